@@ -1,17 +1,53 @@
+import time
+import json
+import atexit
+import random
+import hashlib
+import asyncio
+import email.utils
+from collections.abc import Mapping
+
 import requests
+from requests.adapters import HTTPAdapter
 
+import metrics
+
+
+class LLMError(Exception):
+    """不可重试的错误（鉴权失败、请求格式错误等），或重试次数用尽。"""
+
+    def __init__(self, message, status=None, body=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+class RetryableError(LLMError):
+    """可以重试的错误：网络异常、超时、429、5xx。retry_after 为服务端建议的等待秒数。"""
+
+    def __init__(self, message, status=None, body=None, retry_after=None):
+        super().__init__(message, status, body)
+        self.retry_after = retry_after
 
-# 与llm交互
-def call(chat, model, api_url, token):
-    headers = {
-        "Content-Type": "application/json",  # json格式
-        "Authorization": f"Bearer {token}"  # API调用身份认证
-    }  # 设置请求头
 
+# 这些状态码认为是暂时性的，其余 4xx 直接失败
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def _thaw(obj):
+    """ChatHistory 里只读的消息内容 -> 可以 JSON 序列化的 dict / list（字符串不复制）。"""
+    if isinstance(obj, Mapping):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_thaw(v) for v in obj]
+    return obj
+
+
+def build_request(chat, model, max_tokens=2048):
     data = {
         "model": model,
         "messages": [],  # 多轮对话历史
-        "max_tokens": 2048,  # 控制输出长度
+        "max_tokens": max_tokens,  # 控制输出长度
         'temperature': 0.0,  # 保证deterministic
         "seed": 3
     }
@@ -24,20 +60,335 @@ def call(chat, model, api_url, token):
     #     ]
     # }
     for role, content in chat:
-        data["messages"].append({"role": role, "content": content})
+        data["messages"].append({"role": role, "content": _thaw(content)})
+    return data
+
+
+def canonical_request(data):
+    """
+    去掉图片字节后的请求：data URL 换成 "sha256:<内容哈希>"，其余字段原样保留。
+    用于请求指纹和 trace 落盘。
+    """
+    def strip(obj):
+        if isinstance(obj, dict):
+            if obj.get("type") == "image_url":
+                url = obj["image_url"]["url"]
+                return {"type": "image_url", "image_url": {"url": "sha256:" + hashlib.sha256(url.encode()).hexdigest()}}
+            return {k: strip(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [strip(v) for v in obj]
+        return obj
+    return strip(data)
+
+
+def request_fingerprint(data):
+    """请求指纹：规范化请求（见 canonical_request）按 key 排序序列化后的 sha256。"""
+    text = json.dumps(canonical_request(data), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def request_sizes(data):
+    """请求里文本和图片（data URL）各自的字节数，用于 span 属性。"""
+    text, image = 0, 0
+    for message in data["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            text += len(content.encode())
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                image += len(part["image_url"]["url"])
+            else:
+                text += len(part.get("text", "").encode())
+    return {"prompt_bytes": text, "image_bytes": image}
+
+
+def record_usage(model, status, body):
+    """把返回里的 token 用量写到当前 span 和计数器上。"""
+    sp = metrics.current_span()
+    if not sp.recording:
+        return
+    sp.set(status=status)
+    usage = body.get("usage") if isinstance(body, dict) else None
+    if usage:
+        sp.set(prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"))
+        metrics.inc("llm_prompt_tokens_total", usage.get("prompt_tokens") or 0, model=model)
+        metrics.inc("llm_completion_tokens_total", usage.get("completion_tokens") or 0, model=model)
+
+
+def parse_retry_after(value):
+    """Retry-After 可以是秒数，也可以是 HTTP 日期。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_response(status, body, headers):
+    """按状态码和返回体分类，成功时返回模型的回答。"""
+    if status in RETRYABLE_STATUS:
+        raise RetryableError(f"HTTP {status}", status, body, parse_retry_after(headers.get("Retry-After")))
+    if status >= 400:
+        raise LLMError(f"HTTP {status}", status, body)
+    try:
+        return body['choices'][0]['message']['content']  # 取出模型的回答
+    except (KeyError, IndexError, TypeError):
+        # 200 但没有 choices，一般是网关临时故障
+        raise RetryableError("Malformed response", status, body)
+
+
+def _headers(token):
+    return {
+        "Content-Type": "application/json",  # json格式
+        "Authorization": f"Bearer {token}"  # API调用身份认证
+    }  # 设置请求头
+
+
+def backoff_delay(attempt, base, cap, retry_after=None):
+    """第 attempt 次失败后的等待秒数（full jitter），有 Retry-After 时以它为准。"""
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def _usage(body):
+    return body.get("usage") if isinstance(body, dict) else None
+
+
+def _throttle(limiter, model, error, delay):
+    """429 时让限流器暂停该模型 delay 秒：同一模型的其他调用也一起等，而不是各自立刻重试。"""
+    if limiter is not None and error.status == 429:
+        limiter.penalize(model, delay)
 
-    while True:
+
+def _cache_key(cache, data, priority):
+    """这次调用可以查/写缓存时返回请求指纹，否则返回 None。"""
+    if cache is None or not cache.enabled_for(priority):
+        return None
+    return request_fingerprint(data)
+
+
+def _cancel(ticket):
+    if ticket is not None:
+        ticket.cancel()
+
+
+def _settle(ticket, usage, sp):
+    if ticket is None:
+        return
+    ticket.settle(usage)
+    if ticket.waited > 0.001:
+        sp.set(throttled=round(ticket.waited, 3))
+
+
+class LLMClient:
+    """
+    带连接池的 LLM 客户端：复用 TCP/TLS 连接，设置连接/读取超时，
+    对暂时性错误做指数退避 + 抖动重试（优先遵守 Retry-After），最多 max_attempts 次。
+    limiter 为 ratelimit.RateLimiter 时每次发送（包括重试）前先拿 RPM/TPM 预算；
+    cache 为 llmcache.ResponseCache 时先查缓存，命中则不发请求。
+    """
+
+    def __init__(self, pool_size=8, connect_timeout=10.0, read_timeout=120.0,
+                 max_attempts=5, backoff_base=1.0, backoff_max=30.0, pool_block=False, limiter=None, cache=None):
+        self.limiter = limiter
+        self.cache = cache
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        # pool_block=True 时并发请求数不超过 pool_size，多线程共享一个客户端时用来限流
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=pool_block)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff(self, attempt, retry_after=None):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
+
+    def _post_once(self, api_url, headers, data):
+        try:
+            res = self.session.post(api_url, headers=headers, json=data,
+                                    timeout=(self.connect_timeout, self.read_timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(str(e))
+        try:
+            body = res.json()  # 解析返回json
+        except ValueError:
+            body = res.text
+        record_usage(data["model"], res.status_code, body)
+        return check_response(res.status_code, body, res.headers), _usage(body)
+
+    def call(self, chat, model, api_url, token, max_tokens=2048, priority=None):
+        headers = _headers(token)
+        data = build_request(chat, model, max_tokens)
+
+        with metrics.span("llm", model=model) as sp:
+            if sp.recording:
+                sp.set(**request_sizes(data))
+                metrics.inc("llm_requests_total", model=model)
+            key = _cache_key(self.cache, data, priority)
+            if key is not None:
+                cached = self.cache.get(key, model, priority)
+                if cached is not None:
+                    sp.set(cache="hit")
+                    return cached
+            start = time.perf_counter()
+            for attempt in range(1, self.max_attempts + 1):
+                sp.set(attempts=attempt)
+                ticket = self.limiter.acquire(data, priority) if self.limiter is not None else None
+                try:
+                    content, usage = self._post_once(api_url, headers, data)
+                except RetryableError as e:
+                    _cancel(ticket)
+                    if attempt == self.max_attempts:
+                        raise LLMError(f"Giving up after {attempt} attempts: {e}", e.status, e.body) from e
+                    delay = self.backoff(attempt, e.retry_after)
+                    _throttle(self.limiter, model, e, delay)
+                    metrics.inc("llm_retries_total", model=model)
+                    print(f"Network Error ({e}), retry {attempt}/{self.max_attempts - 1} in {delay:.1f} s")
+                    time.sleep(delay)
+                except BaseException:
+                    # 不重试的错误、投机调用被取消：同样把预扣还回去
+                    _cancel(ticket)
+                    raise
+                else:
+                    _settle(ticket, usage, sp)
+                    if key is not None:
+                        self.cache.put(key, model, content, time.perf_counter() - start)
+                    return content
+
+
+class AsyncLLMClient:
+    """
+    LLMClient 的 asyncio 版本（基于 aiohttp），超时与重试策略相同。
+    内部的 ClientSession 绑定在第一次调用时所在的事件循环上，从别的线程关闭用 close_threadsafe()。
+    """
+
+    def __init__(self, pool_size=8, connect_timeout=10.0, read_timeout=120.0,
+                 max_attempts=5, backoff_base=1.0, backoff_max=30.0, limiter=None, cache=None):
+        self.limiter = limiter
+        self.cache = cache
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+        self._loop = None  # session 所在的事件循环
+
+    def _get_session(self):
+        import aiohttp  # 可选依赖，只有用到异步调用时才需要
+        if self._session is None or self._session.closed:
+            self._loop = asyncio.get_running_loop()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+        return self._session
+
+    async def _post_once(self, api_url, headers, data):
+        import aiohttp
         try:
-            res = requests.post(api_url, headers=headers, json=data)
-            res_json = res.json()  # 解析返回json
-            res_content = res_json['choices'][0]['message']['content']  # 取出模型的回答
-        except:
-            print("Network Error:")
-            try:
-                print(res.json())
-            except:
-                print("Request Failed")
-        else:
-            break
-    
-    return res_content
+            async with self._get_session().post(api_url, headers=headers, json=data) as res:
+                try:
+                    body = await res.json(content_type=None)
+                except ValueError:
+                    body = await res.text()
+                record_usage(data["model"], res.status, body)
+                return check_response(res.status, body, res.headers), _usage(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RetryableError(str(e) or type(e).__name__)
+
+    async def call(self, chat, model, api_url, token, max_tokens=2048, priority=None):
+        headers = _headers(token)
+        data = build_request(chat, model, max_tokens)
+
+        with metrics.span("llm", model=model) as sp:
+            if sp.recording:
+                sp.set(**request_sizes(data))
+                metrics.inc("llm_requests_total", model=model)
+            key = _cache_key(self.cache, data, priority)
+            if key is not None:
+                cached = self.cache.get(key, model, priority)
+                if cached is not None:
+                    sp.set(cache="hit")
+                    return cached
+            start = time.perf_counter()
+            for attempt in range(1, self.max_attempts + 1):
+                sp.set(attempts=attempt)
+                ticket = await self.limiter.acquire_async(data, priority) if self.limiter is not None else None
+                try:
+                    content, usage = await self._post_once(api_url, headers, data)
+                except RetryableError as e:
+                    _cancel(ticket)
+                    if attempt == self.max_attempts:
+                        raise LLMError(f"Giving up after {attempt} attempts: {e}", e.status, e.body) from e
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, e.retry_after)
+                    _throttle(self.limiter, model, e, delay)
+                    metrics.inc("llm_retries_total", model=model)
+                    print(f"Network Error ({e}), retry {attempt}/{self.max_attempts - 1} in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    # 不重试的错误、投机调用被取消：同样把预扣还回去
+                    _cancel(ticket)
+                    raise
+                else:
+                    _settle(ticket, usage, sp)
+                    if key is not None:
+                        self.cache.put(key, model, content, time.perf_counter() - start)
+                    return content
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def close_threadsafe(self, timeout=5.0):
+        """在 session 所在的事件循环上关闭它并等待完成；循环已经停了时什么也不做。"""
+        session, loop = self._session, self._loop
+        if session is None or session.closed or loop is None or not loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout)
+        except Exception as e:
+            print(f"Failed to close async LLM client: {e}")
+
+
+default_client = LLMClient()
+default_async_client = AsyncLLMClient()
+
+
+@atexit.register
+def close_clients():
+    """退出时关掉默认客户端的连接池，避免 aiohttp 报 Unclosed client session。"""
+    default_client.session.close()
+    default_async_client.close_threadsafe()
+
+
+def set_limiter(limiter):
+    """让默认的同步/异步客户端共用一个限流器（None 为不限流）。"""
+    default_client.limiter = limiter
+    default_async_client.limiter = limiter
+
+
+def set_cache(cache):
+    """让默认的同步/异步客户端共用一个应答缓存（None 为不缓存）。"""
+    default_client.cache = cache
+    default_async_client.cache = cache
+
+
+# 与llm交互；priority 为调用所属阶段（见 ratelimit.PRIORITY），预算紧张时决定谁先发
+def call(chat, model, api_url, token, priority=None):
+    return default_client.call(chat, model, api_url, token, priority=priority)
+
+
+async def async_call(chat, model, api_url, token, priority=None):
+    return await default_async_client.call(chat, model, api_url, token, priority=priority)
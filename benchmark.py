@@ -0,0 +1,794 @@
+# 性能基准：python benchmark.py <name> [options]
+import os
+import sys
+import time
+import struct
+import argparse
+import tempfile
+
+
+def _timeit(fn, repeat):
+    """返回 (平均墙钟毫秒, 平均 CPU 毫秒)。"""
+    wall, cpu = 0.0, 0.0
+    for _ in range(repeat):
+        w0, c0 = time.perf_counter(), time.process_time()
+        fn()
+        wall += time.perf_counter() - w0
+        cpu += time.process_time() - c0
+    return wall / repeat * 1000, cpu / repeat * 1000
+
+
+def synthetic_screencap(width=1080, height=2400):
+    """
+    生成一份 screencap 原始输出（带 Android 9+ 的 16 字节头）。
+    渐变背景上叠加随机噪声条带，模拟文字和图标，压缩率接近真实界面。
+    """
+    import numpy as np
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    rgba = np.stack([(x * 255 // width), (y * 255 // height), ((x ^ y) & 0xFF),
+                     np.full_like(x, 255)], axis=-1).astype(np.uint8)
+    for top in range(0, height - 40, 120):
+        rgba[top:top + 40, 40:width - 40, :3] = rng.integers(0, 256, (40, width - 80, 3), dtype=np.uint8)
+    return struct.pack("<IIII", width, height, 1, 0) + rgba.tobytes()
+
+
+def synthetic_ui_dump(items=12, width=1080, height=2400):
+    """生成一份 uiautomator dump 的 XML：标题栏 + 可滚动列表（每项标题 + 摘要，部分带开关）+ 搜索框。"""
+    def node(cls, bounds, text="", desc="", clickable=False, scrollable=False, checkable=False, checked=False, children=""):
+        (x1, y1), (x2, y2) = bounds
+        attrs = (f'text="{text}" resource-id="" class="{cls}" package="com.android.settings" content-desc="{desc}" '
+                 f'checkable="{str(checkable).lower()}" checked="{str(checked).lower()}" clickable="{str(clickable).lower()}" '
+                 f'enabled="true" focusable="{str(clickable).lower()}" focused="false" scrollable="{str(scrollable).lower()}" '
+                 f'long-clickable="false" password="false" selected="false" bounds="[{x1},{y1}][{x2},{y2}]"')
+        return f"<node {attrs}>{children}</node>" if children else f"<node {attrs} />"
+
+    row = (height - 500) // (items + 1)
+    rows = ""
+    for k in range(items):
+        top = 300 + k * row
+        inner = node("android.widget.TextView", ((60, top + 20), (700, top + row // 2)), text=f"Option {k + 1}")
+        inner += node("android.widget.TextView", ((60, top + row // 2), (900, top + row - 20)), text=f"Summary of option {k + 1}")
+        if k % 3 == 0:
+            inner += node("android.widget.Switch", ((width - 180, top + 20), (width - 60, top + row - 20)),
+                          checkable=True, checked=k % 2 == 0)
+        rows += node("android.widget.LinearLayout", ((0, top), (width, top + row)), clickable=True, children=inner)
+    top = 300 + items * row
+    rows += node("android.widget.EditText", ((40, top + 10), (width - 40, top + row - 10)), desc="Search settings", clickable=True)
+    body = node("android.widget.ImageButton", ((0, 80), (126, 206)), desc="Navigate up", clickable=True)
+    body += node("android.widget.TextView", ((150, 100), (600, 190)), text="Display")
+    body += node("androidx.recyclerview.widget.RecyclerView", ((0, 300), (width, height - 100)), scrollable=True, children=rows)
+    root = node("android.widget.FrameLayout", ((0, 0), (width, height)), children=body)
+    return f"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">{root}</hierarchy>"
+
+
+# 截屏：PNG 路径 vs 原始帧路径
+def bench_screencap(args):
+    import chat
+    import controller
+
+    if args.dump:
+        with open(args.dump, "rb") as f:
+            raw = f.read()
+    else:
+        raw = synthetic_screencap(args.width, args.height)
+    frame = controller.parse_raw_screencap(raw)
+    # 设备端 screencap -p 的输出，用本地编码一次代替；这次编码是在设备上做的，单独列出，不计入主机端
+    png = frame.encode("PNG")
+    workdir = tempfile.mkdtemp()
+    out = os.path.join(workdir, "screencap.png")
+
+    def device_png():
+        frame.encode("PNG")
+
+    def png_path():
+        # 拉回的 PNG 落盘 -> 送模型前按默认预处理解码、缩放、编码（每次新建 pipeline，不命中缓存）
+        with open(out, "wb") as f:
+            f.write(png)
+        chat.ImagePipeline().data_url(out)
+
+    def raw_path(save):
+        # 解析帧头 -> 送模型前编码一次；save_screenshots 默认开启时还要在主机上编码一次 PNG 落盘
+        fr = controller.parse_raw_screencap(raw)
+        chat.ImagePipeline().data_url(fr)
+        if save:
+            with open(os.path.join(workdir, "frame.png"), "wb") as f:
+                f.write(fr.encode("PNG"))
+
+    print(f"frame {frame.width}x{frame.height}, raw {len(raw) / 1e6:.1f} MB, png {len(png) / 1e6:.2f} MB "
+          f"(adb transfer time not included)")
+    for name, fn in (("device png encode", device_png), ("png path (host)", png_path),
+                     ("raw path", lambda: raw_path(False)), ("raw path + png save", lambda: raw_path(True))):
+        wall, cpu = _timeit(fn, args.repeat)
+        print(f"{name:>20}: {wall:8.1f} ms wall  {cpu:8.1f} ms cpu")
+
+
+# 截屏守护线程：用一段原始帧流文件代替设备，看取帧延迟
+def bench_capture(args):
+    import numpy as np
+    import metrics
+    import controller
+
+    path = args.stream
+    if path is None:
+        # 没给流文件时合成：4 个不同画面，每个停留 hold 帧（切换后静止，wait_for_settle 才能判定稳定）
+        base = controller.parse_raw_screencap(synthetic_screencap(args.width, args.height))
+        frames = [controller.Frame(base.width, base.height, np.roll(base.array(), k * 40, axis=0).tobytes())
+                  for k in range(4) for _ in range(args.hold)]
+        path = os.path.join(tempfile.mkdtemp(), "stream.raw")
+        controller.write_stream(path, frames)
+
+    target = "bench-capture"
+    daemon = controller.start_capture(target, controller.StreamFileSource(path, fps=args.fps, loop=True))
+    daemon.wait_newer(0.0)
+    idle, after_action, settle = [], [], []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        controller.get_frame(target)
+        idle.append(time.perf_counter() - t0)
+        controller.mark_action(target)
+        t0 = time.perf_counter()
+        controller.get_frame(target)
+        after_action.append(time.perf_counter() - t0)
+        waited, _ = controller.wait_for_settle(target, min_wait=0.0, max_wait=2.0, stable_frames=1)
+        settle.append(waited)
+    controller.stop_capture(target)
+
+    print(f"stream {path}, {args.fps:g} fps, {daemon.frames} frames captured")
+    for name, values in (("latest frame", idle), ("after action", after_action), ("settle", settle)):
+        d = metrics.describe(values)
+        print(f"{name:>13}: p50 {d['p50'] * 1000:7.1f} ms  p95 {d['p95'] * 1000:7.1f} ms")
+
+
+# 界面元素：解析录好的 uiautomator dump，看元素列表的大小和只发文字能省多少 token
+def bench_uidump(args):
+    import controller
+    import ratelimit
+    from prompt import estimate_tokens
+
+    dumps = [(path, open(path, encoding="utf-8").read()) for path in args.xml] or \
+            [("synthetic", synthetic_ui_dump(args.items, args.width, args.height))]
+    scale = min(1.0, args.max_side / max(args.width, args.height))  # 设备像素 -> 截图像素，和 chat.pipeline.scale 一致
+    for path, xml_text in dumps:
+        elements = controller.parse_ui_dump(xml_text)
+        ms, _ = _timeit(lambda: controller.parse_ui_dump(xml_text), args.repeat)
+        text = "\n".join(e.describe(scale) for e in elements)
+        print(f"{path}: {len(xml_text) / 1024:.0f} KB xml, {len(elements)} elements, parse {ms:.1f} ms, "
+              f"usable for text-only: {controller.ui_usable(elements)}, "
+              f"list ~{estimate_tokens(text)} tokens vs ~{ratelimit.IMAGE_TOKENS} per screenshot")
+        if args.show:
+            print(text)
+
+
+# 图片预处理：原图 PNG base64 vs 缩放 + 重新编码
+def bench_images(args):
+    import chat
+    import controller
+
+    if args.dump:
+        with open(args.dump, "rb") as f:
+            raw = f.read()
+    else:
+        raw = synthetic_screencap(args.width, args.height)
+    path = os.path.join(tempfile.mkdtemp(), "screen.png")
+    controller.parse_raw_screencap(raw).save(path)
+
+    configs = {
+        "original": chat.ImagePipeline(max_side=None, fmt=None),
+        f"jpeg{args.quality}@{args.max_side}": chat.ImagePipeline(max_side=args.max_side, quality=args.quality),
+        f"webp{args.quality}@{args.max_side}": chat.ImagePipeline(max_side=args.max_side, fmt="WEBP", quality=args.quality),
+    }
+    for name, pipe in configs.items():
+        wall, cpu = _timeit(lambda: pipe._encode(path), args.repeat)
+        size = len(pipe.data_url(path))
+        # 同一张图再取一次（反思复用决策的截图），应命中缓存
+        hit, _ = _timeit(lambda: pipe.data_url(path), args.repeat)
+        print(f"{name:>16}: {size / 1024:8.0f} KB  encode {wall:7.1f} ms  cached {hit:6.3f} ms")
+
+
+# 对话历史追加：旧的 deepcopy 列表 vs ChatHistory 共享前缀
+def bench_history(args):
+    import copy
+    import tracemalloc
+    import chat
+
+    image = "data:image/jpeg;base64," + "A" * (args.image_kb * 1024)
+
+    def legacy_append(history, role, content):
+        new_history = copy.deepcopy(history)
+        new_history.append([role, content])
+        return new_history
+
+    for name, start, append in (("deepcopy", [], legacy_append),
+                                ("shared", chat.ChatHistory(), lambda h, r, c: h.append(r, c))):
+        history = start
+        tracemalloc.start()
+        print(f"{name}:")
+        for n in range(1, args.messages + 1):
+            content = [{"type": "text", "text": f"step {n}"}, {"type": "image_url", "image_url": {"url": image}}]
+            t0 = time.perf_counter()
+            history = append(history, "user", content)
+            elapsed = (time.perf_counter() - t0) * 1000
+            if n in (1, 10, 50, 100) or n == args.messages:
+                current, _ = tracemalloc.get_traced_memory()
+                print(f"  len={n:4d}  append {elapsed:8.3f} ms  heap {current / 1e6:8.1f} MB")
+        tracemalloc.stop()
+
+
+_WORDS = ("open turn on off enable disable dark theme mode wifi bluetooth display settings search "
+          "navigation location battery sound volume notification account profile message send "
+          "photo camera gallery map route contact call 设置 打开 关闭 搜索 导航 夜间 模式 显示 好友 动态").split()
+
+
+def synthetic_memory_db(n_skills, app_name="Setting", seed=0):
+    """生成 n_skills 条 desc 随机拼词的 skill，用于检索基准。"""
+    import random
+    import memory
+    rng = random.Random(seed)
+    app_mem = {}
+    for i in range(n_skills):
+        desc = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 9))) + f" item{i % 97}"
+        app_mem[memory.make_skill_key(app_name, desc + str(i))] = {
+            "desc": desc, "when_to_use": "", "hint": "", "avoid": "",
+            "stats": {"success": 1, "fail": 0}, "disabled": rng.random() < 0.05,
+        }
+    return {app_name: app_mem}
+
+
+# 记忆检索：逐条 similarity vs SkillIndex
+def bench_retrieval(args):
+    import random
+    import memory
+
+    db = synthetic_memory_db(args.skills)
+    app_mem = db["Setting"]
+    rng = random.Random(1)
+    queries = [" ".join(rng.choice(_WORDS) for _ in range(rng.randint(2, 6))) for _ in range(args.queries)]
+
+    def brute(query):
+        candidates = []
+        for skill_key, rec in app_mem.items():
+            if rec.get("disabled", False):
+                continue
+            score = memory.similarity(query, rec.get("desc", ""))
+            if score >= args.min_score:
+                candidates.append((float(score), str(skill_key), rec))
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        return candidates[:args.top_k]
+
+    t0 = time.perf_counter()
+    index = memory.SkillIndex(db)
+    build = (time.perf_counter() - t0) * 1000
+
+    brute_ms, index_ms, mismatches = 0.0, 0.0, 0
+    for q in queries:
+        t0 = time.perf_counter()
+        expected = brute(q)
+        brute_ms += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        got = index.search("Setting", q, top_k=args.top_k, min_score=args.min_score)
+        index_ms += time.perf_counter() - t0
+        mismatches += [(s, k) for s, k, _ in got] != [(s, k) for s, k, _ in expected]
+    n = len(queries)
+    print(f"{args.skills} skills, {n} queries, index build {build:.0f} ms")
+    print(f"  brute: {brute_ms / n * 1000:8.2f} ms/query")
+    print(f"  index: {index_ms / n * 1000:8.2f} ms/query   top-{args.top_k} mismatches: {mismatches}")
+
+
+# 记忆落盘：整体重写 memory_db.json vs SkillStore 单条记录
+def bench_store(args):
+    import json
+    import memory
+
+    tmp = tempfile.mkdtemp()
+    for n in args.sizes:
+        db = synthetic_memory_db(n)
+        app_mem = db["Setting"]
+        key = next(iter(app_mem))
+        json_path = os.path.join(tmp, f"memory_{n}.json")
+
+        def save_json():
+            app_mem[key]["stats"]["success"] += 1
+            with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(db, f, ensure_ascii=False, indent=2)
+            os.replace(json_path + ".tmp", json_path)
+
+        store = memory.SkillStore(os.path.join(tmp, f"memory_{n}.sqlite"))
+        store.import_db(db)
+
+        def save_store():
+            store.put("Setting", key, app_mem[key])
+            store.incr("Setting", key, "success")
+
+        json_ms, _ = _timeit(save_json, args.repeat)
+        store_ms, _ = _timeit(save_store, args.repeat)
+        print(f"{n:7d} skills: json rewrite {json_ms:8.2f} ms/step   sqlite {store_ms:6.2f} ms/step")
+        store.close()
+
+
+# 同义改写对：(记忆里的 desc, 新任务里的说法)
+PARAPHRASES = [
+    ("turn on Dark theme in Display", "enable dark mode"),
+    ("turn off the Wifi", "disable wi-fi connection"),
+    ("open Bluetooth settings", "go to bluetooth setting page"),
+    ("search for White House in Maps", "look up the White House location"),
+    ("start navigation to destination", "begin navigating to the destination"),
+    ("increase media volume", "turn the media volume up"),
+    ("打开夜间模式", "开启 夜间模式 dark mode"),
+    ("进入好友动态", "打开 QQ 好友动态页面"),
+    ("在设置中关闭wifi", "关闭 WiFi"),
+    ("搜索 北京天气", "search 北京 天气"),
+    ("send a message to contact", "sending messages to a contact"),
+    ("take a photo with camera", "use the camera to take photos"),
+]
+
+
+# 语义检索：同义改写召回率 + 大库查询延迟
+def bench_vector(args):
+    import memory
+
+    encoder = memory.SentenceTransformerEncoder() if args.encoder == "st" else memory.HashingEncoder()
+    db = synthetic_memory_db(args.distractors)
+    app_mem = db["Setting"]
+    for i, (desc, _) in enumerate(PARAPHRASES):
+        app_mem[f"target_{i}"] = {"desc": desc, "when_to_use": "", "stats": {"success": 1, "fail": 0}}
+    backends = {
+        "lexical": (memory.SkillIndex(db), 0.0),
+        f"vector[{encoder.name}]": (memory.VectorIndex(encoder, memory_db=db), -1.0),
+    }
+    for name, (index, min_score) in backends.items():
+        hits = sum(f"target_{i}" in [k for _, k, _ in index.search("Setting", q, top_k=args.top_k, min_score=min_score)]
+                   for i, (_, q) in enumerate(PARAPHRASES))
+        print(f"{name:>24}: paraphrase recall@{args.top_k} {hits}/{len(PARAPHRASES)}")
+
+    # 阈值扫描：改写和自己的原句算正例，和别的原句算负例（main.py 的 retrieval_min_score / vector_min_score 按这个选）
+    targets = {"Setting": {f"target_{i}": {"desc": desc, "when_to_use": ""} for i, (desc, _) in enumerate(PARAPHRASES)}}
+    for name, index in (("lexical", memory.SkillIndex(targets)), (f"vector[{encoder.name}]", memory.VectorIndex(encoder, memory_db=targets))):
+        pos, neg = [], []
+        for i, (_, query) in enumerate(PARAPHRASES):
+            for score, skill_key, _ in index.search("Setting", query, top_k=None, min_score=-1.0):
+                (pos if skill_key == f"target_{i}" else neg).append(score)
+        cells = [f"{t:.2f}: {sum(s >= t for s in pos)}/{len(pos)} hit, {sum(s >= t for s in neg)}/{len(neg)} false"
+                 for t in (0.2, 0.25, 0.3, 0.35, 0.4)]
+        print(f"{name:>24}: " + "; ".join(cells))
+
+    big = synthetic_memory_db(args.skills)
+    t0 = time.perf_counter()
+    index = memory.VectorIndex(encoder, memory_db=big)
+    build = time.perf_counter() - t0
+    queries = [q for _, q in PARAPHRASES]
+    ms, _ = _timeit(lambda: [index.search("Setting", q, top_k=args.top_k) for q in queries], args.repeat)
+    print(f"{args.skills} skills: build {build:.1f} s, query {ms / len(queries):.2f} ms")
+
+
+# 端到端：假设备 + 按阶段应答的 stub LLM 驱动 main.py 的完整循环
+AGENT_STAGES = ("screenshot", "encode", "planning", "retrieval", "decision", "execute",
+                "settle", "diff", "reflection", "memory_write", "persist")
+
+
+class SyntheticDevice:
+    """
+    假设备：每次动作后画面切到下一屏，之后 ui_latency 秒内每帧都在变（模拟动画），然后稳定。
+    capture_ms / shell_ms 模拟 adb 截屏和命令的开销。noop_every 不为 0 时每隔这么多个动作有一个不改变画面（点空了）。
+    """
+
+    def __init__(self, width, height, ui_latency=0.3, capture_ms=30.0, shell_ms=10.0, screens=4, noop_every=0):
+        import numpy as np
+        import controller
+        base = controller.parse_raw_screencap(synthetic_screencap(width, height)).array()
+        self.screens = []
+        for k in range(screens + 2):  # 最后两帧交替作为动画帧
+            arr = base.copy()
+            arr[k * 97 % height:k * 97 % height + height // 6, :, :3] ^= np.uint8(40 * (k + 1))
+            self.screens.append(controller.Frame(width, height, arr.tobytes(), 1))
+        self.width, self.height = width, height
+        self.n_screens = screens
+        self.ui_latency = ui_latency
+        self.capture_ms = capture_ms
+        self.shell_ms = shell_ms
+        self.screen = 0
+        self.last_action = 0.0
+        self.frames = 0
+        self.keyboard = False
+        self.noop_every = noop_every
+        self.actions = 0
+
+    def get_frame(self, adb_path):
+        time.sleep(self.capture_ms / 1000)
+        self.frames += 1
+        if time.time() - self.last_action < self.ui_latency:
+            return self.screens[self.n_screens + self.frames % 2]
+        return self.screens[self.screen]
+
+    def _shell(self, adb_path, *args, check=False):
+        import subprocess as sp
+        time.sleep(self.shell_ms / 1000)
+        if args[:1] == ("dumpsys",):
+            # 键盘状态查询不是动作：点过输入框后键盘弹出，返回键收起
+            return sp.CompletedProcess(list(args), 0, f"mInputShown={str(self.keyboard).lower()}\n", "")
+        if args[:1] == ("uiautomator",):
+            return sp.CompletedProcess(list(args), 0, "UI hierchary dumped to: /sdcard/gui_agent_ui.xml\n", "")
+        if args[:1] == ("cat",):
+            return sp.CompletedProcess(list(args), 0, synthetic_ui_dump(width=self.width, height=self.height), "")
+        self.actions += 1
+        if self.noop_every and self.actions % self.noop_every == 0:
+            return sp.CompletedProcess(list(args), 0, "", "")
+        if args[:2] == ("input", "tap"):
+            self.keyboard = True
+        elif args[:3] == ("input", "keyevent", "4"):
+            self.keyboard = False
+        self.screen = (self.screen + 1) % self.n_screens
+        self.last_action = time.time()
+        return sp.CompletedProcess(list(args), 0, "", "")
+
+    def install(self):
+        import controller
+        controller.get_frame = self.get_frame
+        controller._shell = self._shell
+
+
+class ScriptedLLM:
+    """
+    OpenAI 兼容的 stub：按提示词判断阶段，规划器每 steps_per_subtask 步完成一个子任务。
+    每次应答前等待 latency[stage] 秒，乘上对数正态抖动（jitter 为 sigma）。
+    concurrency 模拟服务端的并发上限，超出的请求排队。
+    """
+
+    def __init__(self, subtasks, steps_per_subtask, latency, jitter=0.0, seed=0, concurrency=None):
+        import random
+        import threading
+        self.subtasks = subtasks
+        self.steps_per_subtask = steps_per_subtask
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(concurrency) if concurrency else None
+
+    @staticmethod
+    def stage(text):
+        if "PLANNER" in text:
+            return "planning"
+        if "BEFORE and AFTER" in text:
+            return "reflection"
+        if "reusable skill" in text:
+            return "memory"
+        return "decision"
+
+    def answer(self, stage, text):
+        import re
+        import json
+        steps = max([int(n) for n in re.findall(r"Step-(\d+)", text)] or [0])
+        if stage == "planning":
+            done = min(steps // self.steps_per_subtask, self.subtasks)
+            subs = [{"id": k + 1, "app_name": "Setting", "desc": f"open display settings and enable option {k + 1}",
+                     "done": k < done} for k in range(self.subtasks)]
+            return json.dumps({"subtasks": subs, "progress": {
+                "completed_ids": list(range(1, done + 1)),
+                "current_app_name": "Setting",
+                "current_subtask": subs[done]["desc"] if done < self.subtasks else "",
+                "completed_summary": f"{done} subtasks done",
+            }})
+        if stage == "reflection":
+            return ("### Thought ###\nThe page changed as expected.\n### Answer ###\nA\n"
+                    f"### Important content ###\nObserved value {steps} on the settings page.")
+        if stage == "memory":
+            return json.dumps({"desc": "enable a display option", "when_to_use": "display settings",
+                               "hint": "open Settings, then Display", "avoid": ""})
+        action = "Type (dark mode)" if steps % 3 == 2 else "Tap (320, 640)"
+        if action.startswith("Tap") and "### UI elements ###" in text:
+            action = "Tap element (4)"
+        return f"### Thought ###\nProceed.\n### Action ###\n{action}\n### Description ###\nOpen the display option"
+
+    @staticmethod
+    def usage(data, answer):
+        """假的 token 用量：文本约 3.5 字符 1 个 token，每张图 1105 个，让客户端的估计有误差可修正。"""
+        chars, images = 0, 0
+        for m in data["messages"]:
+            for c in (m["content"] if isinstance(m["content"], list) else [{"text": m["content"]}]):
+                if c.get("type") == "image_url":
+                    images += 1
+                else:
+                    chars += len(c.get("text", ""))
+        prompt = chars * 2 // 7 + images * 1105
+        completion = len(answer) * 2 // 7
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def delay(self, stage):
+        with self._lock:
+            noise = self.rng.lognormvariate(0, self.jitter) if self.jitter else 1.0
+        return self.latency.get(stage, 0.0) * noise
+
+    def serve(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        llm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                text = "".join(c.get("text", "") for m in data["messages"] if m["role"] == "user"
+                               for c in m["content"] if isinstance(c, dict))
+                stage = llm.stage(text)
+                if llm._slots is not None:
+                    with llm._slots:
+                        time.sleep(llm.delay(stage))
+                else:
+                    time.sleep(llm.delay(stage))
+                answer = llm.answer(stage, text)
+                body = json.dumps({"choices": [{"message": {"content": answer}}],
+                                   "usage": llm.usage(data, answer)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd, f"http://127.0.0.1:{httpd.server_address[1]}/v1/chat/completions"
+
+
+def _git_commit():
+    import subprocess as sp
+    try:
+        return sp.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                      cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_agent(args):
+    import io
+    import json
+    import runpy
+    import resource
+    import contextlib
+    import memory
+    import metrics
+
+    latency = {"planning": args.planning_latency, "decision": args.decision_latency,
+               "reflection": args.reflection_latency, "memory": args.memory_latency}
+    llm = ScriptedLLM(args.subtasks, args.steps_per_subtask, latency, args.jitter, args.seed)
+    httpd, url = llm.serve()
+    device = SyntheticDevice(args.width, args.height, args.ui_latency, args.capture_ms, args.shell_ms,
+                             noop_every=args.noop_every)
+    device.install()
+
+    workdir = tempfile.mkdtemp(prefix="gui_agent_bench_")
+    if args.skills:
+        store = memory.SkillStore(os.path.join(workdir, "memory_db.sqlite"))
+        store.import_db(synthetic_memory_db(args.skills))
+        store.close()
+    os.environ["GUI_AGENT_API_URL"] = url
+    os.environ["GUI_AGENT_API_KEY"] = "bench"
+
+    metrics.reset()
+    metrics.configure(trace_path=args.trace)
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            runpy.run_path(main_path, run_name="__main__")
+    finally:
+        os.chdir(cwd)
+        httpd.shutdown()
+    wall = time.perf_counter() - start
+
+    stats = metrics.summary()
+    steps = stats["durations"].get("step", {}).get("count", 0)  # 投机决策命中时没有 decision span，按 step 计
+    report = {
+        "commit": _git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("func", "json", "verbose", "trace")},
+        "wall": wall,
+        "steps": steps,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stats["durations"],
+        "bytes": stats["bytes"],
+        "counters": stats["counters"],
+    }
+
+    def ms(v):
+        return f"{v * 1000:9.1f}" if v is not None else f"{'-':>9}"
+
+    print(f"{steps} steps in {wall:.1f} s ({wall / max(1, steps):.2f} s/step), peak RSS {report['peak_rss_mb']:.0f} MB")
+    print(f"{'stage':>12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage in AGENT_STAGES:
+        d = stats["durations"].get(stage)
+        if d:
+            print(f"{stage:>12} {d['count']:6d} {ms(d['p50'])} {ms(d['p95'])} {ms(d['p99'])}")
+    for stage, d in stats["bytes"].items():
+        print(f"{stage + ' KB':>12} {d['count']:6d} {d['p50'] / 1024:9.0f} {d['p95'] / 1024:9.0f} {d['p99'] / 1024:9.0f}")
+    local = sum(v for k, v in stats["counters"].items() if k.startswith("reflection_local_total"))
+    if local:
+        print(f"reflection judged locally (no screen change): {local:.0f}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+        print(f"\nvs {args.compare} ({base.get('commit')}): wall {base['wall']:.1f} s -> {wall:.1f} s")
+        for stage in AGENT_STAGES:
+            old, new = base["stages"].get(stage), stats["durations"].get(stage)
+            if old and new and old["p50"]:
+                print(f"{stage:>12} p50 {ms(old['p50'])} -> {ms(new['p50'])} ms ({(new['p50'] / old['p50'] - 1) * 100:+.0f}%)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nreport written to {args.json}")
+
+
+# 多设备吞吐：同样的任务量分给 1/2/4/... 台假设备，看吞吐是否随设备数线性增长
+def bench_runner(args):
+    import io
+    import contextlib
+    import controller
+
+    latency = {"planning": args.planning_latency, "decision": args.decision_latency,
+               "reflection": args.reflection_latency, "memory": args.memory_latency}
+    llm = ScriptedLLM(args.subtasks, args.steps_per_subtask, latency, args.jitter, args.seed, args.llm_concurrency)
+    httpd, url = llm.serve()
+    os.environ["GUI_AGENT_API_URL"] = url
+    os.environ["GUI_AGENT_API_KEY"] = "bench"
+
+    farm = {}  # controller.device() 目标 -> SyntheticDevice
+    controller.get_frame = lambda adb_path: farm[adb_path].get_frame(adb_path)
+    controller._shell = lambda adb_path, *a, check=False: farm[adb_path]._shell(adb_path, *a, check=check)
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="gui_agent_runner_"))
+    try:
+        import api
+        import runner
+        from ratelimit import RateLimiter
+        if args.rpm or args.tpm:
+            api.set_limiter(RateLimiter({}, default={"rpm": args.rpm, "tpm": args.tpm}))
+        runner.share_llm_pool(args.llm_pool)
+        base = None
+        print(f"{'devices':>7} {'tasks':>6} {'wall s':>8} {'tasks/h':>8} {'speedup':>8}")
+        for n in args.devices:
+            serials = [f"emulator-{5554 + 2 * k}" for k in range(n)]
+            for serial in serials:
+                farm[controller.device("adb", serial)] = SyntheticDevice(
+                    args.width, args.height, args.ui_latency, args.capture_ms, args.shell_ms)
+            tasks = [runner.Task(f"benchmark task {k}") for k in range(n * args.tasks_per_device)]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = runner.run_tasks(tasks, serials, "adb", quiet=True)
+            wall = time.perf_counter() - start
+            rate = len(results) / wall * 3600
+            base = base or rate / n
+            failed = sum(not r["completed"] for r in results)
+            print(f"{n:7d} {len(results):6d} {wall:8.1f} {rate:8.0f} {rate / base:7.2f}x" + (f"  ({failed} failed)" if failed else ""))
+        if api.default_client.limiter is not None:
+            for model, st in api.default_client.limiter.summary().items():
+                print(f"\n{model}: {st['requests']} requests, {st['throttled']} throttled ({st['waited']:.1f} s), "
+                      f"{st['rate_limited']} x 429, tokens reserved {st['estimated']} / used {st['actual']}, "
+                      f"estimate ratio {st['ratio']}")
+                for stage, v in sorted(st["stages"].items()):
+                    print(f"{stage:>12} {v['requests']:5d} requests, mean wait {v['waited'] / v['requests'] * 1000:7.0f} ms")
+    finally:
+        os.chdir(cwd)
+        httpd.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GUI Agent benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("screencap", help="PNG screencap vs raw framebuffer, end to end on the host")
+    p.add_argument("--dump", help="screencap 原始输出文件（adb exec-out screencap > dump.raw）")
+    p.add_argument("--width", type=int, default=1080)
+    p.add_argument("--height", type=int, default=2400)
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_screencap)
+
+    p = sub.add_parser("capture", help="frame latency from the capture daemon on a canned raw stream")
+    p.add_argument("--stream", help="原始帧流文件（screencap 原始输出首尾相接，可 .gz），默认合成")
+    p.add_argument("--fps", type=float, default=10.0)
+    p.add_argument("--hold", type=int, default=4, help="合成流里每个画面重复的帧数")
+    p.add_argument("--width", type=int, default=540)
+    p.add_argument("--height", type=int, default=1200)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_capture)
+
+    p = sub.add_parser("uidump", help="parse recorded uiautomator dumps into the element list")
+    p.add_argument("xml", nargs="*", help="uiautomator dump 的 XML 文件，默认合成一份")
+    p.add_argument("--items", type=int, default=12, help="合成的列表项数")
+    p.add_argument("--width", type=int, default=1080)
+    p.add_argument("--height", type=int, default=2400)
+    p.add_argument("--max-side", type=int, default=1280, help="送模型的截图长边，元素坐标按它换算")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--show", action="store_true", help="打印元素列表")
+    p.set_defaults(func=bench_uidump)
+
+    p = sub.add_parser("images", help="bytes and encode time of the image pipeline")
+    p.add_argument("--dump", help="screencap 原始输出文件")
+    p.add_argument("--width", type=int, default=1080)
+    p.add_argument("--height", type=int, default=2400)
+    p.add_argument("--max-side", type=int, default=1280)
+    p.add_argument("--quality", type=int, default=80)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_images)
+
+    p = sub.add_parser("history", help="time and memory per chat history append")
+    p.add_argument("--messages", type=int, default=100)
+    p.add_argument("--image-kb", type=int, default=200)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("retrieval", help="brute-force similarity scan vs SkillIndex")
+    p.add_argument("--skills", type=int, default=10000)
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--top-k", type=int, default=3)
+    p.add_argument("--min-score", type=float, default=0.35)
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser("store", help="per-step persist cost: JSON rewrite vs SkillStore")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_store)
+
+    p = sub.add_parser("vector", help="paraphrase recall and query latency of VectorIndex")
+    p.add_argument("--encoder", choices=["hash", "st"], default="hash")
+    p.add_argument("--distractors", type=int, default=2000)
+    p.add_argument("--skills", type=int, default=100000)
+    p.add_argument("--top-k", type=int, default=3)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_vector)
+
+    p = sub.add_parser("agent", help="end-to-end agent loop with a synthetic device and a stub LLM")
+    p.add_argument("--subtasks", type=int, default=3)
+    p.add_argument("--steps-per-subtask", type=int, default=3, help="任务长度，历史随步数增长")
+    p.add_argument("--skills", type=int, default=1000, help="技能库预置的条数")
+    p.add_argument("--planning-latency", type=float, default=0.2, help="模拟的模型耗时（秒）")
+    p.add_argument("--decision-latency", type=float, default=0.3)
+    p.add_argument("--reflection-latency", type=float, default=0.3)
+    p.add_argument("--memory-latency", type=float, default=0.2)
+    p.add_argument("--jitter", type=float, default=0.2, help="模型耗时的对数正态抖动 sigma")
+    p.add_argument("--ui-latency", type=float, default=0.3, help="动作后画面变化持续的秒数")
+    p.add_argument("--capture-ms", type=float, default=30.0)
+    p.add_argument("--shell-ms", type=float, default=10.0)
+    p.add_argument("--noop-every", type=int, default=0, help="每隔 N 个动作有一个不改变画面，0 为都改变")
+    p.add_argument("--width", type=int, default=1080)
+    p.add_argument("--height", type=int, default=2400)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", help="把结果写成 JSON，便于不同提交之间对比")
+    p.add_argument("--compare", help="之前的 JSON 结果，打印各阶段 p50 的变化")
+    p.add_argument("--trace", help="把每个 span 写成 JSONL")
+    p.add_argument("--verbose", action="store_true", help="显示 main.py 自己的输出")
+    p.set_defaults(func=bench_agent)
+
+    p = sub.add_parser("runner", help="multi-device throughput with synthetic devices and a stub LLM")
+    p.add_argument("--devices", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--tasks-per-device", type=int, default=2)
+    p.add_argument("--llm-pool", type=int, default=8, help="共用的 LLM 连接数上限")
+    p.add_argument("--llm-concurrency", type=int, help="模拟服务端的并发上限")
+    p.add_argument("--rpm", type=int, help="客户端限流：每个模型每分钟请求数")
+    p.add_argument("--tpm", type=int, help="客户端限流：每个模型每分钟 token 数")
+    p.add_argument("--subtasks", type=int, default=2)
+    p.add_argument("--steps-per-subtask", type=int, default=2)
+    p.add_argument("--planning-latency", type=float, default=0.2)
+    p.add_argument("--decision-latency", type=float, default=0.3)
+    p.add_argument("--reflection-latency", type=float, default=0.3)
+    p.add_argument("--memory-latency", type=float, default=0.2)
+    p.add_argument("--jitter", type=float, default=0.2)
+    p.add_argument("--ui-latency", type=float, default=0.3)
+    p.add_argument("--capture-ms", type=float, default=30.0)
+    p.add_argument("--shell-ms", type=float, default=10.0)
+    p.add_argument("--width", type=int, default=720)
+    p.add_argument("--height", type=int, default=1600)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_runner)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
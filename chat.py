@@ -1,32 +1,162 @@
-import copy
+import io
+import os
+import time
 import base64
+import weakref
+import threading
+from types import MappingProxyType
+from collections import OrderedDict
 
+import metrics
 
-# 本地图片文件读成 base64 字符串，以便直接给llm
+
+class ImagePipeline:
+    """
+    送给模型前的图片预处理：长边缩放到 max_side、可选灰度、按 fmt/quality 重新编码。
+    编码结果按 (文件路径, mtime) 或 Frame 对象缓存，同一张图在决策和反思里只编码一次。
+    fmt=None 且 max_side=None 时原样发送文件字节。
+    """
+
+    def __init__(self, max_side=1280, fmt="JPEG", quality=80, grayscale=False, cache_size=8):
+        self.max_side = max_side
+        self.fmt = fmt
+        self.quality = quality
+        self.grayscale = grayscale
+        self.cache_size = cache_size
+        self._file_cache = OrderedDict()
+        self._frame_cache = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()  # 多个 Agent 线程共用一个 pipeline
+        self.stats = {"images": 0, "encoded": 0, "bytes": 0, "encode_time": 0.0}
+
+    def scale(self, width, height):
+        """设备像素 -> 发送图片像素的缩放比例（<= 1）。"""
+        if not self.max_side or max(width, height) <= self.max_side:
+            return 1.0
+        return self.max_side / max(width, height)
+
+    def scaled_size(self, width, height):
+        r = self.scale(width, height)
+        return round(width * r), round(height * r)
+
+    def _encode(self, image):
+        from PIL import Image
+        if hasattr(image, "image"):  # controller.Frame
+            img = image.image()
+        else:
+            if self.fmt is None and self.max_side is None:
+                with open(image, "rb") as f:
+                    ext = str(image).rsplit(".", 1)[-1].lower().replace("jpg", "jpeg")
+                    return f.read(), f"image/{ext}"
+            img = Image.open(image)
+        img = img.convert("L" if self.grayscale else "RGB")
+        if self.scale(*img.size) < 1.0:
+            img = img.resize(self.scaled_size(*img.size), Image.BILINEAR)
+        fmt = self.fmt or "PNG"
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, quality=self.quality)
+        return buf.getvalue(), f"image/{fmt.lower()}"
+
+    def data_url(self, image):
+        """图片（文件路径或 Frame）-> data URL，命中缓存时不再编码。"""
+        if hasattr(image, "image"):
+            cache, key = self._frame_cache, image
+        else:
+            cache, key = self._file_cache, (str(image), os.stat(image).st_mtime_ns)
+        with self._lock:
+            url = cache.get(key)
+        if url is None:
+            # 编码不持锁，不同线程的图片可以并行编码
+            start = time.time()
+            with metrics.span("encode", fmt=self.fmt):
+                data, mime = self._encode(image)
+            url = f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+            with self._lock:
+                self.stats["encoded"] += 1
+                self.stats["encode_time"] += time.time() - start
+                cache[key] = url
+                if cache is self._file_cache:
+                    while len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+        with self._lock:
+            self.stats["images"] += 1
+            self.stats["bytes"] += len(url)
+        return url
+
+
+# 全局默认的预处理配置，main.py 可以整体替换
+pipeline = ImagePipeline()
+
+
+# 图片（本地文件或 controller.Frame）转成 base64 字符串，以便直接给llm
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    return pipeline.data_url(image_path).split(",", 1)[1]
+
+
+def _freeze(obj):
+    """消息内容转成只读结构：dict -> MappingProxyType，list -> tuple，字符串（图片 data URL）不复制。"""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+class ChatHistory:
+    """
+    不可变的对话历史（持久化链表）：每次 append 返回一个新节点，和旧历史共享前缀，
+    不复制任何消息，所以外面持有的旧 history 永远不会被改动。
+    append 时内容被冻结成只读结构，调用方改不了共享的消息（要改先复制，发送前由 api.build_request 转回 dict）。
+    迭代得到 (role, content)，和原来的 [[role, content], ...] 用法一致。
+    """
+    __slots__ = ("_parent", "_message", "_len")
+
+    def __init__(self, parent=None, message=None):
+        self._parent = parent
+        self._message = message
+        self._len = 0 if message is None else len(parent) + 1
+
+    @classmethod
+    def of(cls, messages):
+        history = cls()
+        for role, content in messages:
+            history = history.append(role, content)
+        return history
+
+    def append(self, role, content):
+        return ChatHistory(self, (role, _freeze(content)))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        messages, node = [], self
+        while node._message is not None:
+            messages.append(node._message)
+            node = node._parent
+        return reversed(messages)
+
+    def __getitem__(self, index):
+        return list(self)[index]
 
 
 def init_decision_chat():
-    operation_history = []
     sysetm_prompt = "You are a helpful AI mobile phone operating assistant. You need to help me operate the phone to complete the user\'s instruction."
-    operation_history.append(["system", [{"type": "text", "text": sysetm_prompt}]])
-    return operation_history
+    return ChatHistory().append("system", [{"type": "text", "text": sysetm_prompt}])
 
 
 def init_chat():
-    operation_history = []
     sysetm_prompt = "You are a helpful AI mobile phone operating assistant."
-    operation_history.append(["system", [{"type": "text", "text": sysetm_prompt}]])
-    return operation_history
+    return ChatHistory().append("system", [{"type": "text", "text": sysetm_prompt}])
+
+
+def _as_history(chat_history):
+    # 兼容直接传入 list 的调用方
+    return chat_history if isinstance(chat_history, ChatHistory) else ChatHistory.of(chat_history)
 
 
 def add_response(role, prompt, chat_history, image=None):
-    # 不直接append，先深拷贝，避免外面引用history被改坏
-    new_chat_history = copy.deepcopy(chat_history)
+    # 不直接修改，返回共享前缀的新 history，避免外面引用history被改坏
     if image:
-        base64_image = encode_image(image)
         content = [
             {
                 "type": "text", 
@@ -36,7 +166,7 @@ def add_response(role, prompt, chat_history, image=None):
                 "type": "image_url", 
                 "image_url": {
                     # 把本地文件转成 base64 然后内嵌到消息里给llm，不是放公网 URL
-                    "url": f"data:image/jpeg;base64,{base64_image}"
+                    "url": pipeline.data_url(image)
                 }
             },
         ]
@@ -47,16 +177,11 @@ def add_response(role, prompt, chat_history, image=None):
             "text": prompt
             },
         ]
-    new_chat_history.append([role, content])
-    return new_chat_history
+    return _as_history(chat_history).append(role, content)
 
 
 # 反思阶段的双图
 def add_response_two_image(role, prompt, chat_history, image):
-    new_chat_history = copy.deepcopy(chat_history)
-
-    base64_image1 = encode_image(image[0])
-    base64_image2 = encode_image(image[1])
     content = [
         {
             "type": "text", 
@@ -65,16 +190,24 @@ def add_response_two_image(role, prompt, chat_history, image):
         {
             "type": "image_url", 
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image1}"
+                "url": pipeline.data_url(image[0])
             }
         },
         {
             "type": "image_url", 
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image2}"
+                "url": pipeline.data_url(image[1])
             }
         },
     ]
 
-    new_chat_history.append([role, content])
-    return new_chat_history
+    return _as_history(chat_history).append(role, content)
+
+
+# 估算一次请求的消息体大小（字节），用于统计每次调用发送了多少数据
+def chat_bytes(chat_history):
+    total = 0
+    for role, content in chat_history:
+        for part in content:
+            total += len(part.get("text", "")) + len(part.get("image_url", {}).get("url", ""))
+    return total
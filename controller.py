@@ -1,13 +1,179 @@
 # controller.py
+import re
 import time
+import atexit
+import shlex
+import struct
+import queue
+import threading
 import subprocess as sp
 from pathlib import Path
 
+import metrics
+
+
+# 是否复用常驻 adb shell 会话（False 时退回每条命令起一个 adb 进程）
+PERSISTENT_SHELL = True
+
+
+def device(adb_path, serial=None):
+    """
+    指定设备：返回可以代替 adb_path 传给本模块所有函数的目标（adb -s <serial>）。
+    serial 为 None 时就是 adb_path 本身（只连了一台设备）。
+    """
+    return adb_path if serial is None else (adb_path, "-s", serial)
+
+
+def _argv(adb_path):
+    """adb_path 可以是路径字符串，也可以是 device() 返回的 (路径, "-s", serial)。"""
+    return [adb_path] if isinstance(adb_path, str) else list(adb_path)
+
+
+def list_devices(adb_path):
+    """adb devices 里状态为 device（已连接、已授权）的序列号。"""
+    out = sp.run([adb_path, "devices"], capture_output=True, text=True, check=True).stdout
+    return [line.split()[0] for line in out.splitlines()[1:] if line.strip().endswith("\tdevice")]
+
 
 # 稳定调用 ADB（不会被路径空格影响）
 def _run(adb_path, *args, check=False):
     """以列表参数方式调用 adb，避免空格路径问题。"""
-    return sp.run([adb_path, *map(str, args)], capture_output=True, text=True, check=check)
+    with metrics.span("adb.run", cmd=str(args[0]) if args else "") as span:
+        res = sp.run([*_argv(adb_path), *map(str, args)], capture_output=True, text=True, check=check)
+        span.set(code=res.returncode)
+    metrics.inc("adb_commands_total", kind="run")
+    return res
+
+
+class AdbShell:
+    """
+    常驻的 adb shell 会话：命令从 stdin 写入，读 stdout 直到结束标记为止。
+    写入失败时重连并重发一次；已经写进去之后断开或超时不重发（命令可能已生效，重发会点两次），下次调用重连。
+    """
+
+    def __init__(self, adb_path, timeout=30.0):
+        self.adb_path = adb_path
+        self.timeout = timeout
+        self._proc = None
+        self._lines = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._proc = sp.Popen(
+            [*_argv(self.adb_path), "shell"],
+            stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.STDOUT,
+            text=True, encoding="utf-8", errors="replace", bufsize=1,
+        )
+        # 后台线程逐行读输出，主线程按超时取，避免 readline 卡死
+        self._lines = queue.Queue()
+        threading.Thread(target=self._pump, args=(self._proc, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _pump(proc, lines):
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)  # EOF：shell 已退出
+
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.write("exit\n")
+            self._proc.stdin.flush()
+            self._proc.wait(timeout=1)
+        except Exception:
+            self._proc.kill()
+        self._proc = None
+
+    def _reset(self):
+        if self._proc is not None:
+            self._proc.kill()
+        self._proc = None
+
+    def _send(self, cmd):
+        """把命令写进会话，返回它的结束标记。"""
+        if not self.alive():
+            self._start()
+        self._seq += 1
+        marker = f"__GUI_AGENT_DONE_{self._seq}__"
+        self._proc.stdin.write(f"{cmd} 2>&1; echo {marker} $?\n")
+        self._proc.stdin.flush()
+        return marker
+
+    def _read(self, cmd, marker):
+        out = []
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                raise TimeoutError(f"adb shell command timed out: {cmd}")
+            if line is None:
+                raise ConnectionError("adb shell session closed")
+            if marker in line:
+                # 输出末尾没有换行时，标记会和最后一段输出连在同一行
+                head, tail = line.split(marker, 1)
+                out.append(head)
+                return int(tail.strip() or 0), "".join(out)
+            out.append(line)
+
+    def run(self, *args, check=False):
+        """执行一条 shell 命令，返回与 subprocess.run 相同形状的 CompletedProcess。"""
+        cmd = " ".join(shlex.quote(str(a)) for a in args)
+        with self._lock:
+            try:
+                marker = self._send(cmd)
+            except (OSError, ValueError):
+                # 写不进去说明命令没发出，重连一次再发
+                self._reset()
+                marker = self._send(cmd)
+            try:
+                code, stdout = self._read(cmd, marker)
+            except (ConnectionError, TimeoutError):
+                # 命令已经写入，可能已生效，不重发；丢弃会话，下次调用重连
+                self._reset()
+                raise
+        res = sp.CompletedProcess([*_argv(self.adb_path), "shell", *map(str, args)], code, stdout, "")
+        if check:
+            res.check_returncode()
+        return res
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_shell(adb_path):
+    """每个 adb_path（每台设备）共用一个常驻 shell 会话。"""
+    with _sessions_lock:
+        if adb_path not in _sessions:
+            _sessions[adb_path] = AdbShell(adb_path)
+        return _sessions[adb_path]
+
+
+@atexit.register
+def close_shells():
+    with _sessions_lock:
+        for shell in _sessions.values():
+            shell.close()
+        _sessions.clear()
+
+
+def _shell(adb_path, *args, check=False):
+    """在设备上执行 shell 命令；默认走常驻会话。"""
+    metrics.inc("adb_commands_total", kind="shell")
+    with metrics.span("adb.shell", cmd=" ".join(map(str, args[:2]))) as span:
+        if not PERSISTENT_SHELL:
+            # adb 会把参数拼起来交给设备端 sh，需要逐个转义
+            res = _run(adb_path, "shell", *(shlex.quote(str(a)) for a in args), check=check)
+        else:
+            res = get_shell(adb_path).run(*args, check=check)
+        span.set(code=res.returncode)
+    return res
 
 
 # 截屏：先 exec-out，失败则回退 shell+pull
@@ -16,22 +182,31 @@ def get_screenshot(adb_path, save_path):
     抓取屏幕并保存到 ./screenshot/screenshot.png
     成功后返回保存路径（字符串）。
     """
+    if adb_path in _daemons:
+        return get_frame(adb_path).save(save_path)
+    with metrics.span("adb.screencap", png=True) as span:
+        out = _get_screenshot(adb_path, save_path)
+        span.set(bytes=Path(out).stat().st_size)
+    return out
+
+
+def _get_screenshot(adb_path, save_path):
     out_path = Path(save_path)
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
     # exec-out 直接写本地文件
     try:
         with open(out_path, "wb") as f:
-            sp.run([adb_path, "exec-out", "screencap", "-p"], stdout=f, stderr=sp.PIPE, check=True)
+            sp.run([*_argv(adb_path), "exec-out", "screencap", "-p"], stdout=f, stderr=sp.PIPE, check=True)
     except sp.CalledProcessError as e:
         # 回退到 shell 保存到设备 + pull 回来
         dev_tmp = "/sdcard/screenshot.png"
-        _run(adb_path, "shell", "rm", "-f", dev_tmp)  # 清理旧文件，忽略失败
+        _shell(adb_path, "rm", "-f", dev_tmp)  # 清理旧文件，忽略失败
         time.sleep(0.2)
-        _run(adb_path, "shell", "screencap", "-p", dev_tmp, check=True)
+        _shell(adb_path, "screencap", "-p", dev_tmp, check=True)
         time.sleep(0.2)
         _run(adb_path, "pull", dev_tmp, str(out_path), check=True)
-        _run(adb_path, "shell", "rm", "-f", dev_tmp)
+        _shell(adb_path, "rm", "-f", dev_tmp)
 
     # 最终校验
     if (not out_path.exists()) or out_path.stat().st_size == 0:
@@ -39,37 +214,751 @@ def get_screenshot(adb_path, save_path):
     return str(out_path)
 
 
+# screencap 原始输出的像素格式（都是每像素 4 字节）-> PIL raw mode
+_RAW_MODES = {1: "RGBA", 2: "RGBX", 5: "BGRA"}
+
+
+class Frame:
+    """一帧原始截图（RGBA 像素 + 宽高），只在真正需要时才编码成 PNG/JPEG。"""
+
+    def __init__(self, width, height, pixels, pixel_format=1, timestamp=None):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.pixel_format = pixel_format
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def array(self):
+        """(height, width, 4) 的 uint8 数组，零拷贝。"""
+        import numpy as np
+        arr = np.frombuffer(self.pixels, dtype=np.uint8).reshape(self.height, self.width, 4)
+        if self.pixel_format == 5:
+            arr = arr[..., [2, 1, 0, 3]]
+        return arr
+
+    def image(self):
+        from PIL import Image
+        raw_mode = _RAW_MODES.get(self.pixel_format, "RGBA")
+        img = Image.frombuffer("RGBA", self.size, self.pixels, "raw", raw_mode, 0, 1)
+        return img.convert("RGB")
+
+    def encode(self, fmt="PNG", **params):
+        """编码成图片字节，fmt 为 PIL 格式名（PNG / JPEG / WEBP）。"""
+        import io
+        buf = io.BytesIO()
+        self.image().save(buf, format=fmt, **params)
+        return buf.getvalue()
+
+    def save(self, save_path, fmt="PNG", **params):
+        out_path = Path(save_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_bytes(self.encode(fmt, **params))
+        return str(out_path)
+
+
+def parse_raw_screencap(data):
+    """
+    解析不带 -p 的 screencap 输出：头部 width/height/format（Android 9+ 还多一个 colorspace），
+    后面紧跟像素数据。头部长度由总长度反推。
+    """
+    if len(data) < 12:
+        raise ValueError(f"screencap output too short: {len(data)} bytes")
+    width, height, pixel_format = struct.unpack_from("<III", data, 0)
+    header = len(data) - width * height * 4
+    if header not in (12, 16):
+        raise ValueError(f"unexpected screencap layout: {width}x{height}, {len(data)} bytes")
+    return Frame(width, height, memoryview(data)[header:], pixel_format)
+
+
+def _screencap(adb_path):
+    with metrics.span("adb.screencap") as span:
+        res = sp.run([*_argv(adb_path), "exec-out", "screencap"], capture_output=True, check=True)
+        span.set(bytes=len(res.stdout))
+    return parse_raw_screencap(res.stdout)
+
+
+# 原始帧截屏：跳过设备端 PNG 压缩和本地 PNG 解码；开了截屏守护线程时直接取它手里的最新帧
+def get_frame(adb_path):
+    daemon = _daemons.get(adb_path)
+    if daemon is not None:
+        return daemon.wait_newer(_last_action.get(adb_path, 0.0))
+    return _screencap(adb_path)
+
+
+class CaptureDaemon:
+    """
+    后台持续截屏，始终持有最新一帧。帧的 timestamp 是开始截取的时刻，
+    晚于某个动作的帧一定是动作之后的画面。
+    source 为无参可调用对象，每次返回一帧 Frame（阻塞到拿到为止），抛 EOFError 表示流结束。
+    """
+
+    def __init__(self, source, name="capture"):
+        self.source = source
+        self.frames = 0
+        self.error = None
+        self._frame = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join(timeout=5)
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    def _loop(self):
+        while not self._stopped:
+            try:
+                frame = self.source()
+            except EOFError:
+                break
+            except Exception as e:
+                # 设备暂时断开之类：记下错误，稍后重试
+                self.error = e
+                time.sleep(0.5)
+                continue
+            with self._cond:
+                self._frame = frame
+                self.frames += 1
+                self._cond.notify_all()
+        with self._cond:
+            self._cond.notify_all()
+
+    def latest(self):
+        return self._frame
+
+    def wait_newer(self, since, timeout=None):
+        """
+        返回时间戳晚于 since 的最新帧。timeout 秒内没有这样的帧就返回手里的最新帧：
+        只在画面变化时出帧的源（source.quiet_period）等这么久没新帧说明画面没变，其余源默认等 10 秒。
+        """
+        if timeout is None:
+            timeout = getattr(self.source, "quiet_period", None) or 10.0
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._frame is None or self._frame.timestamp <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._thread.is_alive():
+                    break
+                self._cond.wait(remaining)
+            frame = self._frame
+        if frame is None:
+            raise RuntimeError(f"Capture daemon has no frame yet: {self.error}")
+        return frame
+
+
+def screencap_source(adb_path):
+    """守护线程的默认帧源：连续执行 exec-out screencap（原始帧）。"""
+    def capture():
+        start = time.time()
+        frame = _screencap(adb_path)
+        frame.timestamp = start
+        return frame
+    return capture
+
+
+class StreamFileSource:
+    """
+    从文件回放一段连续的原始截屏，代替设备测试守护线程。文件是若干份 screencap 原始输出首尾相接
+    （每帧 header 字节的头，Android 9+ 为 16，可以用 adb exec-out screencap >> stream.raw 攒），
+    以 .gz 结尾时按 gzip 读。按 fps 出帧；读完后 loop=True 从头再来，否则抛 EOFError。
+    """
+
+    def __init__(self, path, fps=10.0, header=16, loop=False):
+        self.path = path
+        self.interval = 1.0 / fps
+        self.header = header
+        self.loop = loop
+        self._file = self._open()
+        self._next = time.time()
+
+    def _open(self):
+        import gzip
+        return gzip.open(self.path, "rb") if self.path.endswith(".gz") else open(self.path, "rb")
+
+    def _read(self):
+        head = self._file.read(self.header)
+        if len(head) < self.header:
+            return None
+        width, height, pixel_format = struct.unpack_from("<III", head, 0)
+        pixels = self._file.read(width * height * 4)
+        if len(pixels) < width * height * 4:
+            return None
+        return width, height, pixel_format, pixels
+
+    def __call__(self):
+        delay = self._next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next = max(self._next + self.interval, time.time())
+        record = self._read()
+        if record is None and self.loop:
+            self._file.close()
+            self._file = self._open()
+            record = self._read()
+        if record is None:
+            raise EOFError(self.path)
+        width, height, pixel_format, pixels = record
+        return Frame(width, height, pixels, pixel_format)
+
+    def close(self):
+        self._file.close()
+
+
+def write_stream(path, frames, header=16):
+    """把若干 Frame 写成 StreamFileSource 能读的文件（以 .gz 结尾时压缩）。"""
+    import gzip
+    with (gzip.open(path, "wb") if path.endswith(".gz") else open(path, "wb")) as f:
+        for frame in frames:
+            head = struct.pack("<III", frame.width, frame.height, frame.pixel_format)
+            f.write(head + b"\0" * (header - len(head)))
+            f.write(frame.pixels)
+
+
+class ScreenrecordSource:
+    """
+    screenrecord 输出的 H.264 流在本地用 PyAV 解码（可选依赖，pip install av）。
+    画面不变时不出新帧；设备端录满时长限制后会退出，这里自动重启。
+    编码 + 传输有延迟，帧时间戳按 latency 秒往前算。
+    """
+    quiet_period = 0.3  # 这么久没有新帧就认为画面没变
+
+    def __init__(self, adb_path, size=None, bit_rate=8000000, latency=0.15):
+        self.adb_path = adb_path
+        self.size = size  # 例如 "720x1600"，None 为设备原始分辨率
+        self.bit_rate = bit_rate
+        self.latency = latency
+        self._proc = None
+        self._frames = None
+
+    def _open(self):
+        import av
+        argv = [*_argv(self.adb_path), "exec-out", "screenrecord", "--output-format=h264",
+                f"--bit-rate={self.bit_rate}"]
+        if self.size:
+            argv += ["--size", self.size]
+        self._proc = sp.Popen([*argv, "-"], stdout=sp.PIPE, stderr=sp.DEVNULL)
+        self._frames = av.open(self._proc.stdout, format="h264", mode="r").decode(video=0)
+
+    def __call__(self):
+        while True:
+            if self._frames is None:
+                self._open()
+            try:
+                video_frame = next(self._frames)
+            except StopIteration:
+                # 录制结束（时长限制或设备断开），重开一个
+                self.close()
+                time.sleep(0.2)
+                continue
+            pixels = video_frame.to_ndarray(format="rgba").tobytes()
+            return Frame(video_frame.width, video_frame.height, pixels, 1, time.time() - self.latency)
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.kill()
+        self._proc = None
+        self._frames = None
+
+
+_daemons = {}  # adb_path -> CaptureDaemon
+_last_action = {}  # adb_path -> 最近一次动作（tap / swipe / 输入 / 按键）完成的时刻
+
+
+def start_capture(adb_path, source=None):
+    """
+    为这台设备启动截屏守护线程（已启动则直接返回）。之后 get_frame / get_screenshot /
+    wait_for_settle 都从它取最近一次动作之后的最新帧，不再按需截屏。
+    """
+    with _sessions_lock:
+        daemon = _daemons.get(adb_path)
+        if daemon is None or not daemon.alive():
+            daemon = _daemons[adb_path] = CaptureDaemon(source or screencap_source(adb_path),
+                                                        name=f"capture-{adb_path}").start()
+        return daemon
+
+
+@atexit.register
+def stop_capture(adb_path=None):
+    """停掉这台设备（None 为所有设备）的截屏守护线程。"""
+    with _sessions_lock:
+        targets = list(_daemons) if adb_path is None else [adb_path]
+        daemons = [_daemons.pop(t) for t in targets if t in _daemons]
+    for daemon in daemons:
+        daemon.stop()
+
+
+def mark_action(adb_path):
+    """记录动作完成的时刻：之后取的帧必须晚于它。"""
+    _last_action[adb_path] = time.time()
+
+
+def block_hash(frame, rows=32, cols=16):
+    """
+    低分辨率块哈希：隔点采样成小图，灰度后按 rows x cols 分块取均值，量化到 16 级。
+    只用来判断两帧是否"看起来一样"，对压缩噪声和细小抖动不敏感。
+    """
+    import numpy as np
+    arr = frame.array()
+    h, w = arr.shape[:2]
+    small = arr[::max(1, h // (rows * 4)), ::max(1, w // (cols * 4)), :3]
+    gray = small.mean(axis=2)
+    if gray.shape[0] < rows or gray.shape[1] < cols:
+        # 比网格还小的帧（缩略图之类）：最近邻放大到网格大小，每块就是一个像素
+        gray = gray[np.arange(rows) * gray.shape[0] // rows][:, np.arange(cols) * gray.shape[1] // cols]
+    sh, sw = gray.shape[0] // rows * rows, gray.shape[1] // cols * cols
+    blocks = gray[:sh, :sw].reshape(rows, sh // rows, cols, sw // cols).mean(axis=(1, 3))
+    return (blocks // 16).astype(np.uint8)
+
+
+class FrameDiff:
+    """两帧的差异：ratio 为变化像素占比（降采样后），boxes 为变化区域的外接框（设备像素 x1, y1, x2, y2）。"""
+    __slots__ = ("ratio", "boxes")
+
+    def __init__(self, ratio, boxes):
+        self.ratio = ratio
+        self.boxes = boxes
+
+    def __repr__(self):
+        return f"FrameDiff(ratio={self.ratio:.5f}, boxes={self.boxes})"
+
+
+def _pixels(image):
+    """Frame 或图片路径 -> (height, width, 3) 数组。"""
+    import numpy as np
+    if isinstance(image, Frame):
+        return image.array()[..., :3]
+    from PIL import Image
+    return np.asarray(Image.open(image).convert("RGB"))
+
+
+def frame_diff(before, after, stride=4, pixel_delta=24, ignore_top=0.04, cell=16):
+    """
+    动作前后两帧的差异（numpy 向量化）：隔 stride 个像素采样，灰度差超过 pixel_delta 的算变化像素；
+    顶部 ignore_top 比例的状态栏（时钟、通知图标）不算。
+    变化像素按 cell x cell（采样后）的格子聚合，相邻的变化格子合并成一个外接框。
+    尺寸不同（比如横竖屏切换）时认为整屏都变了。
+    """
+    import numpy as np
+    a, b = _pixels(before), _pixels(after)
+    h, w = b.shape[:2]
+    if a.shape != b.shape:
+        return FrameDiff(1.0, [(0, 0, w, h)])
+    top = int(h * ignore_top) // stride * stride
+    ga = a[top::stride, ::stride].astype(np.int16).sum(axis=2)
+    gb = b[top::stride, ::stride].astype(np.int16).sum(axis=2)
+    mask = np.abs(ga - gb) > pixel_delta * 3
+    ratio = float(mask.mean()) if mask.size else 0.0
+    if not mask.any():
+        return FrameDiff(ratio, [])
+
+    # 格子级别的连通区域（格子数很少，直接 BFS）
+    rows, cols = -(-mask.shape[0] // cell), -(-mask.shape[1] // cell)
+    padded = np.zeros((rows * cell, cols * cell), dtype=bool)
+    padded[:mask.shape[0], :mask.shape[1]] = mask
+    changed = padded.reshape(rows, cell, cols, cell).any(axis=(1, 3))
+    seen = np.zeros_like(changed)
+    boxes = []
+    for r0, c0 in zip(*np.nonzero(changed)):
+        if seen[r0, c0]:
+            continue
+        seen[r0, c0] = True
+        stack, r1, c1, r2, c2 = [(r0, c0)], r0, c0, r0, c0
+        while stack:
+            r, c = stack.pop()
+            r1, c1, r2, c2 = min(r1, r), min(c1, c), max(r2, r), max(c2, c)
+            for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+                if 0 <= nr < rows and 0 <= nc < cols and changed[nr, nc] and not seen[nr, nc]:
+                    seen[nr, nc] = True
+                    stack.append((nr, nc))
+        size = cell * stride
+        boxes.append((int(c1 * size), int(top + r1 * size), int(min(w, (c2 + 1) * size)), int(min(h, top + (r2 + 1) * size))))
+    return FrameDiff(ratio, boxes)
+
+
+# 动作后等待 UI 稳定：画面连续 stable_frames 帧不变就返回，代替固定 sleep
+def wait_for_settle(adb_path, min_wait=0.3, max_wait=3.0, stable_frames=2, interval=0.1, tolerance=1):
+    """
+    轮询截屏直到画面稳定，至少等 min_wait 秒，最多等 max_wait 秒。
+    tolerance 为允许变化的块数（光标闪烁之类）。
+    返回 (实际等待秒数, 最后一帧)，最后一帧可直接当作动作后的截图。
+    没有截屏守护线程时每次轮询是一次完整截屏，模拟器上要 200-500 ms，实际轮询周期是 max(interval, 截屏耗时)，
+    判定稳定至少要 stable_frames + 1 次截屏；span 的 poll_ms 记录平均每次截屏的耗时。开了守护线程时直接用它的帧流。
+    """
+    span = metrics.span("adb.settle")
+    daemon = _daemons.get(adb_path)
+    start = time.time()
+    time.sleep(min_wait)
+    polled = time.time()
+    frame = get_frame(adb_path)
+    capture = time.time() - polled
+    last, stable, frames = block_hash(frame), 0, 1
+    while stable < stable_frames and time.time() - start < max_wait:
+        if daemon is not None:
+            # 守护线程的流上直接取下一帧，不用自己定时截屏
+            quiet = getattr(daemon.source, "quiet_period", None) or max_wait
+            frame = daemon.wait_newer(frame.timestamp, timeout=max(0.0, min(quiet, max_wait - (time.time() - start))))
+        else:
+            # interval 从上一次截屏开始算：截屏本身比 interval 慢时不再额外睡
+            time.sleep(max(0.0, interval - (time.time() - polled)))
+            polled = time.time()
+            frame = get_frame(adb_path)
+            capture += time.time() - polled
+        frames += 1
+        cur = block_hash(frame)
+        stable = stable + 1 if int((cur != last).sum()) <= tolerance else 0
+        last = cur
+    if daemon is None:
+        span.set(poll_ms=round(capture / frames * 1000, 1))
+    span.set(frames=frames, stable=stable >= stable_frames).end()
+    return time.time() - start, frame
+
+
+# 软键盘状态：优先读 dumpsys input_method，读不到时看截图底部
+_INPUT_SHOWN = re.compile(r"\b(?:mInputShown|mIsInputViewShown|isInputViewShown)=(true|false)")
+
+
+def parse_input_method(text):
+    """从 dumpsys input_method 的输出里取 mInputShown（老版本里是 mIsInputViewShown），取不到返回 None。"""
+    m = _INPUT_SHOWN.search(text or "")
+    return None if m is None else m.group(1) == "true"
+
+
+def _query(adb_path, *args):
+    """
+    只读的设备查询（dumpsys、uiautomator dump 等）。它们在后台线程里和截屏同时进行，先后顺序不固定，
+    录制/回放（replay.py）把它们放在单独的通道里按参数对应，不占设备事件的顺序。
+    """
+    return _shell(adb_path, *args)
+
+
+def keyboard_shown(adb_path):
+    """软键盘是否弹出（走常驻 shell），取不到时返回 None。"""
+    try:
+        res = _query(adb_path, "dumpsys", "input_method")
+    except Exception:
+        return None
+    return parse_input_method(res.stdout) if res.returncode == 0 else None
+
+
+_probe_pool = None
+
+
+def _submit(fn, *args):
+    """在后台线程池里跑设备查询（键盘状态、界面树），和截屏、LLM 调用并行。"""
+    global _probe_pool
+    if _probe_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with _sessions_lock:
+            if _probe_pool is None:
+                _probe_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="device-probe")
+    return _probe_pool.submit(fn, *args)
+
+
+def probe_keyboard(adb_path):
+    """在后台线程里查键盘状态，返回 Future，可以和截屏同时进行。"""
+    return _submit(keyboard_shown, adb_path)
+
+
+# 截图兜底检测的阈值：键盘顶边出现在屏高的这个范围内；顶边那一行变化明显的列占比；
+# 键盘区域里最多的 3 种颜色的总占比下限；按键文字带来的边缘密度范围
+KEYBOARD_TOP_RANGE = (0.45, 0.8)
+KEYBOARD_EDGE_COVERAGE = 0.9
+KEYBOARD_MIN_FLAT = 0.75
+KEYBOARD_EDGE_DENSITY = (0.01, 0.3)
+
+
+def keyboard_from_frame(frame):
+    """
+    看截图底部有没有软键盘：键盘是一块铺满宽度的区域，顶边是一条贯穿全宽的分界线，
+    内部颜色种类少（键盘底色 + 按键色），按键文字带来一定的边缘密度。只是 dumpsys 读不到时的兜底。
+    """
+    import numpy as np
+    rgb = frame.array()[::4, ::4, :3].astype(np.int16)
+    gray = rgb.mean(axis=2)
+    h = gray.shape[0]
+    lo, hi = int(h * KEYBOARD_TOP_RANGE[0]), int(h * KEYBOARD_TOP_RANGE[1])
+    coverage = (np.abs(np.diff(gray[lo:hi], axis=0)) > 12).mean(axis=1)
+    edges = np.nonzero(coverage >= KEYBOARD_EDGE_COVERAGE)[0]
+    if not len(edges):
+        return False
+    # 最上面的一条全宽分界线当作键盘顶边，去掉最底下的导航栏
+    region = rgb[lo + edges[0] + 2:int(h * 0.95)]
+    if len(region) < h * 0.1:
+        return False
+    colors = (region >> 5).reshape(-1, 3)
+    codes = colors[:, 0] * 64 + colors[:, 1] * 8 + colors[:, 2]
+    counts = np.bincount(codes, minlength=512)
+    flat = np.sort(counts)[-3:].sum() / len(codes)
+    density = (np.abs(np.diff(region.mean(axis=2), axis=1)) > 24).mean()
+    return bool(flat >= KEYBOARD_MIN_FLAT and KEYBOARD_EDGE_DENSITY[0] <= density <= KEYBOARD_EDGE_DENSITY[1])
+
+
+def keyboard_state(probe, frame=None):
+    """
+    汇总键盘状态：probe 为 probe_keyboard 返回的 Future（可以为 None），
+    读不到时用 frame（Frame）兜底，两者都没有时认为没有弹出。
+    """
+    shown = None
+    if probe is not None:
+        try:
+            shown = probe.result(timeout=5)
+        except Exception:
+            shown = None
+    if shown is None and isinstance(frame, Frame):
+        shown = keyboard_from_frame(frame)
+        metrics.inc("keyboard_probe_total", source="frame")
+    elif shown is not None:
+        metrics.inc("keyboard_probe_total", source="dumpsys")
+    return bool(shown)
+
+
+# 界面元素：uiautomator dump 的控件树压成带编号的可操作元素列表
+class UIElement:
+    """一个可操作（或带文字）的控件。bounds 为设备像素 (x1, y1, x2, y2)。"""
+    __slots__ = ("id", "label", "kind", "resource_id", "bounds", "clickable", "editable", "scrollable", "checked")
+
+    def __init__(self, label, kind, resource_id, bounds, clickable, editable, scrollable, checked):
+        self.id = None
+        self.label = label
+        self.kind = kind
+        self.resource_id = resource_id
+        self.bounds = bounds
+        self.clickable = clickable
+        self.editable = editable
+        self.scrollable = scrollable
+        self.checked = checked
+
+    @property
+    def center(self):
+        x1, y1, x2, y2 = self.bounds
+        return (x1 + x2) // 2, (y1 + y2) // 2
+
+    def describe(self, scale=1.0):
+        """一行文字描述，坐标换算成截图（缩放后）坐标；scale 为设备像素 -> 截图像素的比例（chat.pipeline.scale，<= 1）。"""
+        x, y = self.center
+        text = f'[{self.id}] {self.kind}'
+        if self.label:
+            text += f' "{self.label}"'
+        flags = [f for f, on in (("input", self.editable), ("scrollable", self.scrollable),
+                                 ("checked", self.checked is True), ("unchecked", self.checked is False)) if on]
+        if flags:
+            text += " (" + ", ".join(flags) + ")"
+        return text + f" at ({round(x * scale)}, {round(y * scale)})"
+
+
+_BOUNDS = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+UI_MAX_ELEMENTS = 80
+UI_LABEL_MAX_CHARS = 60
+
+
+def parse_ui_dump(xml_text, max_elements=UI_MAX_ELEMENTS):
+    """
+    解析 uiautomator dump 的 XML，返回按位置（从上到下、从左到右）编号的 UIElement 列表（编号从 1 开始）。
+    保留可点击 / 可勾选 / 可滚动 / 输入框，以及不在这些控件里面的文字；
+    自身没有文字的可点击控件用子孙节点的文字作标签。
+    """
+    import xml.etree.ElementTree as ET
+    start = xml_text.find("<?xml")
+    if start < 0:
+        start = xml_text.find("<hierarchy")
+    end = xml_text.rfind(">")
+    root = ET.fromstring(xml_text[max(start, 0):end + 1])
+    elements = []
+
+    def texts(node):
+        out = []
+        for n in node.iter("node"):
+            t = (n.get("text") or n.get("content-desc") or "").strip()
+            if t and t not in out:
+                out.append(t)
+        return out
+
+    def walk(node, inside_action):
+        for child in node.findall("node"):
+            m = _BOUNDS.match(child.get("bounds", ""))
+            visible = child.get("visible-to-user", "true") == "true" and child.get("enabled", "true") == "true"
+            bounds = tuple(int(v) for v in m.groups()) if m else (0, 0, 0, 0)
+            if bounds[2] <= bounds[0] or bounds[3] <= bounds[1]:
+                visible = False
+            cls = child.get("class", "")
+            kind = cls.rsplit(".", 1)[-1] or "View"
+            if kind.endswith("Layout"):
+                kind = "Item"  # 可点击的布局一般是列表项 / 卡片
+            clickable = child.get("clickable") == "true" or child.get("long-clickable") == "true"
+            editable = "EditText" in cls
+            scrollable = child.get("scrollable") == "true"
+            checkable = child.get("checkable") == "true"
+            actionable = clickable or editable or scrollable or checkable
+            own = (child.get("text") or child.get("content-desc") or "").strip()
+            if visible and actionable:
+                label = own if (own or scrollable) else " ".join(texts(child))
+                checked = (child.get("checked") == "true") if checkable else None
+                elements.append(UIElement(label[:UI_LABEL_MAX_CHARS], kind, child.get("resource-id", ""), bounds,
+                                          clickable, editable, scrollable, checked))
+            elif visible and own and not inside_action:
+                elements.append(UIElement(own[:UI_LABEL_MAX_CHARS], "Text", child.get("resource-id", ""), bounds,
+                                          False, False, False, None))
+            # 可滚动容器里的条目仍然单独列出；其他可操作控件的子孙只贡献标签
+            walk(child, inside_action or (actionable and not scrollable))
+
+    walk(root, False)
+    elements.sort(key=lambda e: (e.bounds[1], e.bounds[0]))
+    elements = elements[:max_elements]
+    for k, e in enumerate(elements, 1):
+        e.id = k
+    return elements
+
+
+def dump_ui(adb_path, path="/sdcard/gui_agent_ui.xml"):
+    """uiautomator dump 当前界面，返回 XML 文本；界面一直在动（拿不到 idle 状态）等失败时返回 None。"""
+    with metrics.span("adb.uidump") as span:
+        res = _query(adb_path, "uiautomator", "dump", path)
+        if res.returncode != 0 or "ERROR" in res.stdout:
+            span.set(ok=False)
+            return None
+        xml_text = _query(adb_path, "cat", path).stdout
+        span.set(ok="<hierarchy" in xml_text, bytes=len(xml_text))
+    return xml_text if "<hierarchy" in xml_text else None
+
+
+def ui_usable(elements, min_labeled=5, min_ratio=0.6):
+    """控件树是否足够描述这个界面（能只发文字不发截图）：带标签的可点击元素够多、占比够高。"""
+    if not elements:
+        return False
+    clickable = [e for e in elements if e.clickable or e.editable]
+    labeled = [e for e in clickable if e.label]
+    return len(labeled) >= min_labeled and len(labeled) >= min_ratio * len(clickable)
+
+
+class UIIndex:
+    """
+    按屏幕内容缓存解析好的元素列表：同一画面（像素摘要相同）不再重复 dump，一次 dump 要 1-3 秒。
+    最多缓存 max_entries 个画面，按最近使用淘汰。
+    """
+
+    def __init__(self, max_entries=64):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "dumps": 0, "failures": 0}
+
+    @staticmethod
+    def screen_key(frame, stride=2, ignore_top=0.04):
+        """
+        画面的精确摘要：隔 stride 个像素采样（不含顶部状态栏的时钟）后做 blake2b。
+        不能用量化的块哈希：只差一个标签、开关状态或列表挪了几个像素的两屏会撞 key，元素 ID 就对到旧的位置上。
+        """
+        import hashlib
+        import numpy as np
+        top = int(frame.height * ignore_top)
+        sample = np.ascontiguousarray(frame.array()[top::stride, ::stride, :3])
+        digest = hashlib.blake2b(sample.tobytes(), digest_size=16)
+        digest.update(f"{frame.width}x{frame.height}".encode())
+        return digest.digest()
+
+    def get(self, adb_path, frame):
+        key = (adb_path, self.screen_key(frame))
+        with self._lock:
+            elements = self._cache.get(key)
+            if elements is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                metrics.inc("ui_index_total", result="hit")
+                return elements
+        xml_text = dump_ui(adb_path)
+        try:
+            elements = parse_ui_dump(xml_text) if xml_text else None
+        except SyntaxError:  # ElementTree.ParseError：dump 被截断之类
+            elements = None
+        with self._lock:
+            if elements is None:
+                self.stats["failures"] += 1
+                metrics.inc("ui_index_total", result="failure")
+                return None
+            self.stats["dumps"] += 1
+            metrics.inc("ui_index_total", result="dump")
+            self._cache[key] = elements
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return elements
+
+
+ui_index = UIIndex()
+
+
+def probe_ui(adb_path, frame):
+    """在后台线程里取 frame 这个画面的元素列表（可能命中缓存），返回 Future。"""
+    return _submit(ui_index.get, adb_path, frame)
+
+
 def tap(adb_path, x, y):
-    _run(adb_path, "shell", "input", "tap", int(x), int(y))
+    _shell(adb_path, "input", "tap", int(x), int(y))
+    mark_action(adb_path)
+
+
+# input text 能直接发送的字符（与原来逐字发送时相同）；其余（中文、emoji 等）走 ADB Keyboard 广播
+_SAFE_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -.,!?@'°/:;()")
+
+
+def encode_text(text):
+    """
+    把要输入的文本编码成 adb shell 命令序列。
+    连续的安全字符合成一条 input text，连续的复杂字符合成一条广播，换行和 _ 发 ENTER（沿用原来的约定）。
+    """
+    text = text.replace("\\n", "\n").replace("_", "\n")
+    cmds = []
+    for i, line in enumerate(text.split("\n")):
+        if i > 0:
+            cmds.append(("input", "keyevent", "66"))  # ENTER
+        run, run_safe = "", None
+        for char in line + "\0":  # 末尾哨兵，冲掉最后一段
+            # 空格两种方式都能发，跟随当前这段，避免 "中 文" 被拆成三段
+            safe = run_safe if (char == " " and run) else char in _SAFE_CHARS
+            if run and (char == "\0" or safe != run_safe):
+                if run_safe:
+                    cmds.append(("input", "text", run.replace(" ", "%s")))
+                else:
+                    cmds.append(("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", run))
+                run = ""
+            run += char
+            run_safe = safe
+    return cmds
 
 
 def type(adb_path, text):
-    text = text.replace("\\n", "_").replace("\n", "_")
-    for char in text:
-        if char == ' ':
-            _run(adb_path, "shell", "input", "text", "%s")
-        elif char == '_':
-            _run(adb_path, "shell", "input", "keyevent", "66")  # ENTER
-        elif char.isalnum():
-            _run(adb_path, "shell", "input", "text", char)
-        elif char in '-.,!?@\'°/:;()':
-            _run(adb_path, "shell", "input", "text", char)
-        else:
-            # 复杂字符：走广播法（配合 ADB Keyboard）
-            _run(adb_path, "shell", "am", "broadcast",
-                 "-a", "ADB_INPUT_TEXT", "--es", "msg", char)
+    for cmd in encode_text(text):
+        _shell(adb_path, *cmd)
+    mark_action(adb_path)
 
 
 def slide(adb_path, x1, y1, x2, y2):
-    _run(adb_path, "shell", "input", "swipe",
-         int(x1), int(y1), int(x2), int(y2), "500")
+    _shell(adb_path, "input", "swipe",
+           int(x1), int(y1), int(x2), int(y2), "500")
+    mark_action(adb_path)
 
 
 def back(adb_path):
-    _run(adb_path, "shell", "input", "keyevent", "4")
+    _shell(adb_path, "input", "keyevent", "4")
+    mark_action(adb_path)
 
 
 def home(adb_path):
-    _run(adb_path, "shell", "am", "start",
-         "-a", "android.intent.action.MAIN",
-         "-c", "android.intent.category.HOME")
+    _shell(adb_path, "am", "start",
+           "-a", "android.intent.action.MAIN",
+           "-c", "android.intent.category.HOME")
+    mark_action(adb_path)
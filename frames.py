@@ -0,0 +1,108 @@
+# 截图帧管理：动作后的帧直接交给下一步当动作前的帧（中间没有操作设备时），
+# 截图落盘放到后台线程，可选有损压缩格式，按环形缓冲只保留最近的若干张
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+import metrics
+
+# 格式名 -> 文件扩展名
+_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+
+class FrameManager:
+    """
+    一个 Agent 一个。save() 把 Frame 放进队列由后台线程编码写盘（队列满时阻塞，内存有上限）；
+    keep 为保留的最近文件数，超出时删掉最早写的（None 为不限）。
+    fmt 为 PNG / JPEG / WEBP，后两者按 quality 有损压缩，文件小得多、编码也更快。
+    handoff() / take() 在相邻两步之间传递动作后的截图，invalidate() 在操作设备后作废它。
+    """
+
+    def __init__(self, directory, keep=None, fmt="PNG", quality=80, max_age=None, queue_size=8):
+        self.directory = directory
+        self.keep = keep
+        self.fmt = fmt.upper()
+        self.quality = quality
+        self.max_age = max_age  # 交接的帧超过这么多秒就不再复用（None 为不限）
+        self._written = deque()  # 已写盘的文件，按写入顺序
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._handoff = None  # (screen, width, height, 时间)
+        self.stats = {"saved": 0, "deleted": 0, "errors": 0, "reused": 0, "bytes": 0}
+
+    def path(self, name):
+        """name 不带扩展名，按 fmt 补上。"""
+        return os.path.join(self.directory, name + _EXTENSIONS.get(self.fmt, ".png"))
+
+    def save(self, frame, name):
+        """异步保存一帧，返回将要写入的路径。"""
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._writer, name="frame-writer", daemon=True)
+            self._thread.start()
+        path = self.path(name)
+        self._queue.put((frame, path))
+        return path
+
+    def track(self, path):
+        """登记一个已经同步写好的文件（PNG 截屏模式），同样受 keep 限制。"""
+        self._retain(path)
+
+    def _encode_params(self):
+        if self.fmt == "PNG":
+            return {}
+        return {"quality": self.quality}
+
+    def _writer(self):
+        while True:
+            frame, path = self._queue.get()
+            try:
+                with metrics.span("frame_write", fmt=self.fmt) as sp:
+                    data = frame.encode(self.fmt, **self._encode_params())
+                    with open(path, "wb") as f:
+                        f.write(data)
+                    sp.set(bytes=len(data))
+                self.stats["saved"] += 1
+                self.stats["bytes"] += len(data)
+                self._retain(path)
+            except Exception as e:
+                # 写盘失败（磁盘满之类）不影响 agent 本身
+                self.stats["errors"] += 1
+                print(f"Failed to save screenshot {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _retain(self, path):
+        self._written.append(path)
+        while self.keep is not None and len(self._written) > self.keep:
+            old = self._written.popleft()
+            try:
+                os.remove(old)
+                self.stats["deleted"] += 1
+            except OSError:
+                pass
+
+    def flush(self):
+        """等队列里的帧都写完。"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def handoff(self, screen, width, height):
+        """登记动作后的截图，下一步开始时如果期间没有操作过设备就直接复用。"""
+        self._handoff = (screen, width, height, time.time())
+
+    def invalidate(self):
+        self._handoff = None
+
+    def take(self):
+        """取走交接的截图 (screen, width, height)，没有或已过期时返回 None。"""
+        handoff, self._handoff = self._handoff, None
+        if handoff is None:
+            return None
+        if self.max_age is not None and time.time() - handoff[3] > self.max_age:
+            return None
+        self.stats["reused"] += 1
+        metrics.inc("frames_reused_total")
+        return handoff[:3]
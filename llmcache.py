@@ -0,0 +1,104 @@
+# LLM 应答的磁盘缓存：请求都是 temperature 0 + 固定 seed，同样的请求（同一子任务的记忆写入、
+# 重试时的规划、从同一主屏重跑同一指令）直接复用上次的回答。
+# key 为 api.request_fingerprint：模型 + 规范化后的消息，图片按内容哈希，不重新序列化 base64
+import time
+import sqlite3
+import threading
+
+import metrics
+
+
+class ResponseCache:
+    """
+    SQLite（WAL 模式）存储的应答缓存，多个 agent / 进程可以共用一个文件。
+    超过 max_entries 条或 max_bytes 字节时按最近使用时间淘汰；ttl 秒后过期（None 为不过期）。
+    bypass 里的阶段（见 ratelimit.PRIORITY）既不读也不写缓存。
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600,
+                 bypass=(), timeout=30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bypass = set(bypass)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL,"
+            " size INTEGER NOT NULL, elapsed REAL NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "expired": 0, "evicted": 0, "saved": 0.0}
+
+    def close(self):
+        self.conn.close()
+
+    def enabled_for(self, stage):
+        if stage in self.bypass:
+            with self._lock:
+                self.stats["bypassed"] += 1
+            return False
+        return True
+
+    def get(self, key, model, stage=None):
+        """命中时返回缓存的回答并更新使用时间，否则返回 None。"""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT response, elapsed, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[2] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.stats["expired"] += 1
+                row = None
+            if row is None:
+                self.stats["misses"] += 1
+            else:
+                self.conn.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                self.stats["hits"] += 1
+                self.stats["saved"] += row[1]
+        if row is None:
+            metrics.inc("llm_cache_misses_total", model=model, stage=stage or "-")
+            return None
+        metrics.inc("llm_cache_hits_total", model=model, stage=stage or "-")
+        metrics.inc("llm_cache_saved_seconds_total", row[1], model=model)
+        return row[0]
+
+    def put(self, key, model, response, elapsed):
+        """写入一条回答（elapsed 为这次调用的耗时，命中时计入节省的时间），超出上限时淘汰最久未用的。"""
+        now = time.time()
+        size = len(response.encode())
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, elapsed, created, used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", (key, model, response, size, elapsed, now, now))
+            self._evict()
+
+    def _evict(self):
+        count, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY used").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+            evicted += 1
+        self.stats["evicted"] += evicted
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM responses")
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"], stats["bytes"] = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
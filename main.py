@@ -1,16 +1,24 @@
 import os, re
 import time
 import json
+import asyncio
+import threading
 from PIL import Image
-import difflib
-import hashlib
 
 import controller
-from api import call
+import metrics
+import api
+from api import call, async_call
+from ratelimit import RateLimiter
+from llmcache import ResponseCache
+from frames import FrameManager
 
 from controller import get_screenshot, tap, slide, type, back, home
-from prompt import get_decision_prompt, get_reflect_prompt, get_memory_prompt, get_planning_prompt
-from chat import init_decision_chat, init_chat, add_response, add_response_two_image
+from memory import make_skill_key, similarity, SkillIndex, SkillStore, VectorIndex, HashingEncoder
+import prompt
+from prompt import get_decision_prompt, get_reflect_prompt, get_memory_prompt, get_planning_prompt, compact_important_content, PrefixMeter
+import chat
+from chat import init_decision_chat, init_chat, add_response, add_response_two_image, chat_bytes, ImagePipeline
 
 
 # Setting
@@ -22,6 +30,7 @@ adb_path = "D:/Program Files/Netease/MuMuPlayer/nx_main/adb.exe"
 instruction = "open setting, then turn on Dark theme in Display"
 # instruction = "open QQ, then enter '好友动态'"
 # instruction = "Open Maps, search for White House, then get navigation directions from my current location, and start navigation."
+instruction = os.environ.get("GUI_AGENT_INSTRUCTION", instruction)
 
 # important things need Agent to find and remember
 insight = ""
@@ -31,9 +40,122 @@ add_info = ""
 # "If you want to exit an app, use the action \"Home\". "
 # "If the last operation produced no change, do not choose the same coordinates again."
 
-# GPT API URL and token
-api_url = ""
-key = ""
+# 截屏方式：True 时读取 screencap 原始帧，不做设备端 PNG 压缩，宽高直接来自帧头
+raw_screencap = True
+# 是否把每一帧另存到 ./screenshot/（raw 模式下这是唯一需要编码的地方，在后台线程里写）
+save_screenshots = True
+# 落盘格式 PNG / JPEG / WEBP（后两者按 screenshot_quality 有损压缩），只保留最近 screenshot_keep 张（None 为不限）
+screenshot_format = "PNG"
+screenshot_quality = 80
+screenshot_keep = None
+# 动作后的截图直接当下一步动作前的截图（反思后没有再操作设备时），省一次截屏；
+# 超过 frame_reuse_max_age 秒的帧不复用
+reuse_after_frame = True
+frame_reuse_max_age = 30.0
+
+# 截屏守护线程：后台连续截屏并持有最新一帧，截图和等待 UI 稳定都直接取最近一次动作之后的帧，不再按需截屏。
+# capture_source 为 "screencap"（连续原始截屏）或 "screenrecord"（H.264 流本地解码，需要 PyAV）
+capture_daemon = False
+capture_source = "screencap"
+
+# 截屏的同时查软键盘是否弹出（dumpsys input_method，读不到时看截图底部），告诉模型现在能不能 Type；
+# False 时一直认为键盘没有弹出
+keyboard_probe = True
+
+# 界面元素索引：uiautomator dump 出可操作元素（按画面缓存，和规划并行），决策提示词按编号列出，
+# 模型可以输出 Tap element (ID)，执行时点元素中心；ui_text_only 为 True 时控件树够用的界面决策只发文字、不带截图
+ui_elements = False
+ui_text_only = False
+
+# 反思前先在本地比较动作前后的截图：变化像素占比不超过 no_change_ratio 时直接判为 C（没有变化），不调用模型。
+# no_change_pixel_delta 为算作变化的灰度差，顶部 no_change_ignore_top 比例的状态栏不参与比较。
+# 这里是默认值，每个 Agent 可以单独指定（runner 按设备传入）
+local_no_change = True
+no_change_ratio = 0.0002
+no_change_pixel_delta = 24
+no_change_ignore_top = 0.04
+
+# 动作后等待 UI 稳定：连续 settle_stable_frames 帧不变即认为刷新完成
+# settle_adaptive=False 时退回固定等待 settle_max_wait 秒
+settle_adaptive = True
+settle_min_wait = 0.3
+settle_max_wait = 3.0
+settle_stable_frames = 2
+
+# 送给模型的图片：长边上限（None 不缩放）、编码格式与质量、是否灰度
+# 模型输出的坐标基于缩放后的图，执行前换算回设备像素
+image_max_side = 1280
+image_format = "JPEG"
+image_quality = 80
+image_grayscale = False
+chat.pipeline = ImagePipeline(max_side=image_max_side, fmt=image_format, quality=image_quality, grayscale=image_grayscale)
+
+# 反思为 A 后的"写长期记忆"放到后台异步执行，与下一步的截图、规划重叠
+async_memory = True
+
+# 投机执行：反思还在进行时，假设结果为 A，用动作后的截图提前发起下一步的规划
+# speculative_decision=True 时连决策也一起提前做（下一步直接复用动作后的截图和界面元素）
+# 反思结果为 B/C 时丢弃投机结果，走原来的恢复流程；为 A 时也只有提示词和真实的完全一致才复用
+# （A 的反思理由不进提示词；反思改写了 important content、记忆写入改了技能内容时决策会重做，只改计数时照常复用）
+speculative = False
+speculative_decision = False
+
+# 技能记忆存储："sqlite" 为单条记录读写的 SQLite（WAL），首次启动时自动导入旧的 memory_db.json；
+# "json" 为每次整体重写 memory_db.json
+memory_backend = "sqlite"
+
+# 记忆检索后端："lexical" 为 token Jaccard + SequenceMatcher（SkillIndex）；
+# "vector" 为 desc/when_to_use 的向量余弦相似度（VectorIndex，向量缓存在 memory_vectors/）
+memory_retrieval = "lexical"
+retrieval_min_score = 0.35
+# vector 后端的余弦相似度阈值，和词面分数不是一个尺度。benchmark.py vector 的阈值扫描（HashingEncoder）：
+# 0.30~0.35 同义改写命中 10/12、误中 3/132，0.40 命中降到 8/12，0.25 误中变多；取 0.30 离召回下降留余量。换编码器后重新测
+vector_min_score = 0.3
+
+# 提示词布局："legacy" 为原来的顺序；"cache" 把规则/动作空间/输出格式等固定内容放在最前面，
+# 每步变化的内容放在后面，让服务端的 prompt prefix cache 能命中更长的前缀
+prompt_layout = "legacy"
+prompt.PROMPT_LAYOUT = prompt_layout
+# 打印每个阶段与上一次提示词的公共前缀占比
+measure_prefix = False
+prefix_meter = PrefixMeter()
+
+# 追踪与指标：trace_path 给定时把每个 span（LLM 调用、adb 命令、截图、记忆检索/保存等）逐行写成 JSONL，
+# prometheus_port 给定时在该端口提供 Prometheus 文本格式；都为 None 时不采集
+trace_path = None
+prometheus_port = None
+if trace_path or prometheus_port:
+    metrics.configure(trace_path=trace_path, prometheus_port=prometheus_port)
+
+# 客户端限流：按模型填每分钟请求数 / token 数（照账号配额填），预算不够时按 decision > reflection > planning > memory 排队；
+# None 为不限流，只靠 429 后的退避重试。例如 {"gpt-4o": {"rpm": 500, "tpm": 30000}, "gpt-4-turbo": {"rpm": 500, "tpm": 30000}}
+llm_rate_limits = None
+if llm_rate_limits:
+    api.set_limiter(RateLimiter(llm_rate_limits))
+
+# LLM 应答缓存：SQLite 文件路径（None 为关闭），同样的请求（模型 + 消息 + 图片内容都相同）直接复用上次的回答；
+# llm_cache_bypass 里的阶段（decision / reflection / planning / memory）不走缓存
+llm_cache_path = os.environ.get("GUI_AGENT_LLM_CACHE")
+llm_cache_ttl = 7 * 24 * 3600
+llm_cache_bypass = ()
+if llm_cache_path:
+    api.set_cache(ResponseCache(llm_cache_path, ttl=llm_cache_ttl, bypass=llm_cache_bypass))
+
+# GPT API URL and token（环境变量优先，replay 时指向本地的 stub 服务）
+api_url = os.environ.get("GUI_AGENT_API_URL", "")
+key = os.environ.get("GUI_AGENT_API_KEY", "")
+
+
+def prefix_note(stage, text):
+    """measure_prefix 打开时返回 ", shared prefix xx%"，附在每个阶段的耗时后面。"""
+    if not measure_prefix:
+        return ""
+    return f", shared prefix {prefix_meter.observe(stage, text):.0%}"
+
+
+def to_device(x, y, scale):
+    """模型看到的是缩放后的截图，把坐标换算回设备像素。"""
+    return round(int(x) / scale), round(int(y) / scale)
 
 
 def extract_json_obj(text: str) -> dict:
@@ -46,46 +168,25 @@ def extract_json_obj(text: str) -> dict:
     return json.loads(m.group(0))
 
 
-def normalize_text(s: str) -> str:  # 抽取中英文文字
-    s = (s or "").lower()
-    s = re.sub(r"[^a-z0-9\u4e00-\u9fff]+", " ", s)   # 中英数字保留
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-
-def similarity(a: str, b: str) -> float:  # 轻量的匹配，判断单词是否一样，形状是否类似
-    na, nb = normalize_text(a), normalize_text(b)
-    if not na or not nb:
-        return 0.0
-    # token Jaccard + SequenceMatcher 混合
-    A, B = set(na.split()), set(nb.split())
-    jacc = len(A & B) / max(1, len(A | B))
-    seq = difflib.SequenceMatcher(None, na, nb).ratio()
-    return 0.6 * jacc + 0.4 * seq
-
-
-def make_skill_key(app_name: str, canonical_desc: str) -> str:  # 为子任务生成唯一的key，来辨别
-    base = normalize_text(canonical_desc)
-    h = hashlib.md5((app_name + "||" + base).encode("utf-8")).hexdigest()[:10]  # 截断避免太长
-    return f"{base[:50]}__{h}"
-
-
-def retrieved_memory(memory_db, app_name: str, subtask: str, top_k=3, min_score=0.35):
-    # TODO 考虑优化
+def retrieved_memory(memory_db, app_name: str, subtask: str, top_k=3, min_score=0.35, index=None):
     # 从记忆中匹配，按照相似度得分计算top k
-    app_mem = memory_db.get(app_name, {}) if app_name else {}
-    candidates = []
+    # 传入 index（memory.SkillIndex）时走索引，结果与逐条计算一致
+    if index is not None:
+        selected = index.search(app_name, subtask, top_k=top_k, min_score=min_score)
+    else:
+        app_mem = memory_db.get(app_name, {}) if app_name else {}
+        candidates = []
 
-    for skill_key, rec in app_mem.items():
-        if rec.get("disabled", False):
-            continue
-        desc = rec.get("desc", "") or ""
-        score = similarity(subtask, desc)
-        if score >= min_score:
-            candidates.append((float(score), str(skill_key), rec))
+        for skill_key, rec in app_mem.items():
+            if rec.get("disabled", False):
+                continue
+            desc = rec.get("desc", "") or ""
+            score = similarity(subtask, desc)
+            if score >= min_score:
+                candidates.append((float(score), str(skill_key), rec))
 
-    candidates.sort(key=lambda x: x[0], reverse=True)
-    selected = candidates[:max(0, int(top_k))] if top_k is not None else candidates
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        selected = candidates[:max(0, int(top_k))] if top_k is not None else candidates
 
     items = []
     for score, skill_key, rec in selected:
@@ -116,10 +217,23 @@ def retrieved_memory(memory_db, app_name: str, subtask: str, top_k=3, min_score=
     return payload, best_skill_key
 
 
-def upsert_skill_success(app_name, subtask, hint_json_text):
+def retrieval_threshold():
+    """当前检索后端的相似度阈值。"""
+    return vector_min_score if memory_retrieval == "vector" else retrieval_min_score
+
+
+def stable_memory_json(payload):
+    """检索结果去掉 stats/updated_at（每次反思为 A 都会被记忆写入改掉）后的 JSON，用来判断投机决策能否复用。"""
+    def strip(item):
+        return {k: v for k, v in item.items() if k not in ("stats", "updated_at")} if item else item
+    return json.dumps(dict(payload, top=strip(payload["top"]), items=[strip(i) for i in payload["items"]]), ensure_ascii=False)
+
+
+def upsert_skill_success(app_name, subtask, hint_json_text, best_skill_key):
     memory_db.setdefault(app_name, {})
     # 如果本轮已有匹配 skill，就更新那个；否则新建
     if best_skill_key and best_skill_key in memory_db[app_name]:
+        best = best_skill_key
         rec = memory_db[app_name][best_skill_key]
     else:
         skill_key = make_skill_key(app_name, subtask)
@@ -153,24 +267,60 @@ def upsert_skill_success(app_name, subtask, hint_json_text):
         rec["hint"] = hint
     if avoid:
         rec["avoid"] = avoid
-    rec["stats"]["success"] = rec.get("stats", {}).get("success", 0) + 1
     rec["updated_at"] = time.time()
     rec.pop("_key", None)
+    skill_index.upsert(app_name, best, rec)
+    if memory_store is not None:
+        memory_store.put(app_name, best, rec)
+        stats = memory_store.incr(app_name, best, "success")
+        if stats is None:
+            # put 之后被别的进程删掉了：重新写一遍，这次的成功照样计入
+            rec["stats"] = {"success": 0, "fail": 0}
+            memory_store.import_db({app_name: {best: rec}})
+            stats = memory_store.incr(app_name, best, "success")
+        rec["stats"] = stats
+    else:
+        rec["stats"]["success"] = rec.get("stats", {}).get("success", 0) + 1
 
 
-def punish_skill_failure(app_name):
+def punish_skill_failure(app_name, best_skill_key, used_memory):
     # 本轮使用了了 memory skill；有明确的 best_skill_key； skill 仍然存在 时惩罚
     if not (used_memory and best_skill_key and app_name in memory_db and best_skill_key in memory_db[app_name]):
         return
     rec = memory_db[app_name][best_skill_key]
-    rec["stats"]["fail"] = rec.get("stats", {}).get("fail", 0) + 1
+    if memory_store is not None:
+        stats = memory_store.incr(app_name, best_skill_key, "fail")
+        if stats is None:
+            # 别的进程已经删掉了这条 skill，本地也跟着删
+            del memory_db[app_name][best_skill_key]
+            skill_index.remove(app_name, best_skill_key)
+            return
+        rec["stats"] = stats
+    else:
+        rec["stats"]["fail"] = rec.get("stats", {}).get("fail", 0) + 1
     rec["updated_at"] = time.time()
 
     # 先禁用再删除
     if rec["stats"]["fail"] >= 2:
         rec["disabled"] = True
+        if memory_store is not None:
+            memory_store.disable(app_name, best_skill_key)
     if rec["stats"]["fail"] >= 4:
         del memory_db[app_name][best_skill_key]
+        skill_index.remove(app_name, best_skill_key)
+        if memory_store is not None:
+            memory_store.delete(app_name, best_skill_key)
+
+
+def refresh_memory():
+    """其他进程改过技能库时重新读入 memory_db 并重建检索索引；调用方持有 memory_lock。"""
+    if memory_store is None or not memory_store.changed():
+        return False
+    memory_db.clear()
+    memory_db.update(memory_store.load())
+    skill_index.rebuild(memory_db)
+    metrics.inc("memory_reload_total")
+    return True
 
 
 def load_memory_db(path):
@@ -187,200 +337,579 @@ def save_memory_db(path, memory_db):
     os.replace(tmp, path)
 
 
-operation_history = []
-action_history = []
-important_content = ""
+def save_memory():
+    """每次反思后落盘：SQLite 已按单条记录写入，只有 json 后端需要整体重写。"""
+    if memory_store is None:
+        save_memory_db(MEMORY_PATH, memory_db)
 
-operation = ""
-action = ""
-keyboard = False
 
-planning_json = None
-completed = ""
+# 技能记忆：所有 Agent 共用一份（memory_lock 保护），open_memory() 之后可用
+MEMORY_PATH = "./memory_db.json"
+MEMORY_STORE_PATH = "./memory_db.sqlite"
+memory_store = None
+memory_db = {}
+skill_index = None
+
+
+def open_memory():
+    """按 memory_backend / memory_retrieval 打开技能记忆和检索索引。"""
+    global memory_store, memory_db, skill_index
+    if memory_backend == "sqlite":
+        memory_store = SkillStore(MEMORY_STORE_PATH)
+        migrated = memory_store.migrate_json(MEMORY_PATH)
+        if migrated:
+            print(f"[Memory] migrated {migrated} skills from {MEMORY_PATH} to {MEMORY_STORE_PATH}")
+        memory_db = memory_store.load()
+    else:
+        memory_store = None
+        memory_db = load_memory_db(MEMORY_PATH)
+    if memory_retrieval == "vector":
+        skill_index = VectorIndex(HashingEncoder(), cache_dir="./memory_vectors", memory_db=memory_db)
+        skill_index.flush()
+    else:
+        skill_index = SkillIndex(memory_db)
 
-last_reflect_label = ""     # A / B / C
-last_reflect_thought = ""    # optional short text
-error = False
 
-MEMORY_PATH = "./memory_db.json"
-memory_db = load_memory_db(MEMORY_PATH)
-if not os.path.exists("screenshot"):
-    os.mkdir("screenshot")
-
-i = 0
-all_start = time.time()
-while True:
-    step_start = time.time()
-    i += 1
-    print("\n\n\n*** Step:", i, "***")
-    # 获取截图
-    screenshot_file = f"./screenshot/before_step_{i}.png"
-    get_screenshot(adb_path, screenshot_file)
-    width, height = Image.open(screenshot_file).size
-
-    # 规划 planning
-    start = time.time()
-    # TODO：增加全局记忆到planning中
-    prompt_planning = get_planning_prompt(
-        instruction=instruction,
-        planning_json=planning_json,
-        operation_history=operation_history,
-        action_history=action_history,
-        completed_summary=completed,
-        last_reflect_label=last_reflect_label,
-        last_reflect_reason=last_reflect_thought,
-    )
-    chat_planning = init_chat()
-    chat_planning = add_response("user", prompt_planning, chat_planning)
-    output_planning = call(chat_planning, "gpt-4-turbo", api_url, key)
-    chat_planning = add_response("assistant", output_planning, chat_planning)
-
-    planning_json = extract_json_obj(output_planning)  # 提取集合json
-    completed = planning_json["progress"].get("completed_summary", completed)
-    completed_ids = planning_json["progress"].get("completed_ids")
-    current_app_name = planning_json["progress"].get("current_app_name", "")
-    current_subtask = planning_json["progress"].get("current_subtask", "")
-
-    if len(completed_ids) == len(planning_json["subtasks"]):  # 结束判断
-        print("[Planner] No remaining subtask. Stopping.")
-        all_end = time.time()
-        print("\n" + "=" * 110)
-        print(f"All operations use time: {all_end - all_start:.1f} s")
-        break
-
-    end = time.time()
-    print("\n" + "=" * 50 + " Planning " + "=" * 50)
-    print(f"Planning uses time: {end - start:.1f} s\n")
-    print(planning_json)  # 打印计划字典
-
-    # TODO 优化记忆命中代码
-    memory_payload, best_skill_key = retrieved_memory(memory_db, current_app_name, current_subtask, top_k=3, min_score=0.35)
-    retrieved_memory_json = json.dumps(memory_payload, ensure_ascii=False)
-    used_memory = len(memory_payload) > 0
-
-    # 决策 Decision #################################
-    start = time.time()
-    prompt_decision = get_decision_prompt(
-        instruction=instruction, width=width, height=height,
-        keyboard=keyboard,
-        operation_history=operation_history, action_history=action_history,
-        last_operation=operation, last_action=action,
-        add_info=add_info,
-        last_reflect_label=last_reflect_label, last_reflect_reason=last_reflect_thought,
-        error=error,
-        completed=completed,
-        current_app_name=current_app_name,  # 来自 planning
-        current_subtask=current_subtask,  # 来自 planning
-        important_content=important_content,
-        retrieved_memory=retrieved_memory_json,  # 检索到的记忆
-    )
-
-    chat_decision = init_decision_chat()
-    chat_decision = add_response("user", prompt_decision, chat_decision, screenshot_file)
-    output_decision = call(chat_decision, "gpt-4o", api_url, key)
-    chat_decision = add_response("assistant", output_decision, chat_decision)
-
-    end = time.time()
-    print("\n" + "=" * 50 + " Decision " + "=" * 50)
-    print(f"Decision uses time: {end - start:.1f} s\n")
-    print(output_decision)
-
-    thought = output_decision.split("### Thought ###")[-1].split("### Action ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
-    action = output_decision.split("### Action ###")[-1].split("### Description ###")[0].replace("\n", " ").replace("  ", " ").strip()
-    operation = output_decision.split("### Description ###")[-1].replace("\n", " ").replace("  ", " ").strip()
-
-    # 执行 Executor #####################################################
-    if "Open app" in action:
-        coordinate = action.split("(")[-1].split(")")[0].split(", ")
-        x, y = int(coordinate[0]), int(coordinate[1])
-        tap(adb_path, x, y)
-    
-    elif "Tap" in action:
-        coordinate = action.split("(")[-1].split(")")[0].split(", ")
-        x, y = int(coordinate[0]), int(coordinate[1])
-        tap(adb_path, x, y)
-    
-    elif "Swipe" in action:
-        coordinate1 = action.split("Swipe (")[-1].split("), (")[0].split(", ")
-        coordinate2 = action.split("), (")[-1].split(")")[0].split(", ")
-        x1, y1 = int(coordinate1[0]), int(coordinate1[1])
-        x2, y2 = int(coordinate2[0]), int(coordinate2[1])
-        slide(adb_path, x1, y1, x2, y2)
-        
-    elif "Type" in action:
-        if "(text)" not in action:
-            text = action.split("(")[-1].split(")")[0]
-        else:
-            text = action.split(" \"")[-1].split("\"")[0]
-        type(adb_path, text)
-    
-    elif "Back" in action:
-        back(adb_path)
-    
-    elif "Home" in action:
-        home(adb_path)
-
-    # todo：增加ui刷新的判断
-    time.sleep(3)  # 等待设备ui刷新
-
-    # 新截图用于反思
-    last_screenshot_file = screenshot_file
-    last_keyboard = keyboard
-    screenshot_file = f"./screenshot/after_step_{i}.png"
-    get_screenshot(adb_path, screenshot_file)
-    width, height = Image.open(screenshot_file).size
-
-    # TODO：判断操作后的键盘状态
-    keyboard = False
-
-    # 反思 reflection
-    start = time.time()
-    prompt_reflect = get_reflect_prompt(instruction, width, height, last_keyboard, keyboard, operation, action, add_info, important_content=important_content, current_app_name=current_app_name, current_subtask=current_subtask)
-    chat_reflect = init_chat()
-    chat_reflect = add_response_two_image("user", prompt_reflect, chat_reflect, [last_screenshot_file, screenshot_file])
-    output_reflect = call(chat_reflect, 'gpt-4o', api_url, key)
-    chat_reflect = add_response("assistant", output_reflect, chat_reflect)
-    end = time.time()
-
-    print("\n"+"=" * 50 + " Reflection " + "=" * 48)
-    print(f"Reflection uses time: {end-start:.1f} s\n")
-    print(output_reflect)  # thought
-
-    last_reflect_thought = output_reflect.split("### Thought ###")[-1].split("### Answer ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
-    answer = output_reflect.split("### Answer ###")[-1].split("### Important content ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
-    important_content = output_reflect.split("### Important content ###")[-1].replace("\n", " ").strip()
-
-    if 'A' in answer:
-        last_reflect_label = 'A'
-        operation_history.append(operation)
-        action_history.append(action)
-        error = False
-
-        # 生成/刷新“长期技能记忆”
-        prompt_memory = get_memory_prompt(instruction, current_app_name, current_subtask, last_reflect_thought, operation, action)
-        chat_memory = init_chat()
-        chat_memory = add_response("user", prompt_memory, chat_memory)
-        output_memory = call(chat_memory, "gpt-4o", api_url, key)
-        chat_memory = add_response("assistant", output_memory, chat_memory)
+# 后台事件循环：跑不阻塞下一步的异步任务（写记忆 + 保存）
+bg_loop = asyncio.new_event_loop()
+threading.Thread(target=bg_loop.run_forever, daemon=True).start()
 
-        upsert_skill_success(current_app_name, current_subtask, output_memory)
-        save_memory_db(MEMORY_PATH, memory_db)
 
-    elif 'B' in answer:
-        last_reflect_label = 'B'
-        error = True
-        controller.back(adb_path)
+# memory_db 会被主线程和后台任务同时读写
+memory_lock = threading.Lock()
 
-        punish_skill_failure(current_app_name)
-        save_memory_db(MEMORY_PATH, memory_db)
 
-    elif 'C' in answer:
-        last_reflect_label = 'C'
-        error = True
+class Agent:
+    """
+    一次任务（episode）的全部状态和步骤循环：历史、计划、键盘状态、反思结果、投机执行。
+    多个 Agent 可以在不同线程里驱动不同设备（adb_path 用 controller.device() 指定序列号），
+    共用 LLM 客户端、技能记忆和后台事件循环。
+    """
 
-        punish_skill_failure(current_app_name)
-        save_memory_db(MEMORY_PATH, memory_db)
+    def __init__(self, instruction, adb_path, name="", screenshot_dir="./screenshot", no_change=None):
+        self.instruction = instruction
+        self.adb_path = adb_path
+        self.name = name  # 多设备时作为日志前缀
+        self.screenshot_dir = screenshot_dir
+        # 本地无变化判定的设置：enabled / ratio / pixel_delta / ignore_top，no_change 里给出的项覆盖模块级默认值
+        self.no_change = {"enabled": local_no_change, "ratio": no_change_ratio, "pixel_delta": no_change_pixel_delta,
+                          "ignore_top": no_change_ignore_top, **(no_change or {})}
+        self.frames = FrameManager(screenshot_dir, keep=screenshot_keep, fmt=screenshot_format,
+                                   quality=screenshot_quality, max_age=frame_reuse_max_age)
+
+        self.operation_history = []
+        self.action_history = []
+        self.important_content = ""
+
+        self.operation = ""
+        self.action = ""
+        self.keyboard = False
+
+        self.planning_json = None
+        self.completed = ""
+
+        self.last_reflect_label = ""     # A / B / C
+        self.last_reflect_thought = ""    # optional short text
+        self.error = False
+
+        self.elements = {}  # 本步决策提示词里的元素：ID -> controller.UIElement
+        self.last_diff = None  # 上一个动作前后截图的差异（controller.FrameDiff），变化区域供其他阶段参考
+        self.pending_memory = None
+        self.spec_next = None  # 上一步发起的投机执行
+        # 投机执行的统计：命中率与节省的时间
+        self.spec_stats = {"started": 0, "hits": 0, "decision_hits": 0, "saved": 0.0}
+        self.steps = 0
+
+    def log(self, *args):
+        if self.name:
+            print(f"[{self.name}]", *args)
+        else:
+            print(*args)
+
+    def capture_screen(self, name, frame=None):
+        """
+        截屏，返回 (image, width, height)。image 可直接交给 chat.add_response：
+        raw 模式下是内存中的 Frame（由 self.frames 在后台落盘到 name），否则是 PNG 文件路径。
+        已经拿到的帧（比如等待 UI 稳定时的最后一帧）可以通过 frame 传入，省一次截屏。
+        """
+        if raw_screencap:
+            frame = frame or controller.get_frame(self.adb_path)
+            if save_screenshots:
+                self.frames.save(frame, name)
+            return frame, frame.width, frame.height
+        save_path = os.path.join(self.screenshot_dir, name + ".png")
+        get_screenshot(self.adb_path, save_path)
+        self.frames.track(save_path)
+        width, height = Image.open(save_path).size
+        return save_path, width, height
+
+    async def write_memory(self, app_name, subtask, reflect_thought, operation, action, skill_key):
+        sp = metrics.span("memory_write", app=app_name)
+        prompt_memory = get_memory_prompt(self.instruction, app_name, subtask, reflect_thought, operation, action)
+        chat_memory = init_chat()
+        chat_memory = add_response("user", prompt_memory, chat_memory)
+        metrics.record_bytes("memory", chat_bytes(chat_memory))
+        output_memory = await async_call(chat_memory, "gpt-4o", api_url, key, priority="memory")
+        chat_memory = add_response("assistant", output_memory, chat_memory)
 
-    step_end = time.time()
-    print("\n"+"=" * 110)
-    print(f"This iteration uses time: {step_end-step_start:.1f} s")
+        def persist():
+            with memory_lock, metrics.span("persist"):
+                upsert_skill_success(app_name, subtask, output_memory, skill_key)
+                save_memory()
+        await asyncio.to_thread(persist)
+        sp.end()
+
+    def wait_memory(self):
+        """等后台的记忆写入完成；读写 memory_db 之前必须先调用。"""
+        if self.pending_memory is None:
+            return
+        start = time.time()
+        try:
+            self.pending_memory.result()
+        except Exception as e:
+            self.log(f"[Memory] write failed: {e}")
+        self.pending_memory = None
+        self.log(f"[Memory] waited {time.time() - start:.1f} s for background write")
+
+    async def speculate(self, chat_planning, decision_kwargs, screenshot, scale, ui_probe, completed):
+        """
+        假设本步反思为 A，提前跑下一步的规划；decision_kwargs 不为 None 时接着跑决策。
+        返回各阶段的输出与耗时，由主循环在确认命中后取用。
+        """
+        start = time.time()
+        result = {"planning": await async_call(chat_planning, "gpt-4-turbo", api_url, key, priority="planning")}
+        result["planning_time"] = time.time() - start
+        if decision_kwargs is None:
+            return result
+
+        plan = extract_json_obj(result["planning"])
+        progress = plan["progress"]
+        if len(progress.get("completed_ids")) == len(plan["subtasks"]):  # 下一步就结束，不需要决策
+            return result
+        app_name = progress.get("current_app_name", "")
+        subtask = progress.get("current_subtask", "")
+        with memory_lock:
+            payload, _ = retrieved_memory(memory_db, app_name, subtask, top_k=3, min_score=retrieval_threshold(), index=skill_index)
+        result["retrieved_memory"] = json.dumps(payload, ensure_ascii=False)
+        result["stable_memory"] = stable_memory_json(payload)
+        # 界面元素和主循环一样取（同一画面命中 ui_index 缓存，编号也一致）
+        elements = None
+        if ui_probe is not None:
+            try:
+                elements = await asyncio.wait_for(asyncio.wrap_future(ui_probe), 10)
+            except Exception:
+                pass
+        text_only = ui_text_only and controller.ui_usable(elements)
+        decision_kwargs = dict(
+            decision_kwargs,
+            completed=progress.get("completed_summary", completed),
+            current_app_name=app_name, current_subtask=subtask,
+            ui_elements="\n".join(e.describe(scale) for e in elements) if elements else None,
+            text_only=text_only,
+        )
+        prompt_decision = get_decision_prompt(**decision_kwargs, retrieved_memory=result["retrieved_memory"])
+        chat_decision = init_decision_chat()
+        chat_decision = add_response("user", prompt_decision, chat_decision, None if text_only else screenshot)
+        result["decision"] = await async_call(chat_decision, "gpt-4o", api_url, key, priority="decision")
+        result["decision_key"] = get_decision_prompt(**decision_kwargs, retrieved_memory=result["stable_memory"])
+        result["text_only"] = text_only
+        result["chat_decision"] = chat_decision
+        result["decision_time"] = time.time() - start - result["planning_time"]
+        return result
+
+    def start_speculation(self, screenshot, size, img_size):
+        """用动作后的状态构造下一步的规划（和决策）请求，提交到后台事件循环。"""
+        prompt_planning = get_planning_prompt(
+            instruction=self.instruction,
+            planning_json=self.planning_json,
+            operation_history=self.operation_history + [self.operation],
+            action_history=self.action_history + [self.action],
+            completed_summary=self.completed,
+            last_reflect_label="A",
+            last_reflect_reason="",
+        )
+        chat_planning = add_response("user", prompt_planning, init_chat())
+        decision_kwargs, ui_probe = None, None
+        if speculative_decision:
+            decision_kwargs = dict(
+                instruction=self.instruction, width=img_size[0], height=img_size[1],
+                keyboard=self.keyboard,
+                operation_history=self.operation_history + [self.operation],
+                action_history=self.action_history + [self.action],
+                last_operation=self.operation, last_action=self.action,
+                add_info=add_info,
+                last_reflect_label="A", last_reflect_reason="",
+                error=False,
+                important_content=self.important_content,
+            )
+            if ui_elements and isinstance(screenshot, controller.Frame):
+                ui_probe = controller.probe_ui(self.adb_path, screenshot)
+        self.spec_stats["started"] += 1
+        job = self.speculate(chat_planning, decision_kwargs, screenshot, chat.pipeline.scale(*size), ui_probe, self.completed)
+        return {
+            "future": asyncio.run_coroutine_threadsafe(job, bg_loop),
+            "prompt_planning": prompt_planning,
+            "chat_planning": chat_planning,
+            "with_decision": decision_kwargs is not None,
+            "screenshot": screenshot, "size": size,
+        }
+
+    def take_speculation(self, spec):
+        """反思确认为 A 后取投机结果；投机失败时返回 None，走正常流程。"""
+        start = time.time()
+        try:
+            result = spec["future"].result()
+        except Exception as e:
+            self.log(f"[Speculation] failed: {e}")
+            return None
+        result["waited"] = time.time() - start
+        self.spec_stats["hits"] += 1
+        return result
+
+    def credit_speculation(self, spec, decision_used):
+        """记下投机省掉的时间：规划总是用上了，决策只有真正复用时才算。"""
+        saved = spec["planning_time"] + (spec.get("decision_time", 0.0) if decision_used else 0.0) - spec["waited"]
+        self.spec_stats["saved"] += max(0.0, saved)
+
+    def compare_screens(self, before, after):
+        """动作前后截图的本地差异；关掉本地判定时返回 None。"""
+        if not self.no_change["enabled"]:
+            return None
+        with metrics.span("diff") as sp:
+            diff = controller.frame_diff(before, after, pixel_delta=self.no_change["pixel_delta"],
+                                         ignore_top=self.no_change["ignore_top"])
+            sp.set(ratio=round(diff.ratio, 6), boxes=len(diff.boxes))
+        return diff
+
+    def resolve_elements(self, ui_probe):
+        """取后台 dump 的界面元素列表，失败或没开时返回 None；同时记下 ID -> 元素供执行时查找。"""
+        elements = None
+        if ui_probe is not None:
+            try:
+                elements = ui_probe.result(timeout=10)
+            except Exception as e:
+                self.log(f"[UI] element dump failed: {e}")
+        self.elements = {e.id: e for e in elements or []}
+        return elements
+
+    def execute(self, action, scale):
+        """把模型输出的动作翻译成 adb 命令。"""
+        self.frames.invalidate()
+        adb_path = self.adb_path
+        if "Open app" in action:
+            coordinate = action.split("(")[-1].split(")")[0].split(", ")
+            x, y = to_device(coordinate[0], coordinate[1], scale)
+            tap(adb_path, x, y)
+
+        elif "Tap element" in action:
+            # 按元素编号点中心（设备坐标，不用再缩放）
+            match = re.search(r"Tap element \(?\s*(\d+)", action)
+            element = self.elements.get(int(match.group(1))) if match else None
+            if element is None:
+                self.log(f"[UI] unknown element in action: {action}")
+                return
+            tap(adb_path, *element.center)
+
+        elif "Tap" in action:
+            coordinate = action.split("(")[-1].split(")")[0].split(", ")
+            x, y = to_device(coordinate[0], coordinate[1], scale)
+            tap(adb_path, x, y)
+
+        elif "Swipe" in action:
+            coordinate1 = action.split("Swipe (")[-1].split("), (")[0].split(", ")
+            coordinate2 = action.split("), (")[-1].split(")")[0].split(", ")
+            x1, y1 = to_device(coordinate1[0], coordinate1[1], scale)
+            x2, y2 = to_device(coordinate2[0], coordinate2[1], scale)
+            slide(adb_path, x1, y1, x2, y2)
+
+        elif "Type" in action:
+            if "(text)" not in action:
+                text = action.split("(")[-1].split(")")[0]
+            else:
+                text = action.split(" \"")[-1].split("\"")[0]
+            type(adb_path, text)
+
+        elif "Back" in action:
+            back(adb_path)
+
+        elif "Home" in action:
+            home(adb_path)
+
+    def run(self, max_steps=None):
+        """跑到规划器判定完成（或达到 max_steps），返回本次任务的概要。"""
+        os.makedirs(self.screenshot_dir, exist_ok=True)
+        if capture_daemon:
+            source = controller.ScreenrecordSource(self.adb_path) if capture_source == "screenrecord" else None
+            controller.start_capture(self.adb_path, source)
+        all_start = time.time()
+        done = False
+        while not done and (max_steps is None or self.steps < max_steps):
+            done = self.step()
+        all_end = time.time()
+        self.log("\n" + "=" * 110)
+        self.log(f"All operations use time: {all_end - all_start:.1f} s")
+        if self.spec_stats["started"]:
+            self.log(f"Speculation: {self.spec_stats['hits']}/{self.spec_stats['started']} hits, "
+                     f"{self.spec_stats['decision_hits']} decision hits, saved {self.spec_stats['saved']:.1f} s")
+        self.wait_memory()
+        self.frames.flush()
+        if self.spec_next is not None:
+            self.spec_next["future"].cancel()
+            self.spec_next = None
+        return {"instruction": self.instruction, "device": self.name, "completed": done,
+                "steps": self.steps, "time": all_end - all_start}
+
+    def step(self):
+        """执行一步：截图 -> 规划 -> 检索 -> 决策 -> 执行 -> 反思。规划器判定任务完成时返回 True。"""
+        step_start = time.time()
+        self.steps += 1
+        i = self.steps
+        spec_next = self.spec_next
+        step_span = metrics.span("step", step=i, device=self.name)
+        self.log("\n\n\n*** Step:", i, "***")
+        # 获取截图：上一步动作后的截图之后没有再操作设备时直接复用（投机决策也基于这张）
+        reused = self.frames.take() if reuse_after_frame else None
+        if spec_next is not None and spec_next["with_decision"]:
+            screenshot, (width, height) = spec_next["screenshot"], spec_next["size"]
+        elif reused is not None:
+            screenshot, width, height = reused
+        else:
+            probe = controller.probe_keyboard(self.adb_path) if keyboard_probe else None
+            with metrics.span("screenshot"):
+                screenshot, width, height = self.capture_screen(f"before_step_{i}")
+            self.keyboard = controller.keyboard_state(probe, screenshot) if keyboard_probe else False
+        scale = chat.pipeline.scale(width, height)
+        img_width, img_height = chat.pipeline.scaled_size(width, height)
+        # 界面元素在后台 dump，和规划并行
+        ui_probe = None
+        if ui_elements and isinstance(screenshot, controller.Frame):
+            ui_probe = controller.probe_ui(self.adb_path, screenshot)
+
+        # 规划 planning
+        start = time.time()
+        # TODO：增加全局记忆到planning中
+        prompt_planning = get_planning_prompt(
+            instruction=self.instruction,
+            planning_json=self.planning_json,
+            operation_history=self.operation_history,
+            action_history=self.action_history,
+            completed_summary=self.completed,
+            last_reflect_label=self.last_reflect_label,
+            last_reflect_reason=self.last_reflect_thought,
+        )
+        if spec_next is not None and spec_next["prompt_planning"] != prompt_planning:
+            self.log("[Speculation] planning prompt changed, discarded")
+            spec_next["future"].cancel()
+            spec_next = None
+        spec = self.take_speculation(spec_next) if spec_next is not None else None
+        if spec is not None:
+            chat_planning = spec_next["chat_planning"]
+            output_planning = spec["planning"]
+        else:
+            chat_planning = init_chat()
+            chat_planning = add_response("user", prompt_planning, chat_planning)
+            metrics.record_bytes("planning", chat_bytes(chat_planning))
+            with metrics.span("planning"):
+                output_planning = call(chat_planning, "gpt-4-turbo", api_url, key, priority="planning")
+        chat_planning = add_response("assistant", output_planning, chat_planning)
+
+        self.planning_json = planning_json = extract_json_obj(output_planning)  # 提取集合json
+        self.completed = planning_json["progress"].get("completed_summary", self.completed)
+        completed_ids = planning_json["progress"].get("completed_ids")
+        current_app_name = planning_json["progress"].get("current_app_name", "")
+        current_subtask = planning_json["progress"].get("current_subtask", "")
+
+        if len(completed_ids) == len(planning_json["subtasks"]):  # 结束判断
+            if spec is not None:
+                self.credit_speculation(spec, decision_used=False)
+            self.log("[Planner] No remaining subtask. Stopping.")
+            self.spec_next = None
+            step_span.end()
+            return True
+
+        end = time.time()
+        self.log("\n" + "=" * 50 + " Planning " + "=" * 50)
+        self.log(f"Planning uses time: {end - start:.1f} s, request {chat_bytes(chat_planning) / 1024:.0f} KB{prefix_note('planning', prompt_planning)}\n")
+        self.log(planning_json)  # 打印计划字典
+
+        # 记忆检索：走 SkillIndex，先等后台记忆写入完成
+        self.wait_memory()
+        with memory_lock, metrics.span("retrieval", app=current_app_name) as sp:
+            if refresh_memory():
+                self.log("[Memory] reloaded: skill store changed by another process")
+            memory_payload, best_skill_key = retrieved_memory(memory_db, current_app_name, current_subtask, top_k=3, min_score=retrieval_threshold(), index=skill_index)
+            sp.set(hits=len(memory_payload["items"]))
+        retrieved_memory_json = json.dumps(memory_payload, ensure_ascii=False)
+        used_memory = len(memory_payload) > 0
+
+        # 决策 Decision #################################
+        start = time.time()
+        elements = self.resolve_elements(ui_probe)
+        ui_text = "\n".join(e.describe(scale) for e in elements) if elements else None
+        text_only = ui_text_only and controller.ui_usable(elements)
+        decision_kwargs = dict(
+            instruction=self.instruction, width=img_width, height=img_height,
+            keyboard=self.keyboard,
+            operation_history=self.operation_history, action_history=self.action_history,
+            last_operation=self.operation, last_action=self.action,
+            add_info=add_info,
+            last_reflect_label=self.last_reflect_label, last_reflect_reason=self.last_reflect_thought,
+            error=self.error,
+            completed=self.completed,
+            current_app_name=current_app_name,  # 来自 planning
+            current_subtask=current_subtask,  # 来自 planning
+            important_content=self.important_content,
+            ui_elements=ui_text, text_only=text_only,
+        )
+        prompt_decision = get_decision_prompt(**decision_kwargs, retrieved_memory=retrieved_memory_json)  # 检索到的记忆
+
+        # 投机决策只有在提示词相同（important content、界面元素、检索到的技能等都没变）且同样附截图时才能用；
+        # 唯一放宽的是技能的 stats/updated_at：投机时看到的是本步记忆写入之前的计数
+        decision_hit = (spec is not None and "decision" in spec and spec["text_only"] == text_only
+                        and spec["decision_key"] == get_decision_prompt(**decision_kwargs, retrieved_memory=stable_memory_json(memory_payload)))
+        if spec is not None:
+            self.credit_speculation(spec, decision_used=decision_hit)
+        if decision_hit:
+            self.spec_stats["decision_hits"] += 1
+            chat_decision = spec["chat_decision"]
+            output_decision = spec["decision"]
+        else:
+            chat_decision = init_decision_chat()
+            chat_decision = add_response("user", prompt_decision, chat_decision, None if text_only else screenshot)
+            metrics.record_bytes("decision", chat_bytes(chat_decision))
+            with metrics.span("decision", text_only=text_only):
+                output_decision = call(chat_decision, "gpt-4o", api_url, key, priority="decision")
+        chat_decision = add_response("assistant", output_decision, chat_decision)
+        self.spec_next = None
+
+        end = time.time()
+        self.log("\n" + "=" * 50 + " Decision " + "=" * 50)
+        self.log(f"Decision uses time: {end - start:.1f} s, request {chat_bytes(chat_decision) / 1024:.0f} KB"
+                 f"{', text only' if text_only else ''}{prefix_note('decision', prompt_decision)}\n")
+        self.log(output_decision)
+
+        thought = output_decision.split("### Thought ###")[-1].split("### Action ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
+        action = output_decision.split("### Action ###")[-1].split("### Description ###")[0].replace("\n", " ").replace("  ", " ").strip()
+        operation = output_decision.split("### Description ###")[-1].replace("\n", " ").replace("  ", " ").strip()
+        self.action, self.operation = action, operation
+
+        # 执行 Executor #####################################################
+        with metrics.span("execute", action=action):
+            self.execute(action, scale)
+
+        # 等待设备ui刷新
+        settled_frame = None
+        if settle_adaptive:
+            settle_wait, settled_frame = controller.wait_for_settle(
+                self.adb_path, min_wait=settle_min_wait, max_wait=settle_max_wait, stable_frames=settle_stable_frames)
+        else:
+            settle_wait = settle_max_wait
+            time.sleep(settle_max_wait)
+        metrics.record("settle", settle_wait)
+        self.log(f"UI settle wait: {settle_wait:.2f} s")
+
+        # 新截图用于反思
+        last_screenshot = screenshot
+        last_keyboard = self.keyboard
+        probe = controller.probe_keyboard(self.adb_path) if keyboard_probe else None
+        with metrics.span("screenshot"):
+            screenshot, width, height = self.capture_screen(f"after_step_{i}", settled_frame)
+        self.frames.handoff(screenshot, width, height)
+        img_width, img_height = chat.pipeline.scaled_size(width, height)
+
+        # 操作后的键盘状态（和截屏并行查询）
+        self.keyboard = keyboard = controller.keyboard_state(probe, screenshot) if keyboard_probe else False
+        self.log(f"Keyboard: {'shown' if keyboard else 'hidden'}")
+
+        # 反思 reflection：画面没有变化时本地直接判 C
+        start = time.time()
+        self.last_diff = diff = self.compare_screens(last_screenshot, screenshot)
+        if diff is not None and diff.ratio <= self.no_change["ratio"] and last_keyboard == keyboard:
+            # 判为 C 时不发起投机执行：投机假设本步为 A，反思后也会被取消
+            output_reflect = ("### Thought ###\nThe screen did not change after the operation (local pixel check).\n"
+                              "### Answer ###\nC\n### Important content ###\n" + self.important_content)
+            metrics.inc("reflection_local_total", label="C")
+            end = time.time()
+            self.log("\n" + "=" * 50 + " Reflection " + "=" * 48)
+            self.log(f"Reflection judged locally in {end - start:.3f} s: changed pixels {diff.ratio:.4%} "
+                     f"<= {self.no_change['ratio']:.4%}, labeled C\n")
+        else:
+            prompt_reflect = get_reflect_prompt(self.instruction, img_width, img_height, last_keyboard, keyboard, operation, action, add_info, important_content=self.important_content, current_app_name=current_app_name, current_subtask=current_subtask)
+            chat_reflect = init_chat()
+            chat_reflect = add_response_two_image("user", prompt_reflect, chat_reflect, [last_screenshot, screenshot])
+            if speculative:
+                self.spec_next = self.start_speculation(screenshot, (width, height), (img_width, img_height))
+            metrics.record_bytes("reflection", chat_bytes(chat_reflect))
+            with metrics.span("reflection"):
+                output_reflect = call(chat_reflect, 'gpt-4o', api_url, key, priority="reflection")
+            chat_reflect = add_response("assistant", output_reflect, chat_reflect)
+            end = time.time()
+
+            self.log("\n"+"=" * 50 + " Reflection " + "=" * 48)
+            changed = f", changed {diff.ratio:.2%} in {len(diff.boxes)} regions" if diff is not None else ""
+            self.log(f"Reflection uses time: {end-start:.1f} s, request {chat_bytes(chat_reflect) / 1024:.0f} KB{changed}{prefix_note('reflect', prompt_reflect)}\n")
+        self.log(output_reflect)  # thought
+
+        self.last_reflect_thought = output_reflect.split("### Thought ###")[-1].split("### Answer ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
+        answer = output_reflect.split("### Answer ###")[-1].split("### Important content ###")[0].replace("\n", " ").replace(":", "").replace("  ", " ").strip()
+        # 反思会不断追加 important content，去重并限制长度，避免提示词随步数增长
+        self.important_content = compact_important_content(output_reflect.split("### Important content ###")[-1].replace("\n", " ").strip())
+
+        if 'A' in answer:
+            self.last_reflect_label = 'A'
+            self.operation_history.append(operation)
+            self.action_history.append(action)
+            self.error = False
+
+            # 生成/刷新“长期技能记忆”：不影响下一步动作，默认放到后台
+            memory_job = self.write_memory(current_app_name, current_subtask, self.last_reflect_thought, operation, action, best_skill_key)
+            self.pending_memory = asyncio.run_coroutine_threadsafe(memory_job, bg_loop)
+            if not async_memory:
+                self.wait_memory()
+
+        elif 'B' in answer:
+            self.last_reflect_label = 'B'
+            self.error = True
+            self.frames.invalidate()
+            controller.back(self.adb_path)
+
+            with memory_lock, metrics.span("persist"):
+                punish_skill_failure(current_app_name, best_skill_key, used_memory)
+                save_memory()
+
+        elif 'C' in answer:
+            self.last_reflect_label = 'C'
+            self.error = True
+
+            with memory_lock, metrics.span("persist"):
+                punish_skill_failure(current_app_name, best_skill_key, used_memory)
+                save_memory()
+
+        # 反思不是 A：投机结果作废
+        if self.spec_next is not None and self.last_reflect_label != 'A':
+            self.spec_next["future"].cancel()
+            self.spec_next = None
+
+        step_span.end()
+        step_end = time.time()
+        self.log("\n"+"=" * 110)
+        self.log(f"This iteration uses time: {step_end-step_start:.1f} s")
+        if self.spec_stats["started"]:
+            self.log(f"Speculation hit rate: {self.spec_stats['hits']}/{self.spec_stats['started']}, saved {self.spec_stats['saved']:.1f} s so far")
+        return False
+
+
+# 直接运行 main.py 时才进入 agent 循环；被 import 时（replay、benchmark、runner）只加载配置和函数
+if __name__ == "__main__":
+    open_memory()
+    Agent(instruction, adb_path).run()
+    if memory_retrieval == "vector":
+        skill_index.flush()
+    if api.default_client.cache is not None:
+        stats = api.default_client.cache.summary()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bypassed']} bypassed, "
+              f"saved {stats['saved']:.1f} s, {stats['entries']} entries")
+    if metrics.enabled:
+        totals = metrics.summary()["durations"]
+        print("Time by span: " + ", ".join(f"{name} {d['total']:.1f} s" for name, d in
+                                           sorted(totals.items(), key=lambda kv: -kv[1]["total"]) if name != "step"))
@@ -0,0 +1,511 @@
+# 长期技能记忆：文本相似度与检索索引
+import os
+import re
+import json
+import time
+import heapq
+import zlib
+import sqlite3
+import threading
+import difflib
+import hashlib
+from collections import OrderedDict, defaultdict
+
+
+def normalize_text(s: str) -> str:  # 抽取中英文文字
+    s = (s or "").lower()
+    s = re.sub(r"[^a-z0-9\u4e00-\u9fff]+", " ", s)   # 中英数字保留
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
+
+
+def similarity(a: str, b: str) -> float:  # 轻量的匹配，判断单词是否一样，形状是否类似
+    na, nb = normalize_text(a), normalize_text(b)
+    if not na or not nb:
+        return 0.0
+    # token Jaccard + SequenceMatcher 混合
+    A, B = set(na.split()), set(nb.split())
+    jacc = len(A & B) / max(1, len(A | B))
+    seq = difflib.SequenceMatcher(None, na, nb).ratio()
+    return 0.6 * jacc + 0.4 * seq
+
+
+def make_skill_key(app_name: str, canonical_desc: str) -> str:  # 为子任务生成唯一的key，来辨别
+    base = normalize_text(canonical_desc)
+    h = hashlib.md5((app_name + "||" + base).encode("utf-8")).hexdigest()[:10]  # 截断避免太长
+    return f"{base[:50]}__{h}"
+
+
+class _AppIndex:
+    def __init__(self):
+        self.entries = {}  # skill_key -> [order, norm_desc, tokens, rec]
+        self.postings = defaultdict(set)  # token -> skill_keys
+        self.next_order = 0
+
+
+class SkillIndex:
+    """
+    memory_db 的检索索引，按 app 分区：
+    - desc 预先归一化并切好 token，倒排表直接得到与查询的交集大小，Jaccard 不用再算集合
+    - 用 Jaccard + SequenceMatcher 的长度上界（real_quick_ratio）给每条打分上界，
+      按上界从高到低只对可能进入 top-k 的候选跑 SequenceMatcher
+    返回结果与逐条调用 similarity() 的排序完全一致（同分按 memory_db 中的插入顺序）。
+    """
+
+    def __init__(self, memory_db=None):
+        self._apps = defaultdict(_AppIndex)
+        if memory_db:
+            self.rebuild(memory_db)
+
+    def rebuild(self, memory_db):
+        self._apps.clear()
+        for app_name, app_mem in memory_db.items():
+            for skill_key, rec in app_mem.items():
+                self.upsert(app_name, skill_key, rec)
+
+    def upsert(self, app_name, skill_key, rec):
+        """新增或更新一条 skill；desc 不变时只替换记录引用，保留原来的顺序。"""
+        idx = self._apps[app_name]
+        norm = normalize_text(rec.get("desc", "") or "")
+        entry = idx.entries.get(skill_key)
+        if entry is not None:
+            if entry[1] == norm:
+                entry[3] = rec
+                return
+            for t in entry[2]:
+                idx.postings[t].discard(skill_key)
+            order = entry[0]
+        else:
+            order = idx.next_order
+            idx.next_order += 1
+        tokens = frozenset(norm.split())
+        idx.entries[skill_key] = [order, norm, tokens, rec]
+        for t in tokens:
+            idx.postings[t].add(skill_key)
+
+    def remove(self, app_name, skill_key):
+        idx = self._apps.get(app_name)
+        entry = idx.entries.pop(skill_key, None) if idx else None
+        if entry is None:
+            return
+        for t in entry[2]:
+            idx.postings[t].discard(skill_key)
+            if not idx.postings[t]:
+                del idx.postings[t]
+
+    def __len__(self):
+        return sum(len(idx.entries) for idx in self._apps.values())
+
+    def search(self, app_name, subtask, top_k=3, min_score=0.35):
+        """返回 [(score, skill_key, rec)]，按分数从高到低。"""
+        idx = self._apps.get(app_name) if app_name else None
+        if not idx or not idx.entries or (top_k is not None and top_k <= 0):
+            return []
+        nq = normalize_text(subtask)
+        if min_score <= 0 or not nq:
+            # 0 分也要返回时没法剪枝，退回逐条计算
+            return self._scan(idx, subtask, top_k, min_score)
+
+        q_tokens = set(nq.split())
+        overlap = defaultdict(int)
+        for t in q_tokens:
+            for skill_key in idx.postings.get(t, ()):
+                overlap[skill_key] += 1
+
+        # 上界：Jaccard 精确值 + SequenceMatcher.real_quick_ratio()
+        lq = len(nq)
+        bounds = []
+        for skill_key, (order, norm, tokens, rec) in idx.entries.items():
+            if not norm:
+                continue
+            inter = overlap.get(skill_key, 0)
+            jacc = inter / max(1, len(q_tokens) + len(tokens) - inter)
+            seq_ub = 2.0 * min(lq, len(norm)) / (lq + len(norm))
+            ub = 0.6 * jacc + 0.4 * seq_ub
+            if ub >= min_score:
+                bounds.append((-ub, order, skill_key, jacc))
+        heapq.heapify(bounds)
+
+        found = []  # (score, order, skill_key, rec)
+        kth = []  # top_k 个最高分的小顶堆
+        while bounds:
+            neg_ub, order, skill_key, jacc = heapq.heappop(bounds)
+            if top_k is not None and len(kth) >= top_k and -neg_ub < kth[0]:
+                break
+            order, norm, tokens, rec = idx.entries[skill_key]
+            if rec.get("disabled", False):
+                continue
+            seq = difflib.SequenceMatcher(None, nq, norm).ratio()
+            score = 0.6 * jacc + 0.4 * seq
+            if score < min_score:
+                continue
+            found.append((score, order, skill_key, rec))
+            if top_k is not None:
+                heapq.heappush(kth, score)
+                if len(kth) > top_k:
+                    heapq.heappop(kth)
+
+        found.sort(key=lambda x: (-x[0], x[1]))
+        selected = found[:max(0, int(top_k))] if top_k is not None else found
+        return [(float(score), str(skill_key), rec) for score, order, skill_key, rec in selected]
+
+    @staticmethod
+    def _scan(idx, subtask, top_k, min_score):
+        candidates = []
+        for skill_key, (order, norm, tokens, rec) in sorted(idx.entries.items(), key=lambda kv: kv[1][0]):
+            if rec.get("disabled", False):
+                continue
+            score = similarity(subtask, rec.get("desc", "") or "")
+            if score >= min_score:
+                candidates.append((float(score), str(skill_key), rec))
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        return candidates[:max(0, int(top_k))] if top_k is not None else candidates
+
+
+class SkillStore:
+    """
+    SQLite（WAL 模式）的技能记忆存储，替代每步整体重写 memory_db.json。
+    新增/更新、计数加一、禁用、删除都是单条记录的事务，耗时与库大小无关；
+    计数用 SQL 自增，多个 agent 共用同一个库文件也不会互相覆盖。
+    其他进程的修改用 changed()（PRAGMA data_version）发现，调用方据此重新 load()。
+    """
+
+    _FIELDS = ("desc", "when_to_use", "hint", "avoid")
+    _MIGRATED = 1  # PRAGMA user_version：旧 JSON 已经导入过
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS skills ("
+            " app_name TEXT NOT NULL, skill_key TEXT NOT NULL,"
+            " desc TEXT NOT NULL DEFAULT '', when_to_use TEXT NOT NULL DEFAULT '',"
+            " hint TEXT NOT NULL DEFAULT '', avoid TEXT NOT NULL DEFAULT '',"
+            " success INTEGER NOT NULL DEFAULT 0, fail INTEGER NOT NULL DEFAULT 0,"
+            " disabled INTEGER NOT NULL DEFAULT 0, updated_at REAL,"
+            " PRIMARY KEY (app_name, skill_key))"
+        )
+        self._version = self._data_version()
+
+    def _data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed(self):
+        """上次调用（或打开）以来有没有别的连接提交过修改；本连接自己的写入不算。"""
+        with self._lock:
+            version = self._data_version()
+            changed, self._version = version != self._version, version
+        return changed
+
+    def close(self):
+        self.conn.close()
+
+    def load(self):
+        """读出整个库，格式与 memory_db.json 相同；同一 app 内按插入顺序。"""
+        memory_db = {}
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT app_name, skill_key, desc, when_to_use, hint, avoid, success, fail, disabled, updated_at"
+                " FROM skills ORDER BY rowid").fetchall()
+        for app_name, skill_key, desc, when_to_use, hint, avoid, success, fail, disabled, updated_at in rows:
+            rec = {
+                "desc": desc, "when_to_use": when_to_use, "hint": hint, "avoid": avoid,
+                "stats": {"success": success, "fail": fail},
+                "disabled": bool(disabled),
+            }
+            if updated_at is not None:
+                rec["updated_at"] = updated_at
+            memory_db.setdefault(app_name, {})[skill_key] = rec
+        return memory_db
+
+    def put(self, app_name, skill_key, rec):
+        """新增或更新一条 skill 的文本字段；已存在时不动计数。"""
+        stats = rec.get("stats", {})
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO skills (app_name, skill_key, desc, when_to_use, hint, avoid, success, fail, disabled, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (app_name, skill_key) DO UPDATE SET"
+                " desc = excluded.desc, when_to_use = excluded.when_to_use, hint = excluded.hint,"
+                " avoid = excluded.avoid, updated_at = excluded.updated_at",
+                (app_name, skill_key, *((rec.get(f, "") or "") for f in self._FIELDS),
+                 stats.get("success", 0), stats.get("fail", 0), int(bool(rec.get("disabled", False))),
+                 rec.get("updated_at")),
+            )
+
+    def incr(self, app_name, skill_key, field):
+        """success / fail 加一，返回库里最新的 stats（包含其他进程的累加）；记录已被删掉时返回 None。"""
+        if field not in ("success", "fail"):
+            raise ValueError(f"unknown stat: {field}")
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    f"UPDATE skills SET {field} = {field} + 1, updated_at = ? WHERE app_name = ? AND skill_key = ?",
+                    (time.time(), app_name, skill_key))
+                row = self.conn.execute(
+                    "SELECT success, fail FROM skills WHERE app_name = ? AND skill_key = ?",
+                    (app_name, skill_key)).fetchone()
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return {"success": row[0], "fail": row[1]} if row else None
+
+    def disable(self, app_name, skill_key):
+        with self._lock:
+            self.conn.execute("UPDATE skills SET disabled = 1 WHERE app_name = ? AND skill_key = ?",
+                              (app_name, skill_key))
+
+    def delete(self, app_name, skill_key):
+        with self._lock:
+            self.conn.execute("DELETE FROM skills WHERE app_name = ? AND skill_key = ?", (app_name, skill_key))
+
+    def import_db(self, memory_db):
+        """把 memory_db 字典整体写入（一个事务）。"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for app_name, app_mem in memory_db.items():
+                    for skill_key, rec in app_mem.items():
+                        stats = rec.get("stats", {})
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO skills VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (app_name, skill_key, *((rec.get(f, "") or "") for f in self._FIELDS),
+                             stats.get("success", 0), stats.get("fail", 0),
+                             int(bool(rec.get("disabled", False))), rec.get("updated_at")))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def migrate_json(self, json_path):
+        """
+        库为空且旧的 memory_db.json 存在时导入一次，返回导入的条数。
+        导入过（或检查时库里已有数据）就在 PRAGMA user_version 记下，之后技能被删光也不会再把旧 JSON 导回来。
+        """
+        with self._lock:
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] >= self._MIGRATED:
+                return 0
+            empty = self.conn.execute("SELECT 1 FROM skills LIMIT 1").fetchone() is None
+        count = 0
+        if empty and os.path.exists(json_path):
+            with open(json_path, "r", encoding="utf-8") as f:
+                memory_db = json.load(f)
+            self.import_db(memory_db)
+            count = sum(len(app_mem) for app_mem in memory_db.values())
+        with self._lock:
+            self.conn.execute(f"PRAGMA user_version = {self._MIGRATED}")
+        return count
+
+
+class HashingEncoder:
+    """
+    不依赖模型的本地向量化：英文词 + 词内字符 n-gram + 中文单字/双字，哈希到 dim 维后 L2 归一化。
+    对词形变化、中英混写比 token Jaccard 稳，但不理解同义词；需要语义时换成 SentenceTransformerEncoder。
+    """
+
+    def __init__(self, dim=512, ngrams=(3, 4)):
+        self.dim = dim
+        self.ngrams = ngrams
+        self.name = f"hash-{dim}-{'-'.join(map(str, ngrams))}"
+
+    def _features(self, text):
+        feats = []
+        for word in re.findall(r"[\u4e00-\u9fff]+|[a-z0-9]+", normalize_text(text)):
+            if "\u4e00" <= word[0] <= "\u9fff":
+                feats.extend(word)
+                feats.extend(word[i:i + 2] for i in range(len(word) - 1))
+            else:
+                feats.append("w:" + word)
+                padded = f"<{word}>"
+                for n in self.ngrams:
+                    feats.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        return feats
+
+    def encode(self, texts):
+        import numpy as np
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feat in self._features(text):
+                h = zlib.crc32(feat.encode("utf-8"))
+                vecs[row, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs / np.maximum(norms, 1e-8)
+
+
+class SentenceTransformerEncoder:
+    """本地 CPU 句向量模型（需要安装 sentence-transformers）。"""
+
+    def __init__(self, model_name="paraphrase-multilingual-MiniLM-L12-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.name = f"st-{model_name}"
+
+    def encode(self, texts):
+        import numpy as np
+        return np.asarray(self.model.encode(list(texts), normalize_embeddings=True), dtype=np.float32)
+
+
+def skill_text(rec):
+    """参与向量化的文本：desc + when_to_use。"""
+    return f"{rec.get('desc', '') or ''} {rec.get('when_to_use', '') or ''}".strip()
+
+
+class _AppVectors:
+    def __init__(self, dim):
+        import numpy as np
+        self.matrix = np.zeros((16, dim), dtype=np.float32)
+        self.keys = []  # 行号 -> skill_key
+        self.recs = []  # 行号 -> rec
+        self.texts = []  # 行号 -> 向量化的文本
+        self.rows = {}  # skill_key -> 行号
+
+
+class VectorIndex:
+    """
+    语义检索后端，接口与 SkillIndex 相同（upsert / remove / search），min_score 为余弦相似度。
+    每个 app 一个向量矩阵，查询是一次矩阵-向量乘 + argpartition。
+    向量按文本缓存（最多 cache_size 条，按最近使用淘汰），desc/when_to_use 没变的 upsert 不会重新编码；
+    给了 cache_dir 时每个 app 的矩阵存成 .npy，下次启动以内存映射方式读回。
+    """
+
+    def __init__(self, encoder=None, cache_dir=None, memory_db=None, cache_size=4096):
+        self.encoder = encoder or HashingEncoder()
+        self.dim = self.encoder.encode(["dim"]).shape[1]
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self._apps = {}
+        self._cache = OrderedDict()  # 文本 -> 向量
+        if memory_db:
+            self.rebuild(memory_db)
+
+    def _app(self, app_name):
+        if app_name not in self._apps:
+            self._apps[app_name] = _AppVectors(self.dim)
+        return self._apps[app_name]
+
+    def _cache_paths(self, app_name):
+        name = hashlib.md5(f"{self.encoder.name}||{app_name}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name + ".npy"), os.path.join(self.cache_dir, name + ".json")
+
+    def _load_cache(self, app_name):
+        if not self.cache_dir:
+            return
+        import numpy as np
+        npy, meta = self._cache_paths(app_name)
+        if not (os.path.exists(npy) and os.path.exists(meta)):
+            return
+        with open(meta, "r", encoding="utf-8") as f:
+            texts = json.load(f)["texts"]
+        vecs = np.load(npy, mmap_mode="r")
+        for row, text in enumerate(texts):
+            self._cache.setdefault(text, vecs[row])  # 超出 cache_size 的部分在下一次 _encode 时淘汰
+
+    def _encode(self, texts):
+        import numpy as np
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        vecs = {t: self._cache.get(t) for t in dict.fromkeys(texts)}
+        missing = [t for t, vec in vecs.items() if vec is None]
+        if missing:
+            vecs.update(zip(missing, self.encoder.encode(missing)))
+        for text, vec in vecs.items():
+            self._cache[text] = vec
+            self._cache.move_to_end(text)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return np.stack([vecs[t] for t in texts])
+
+    def rebuild(self, memory_db):
+        self._apps.clear()
+        for app_name, app_mem in memory_db.items():
+            self._load_cache(app_name)
+            items = list(app_mem.items())
+            vecs = self._encode([skill_text(rec) for _, rec in items])
+            av = self._app(app_name)
+            for (skill_key, rec), vec in zip(items, vecs):
+                self._put(av, skill_key, rec, vec)
+
+    def flush(self):
+        """把每个 app 的向量矩阵写到 cache_dir。"""
+        if not self.cache_dir:
+            return
+        import numpy as np
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for app_name, av in self._apps.items():
+            npy, meta = self._cache_paths(app_name)
+            np.save(npy + ".tmp.npy", av.matrix[:len(av.keys)])
+            os.replace(npy + ".tmp.npy", npy)
+            with open(meta, "w", encoding="utf-8") as f:
+                json.dump({"encoder": self.encoder.name, "texts": av.texts}, f, ensure_ascii=False)
+
+    @staticmethod
+    def _put(av, skill_key, rec, vec):
+        import numpy as np
+        row = av.rows.get(skill_key)
+        if row is None:
+            row = len(av.keys)
+            if row == av.matrix.shape[0]:
+                grown = np.zeros((row * 2, av.matrix.shape[1]), dtype=np.float32)
+                grown[:row] = av.matrix
+                av.matrix = grown
+            av.rows[skill_key] = row
+            av.keys.append(skill_key)
+            av.recs.append(rec)
+            av.texts.append(skill_text(rec))
+        av.matrix[row] = vec
+        av.recs[row] = rec
+        av.texts[row] = skill_text(rec)
+
+    def upsert(self, app_name, skill_key, rec):
+        self._put(self._app(app_name), skill_key, rec, self._encode([skill_text(rec)])[0])
+
+    def remove(self, app_name, skill_key):
+        av = self._apps.get(app_name)
+        row = av.rows.pop(skill_key, None) if av else None
+        if row is None:
+            return
+        # 用最后一行填补空位，保持矩阵连续
+        last = len(av.keys) - 1
+        if row != last:
+            av.matrix[row] = av.matrix[last]
+            for lst in (av.keys, av.recs, av.texts):
+                lst[row] = lst[last]
+            av.rows[av.keys[row]] = row
+        for lst in (av.keys, av.recs, av.texts):
+            lst.pop()
+
+    def __len__(self):
+        return sum(len(av.keys) for av in self._apps.values())
+
+    def search(self, app_name, subtask, top_k=3, min_score=0.3):
+        """返回 [(score, skill_key, rec)]，score 为余弦相似度。"""
+        import numpy as np
+        av = self._apps.get(app_name) if app_name else None
+        n = len(av.keys) if av else 0
+        if not n or not subtask or (top_k is not None and top_k <= 0):
+            return []
+        scores = av.matrix[:n] @ self.encoder.encode([subtask])[0]
+        k = n if top_k is None else min(n, int(top_k) + 8)  # 多取几个，留给被禁用的记录
+        while True:
+            order = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+            order = order[np.argsort(-scores[order], kind="stable")]
+            out = []
+            for row in order:
+                score = float(scores[row])
+                if score < min_score:
+                    break
+                rec = av.recs[row]
+                if rec.get("disabled", False):
+                    continue
+                out.append((score, str(av.keys[row]), rec))
+                if top_k is not None and len(out) >= top_k:
+                    return out
+            # 候选里禁用的太多、又还没低于 min_score 时，扩大范围重来
+            if k >= n or score < min_score:
+                return out
+            k = min(n, k * 4)
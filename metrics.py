@@ -0,0 +1,235 @@
+# 追踪与指标：span（带父子关系的耗时记录）+ 计数器，导出到 JSONL 文件和/或 Prometheus 文本端点
+# 未 configure 时 span() 返回空操作对象，埋点的开销只有一次全局变量判断
+import os
+import json
+import time
+import uuid
+import atexit
+import itertools
+import threading
+import contextvars
+
+enabled = False
+trace_id = None
+_lock = threading.Lock()
+_exporter = None  # JSONL 文件
+_current = contextvars.ContextVar("gui_agent_span", default=None)
+_ids = itertools.count(1)  # span id 在一个进程（trace）内唯一
+
+durations = {}  # span 名 -> [秒]，benchmark.py agent 用来算百分位
+sizes = {}  # stage -> [请求字节数]
+counters = {}  # (name, labels) -> 累计值
+histograms = {}  # span 名 -> [各桶计数..., sum, count]
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    """一次计时：with metrics.span("llm", model=...) as sp: ...; sp.set(tokens=...) 追加属性。"""
+    __slots__ = ("name", "id", "parent", "attrs", "start", "_t0", "_token")
+    recording = True
+
+    def __init__(self, name, attrs):
+        parent = _current.get()
+        self.name = name
+        self.id = next(_ids)
+        self.parent = parent.id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _current.set(self)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def end(self, error=None):
+        duration = time.perf_counter() - self._t0
+        try:
+            _current.reset(self._token)
+        except (ValueError, RuntimeError):
+            # 在别的线程/上下文里结束（比如循环里手动 start/end 的 step），只恢复成父 span
+            pass
+        if error is not None:
+            self.attrs["error"] = f"{type(error).__name__}: {error}"
+        _finish(self, duration)
+        return duration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+    recording = False
+
+    def set(self, **attrs):
+        return self
+
+    def end(self, error=None):
+        return 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name, **attrs):
+    """开始一个 span；未启用时返回空操作对象。可以当 context manager 用，也可以手动 end()。"""
+    if not enabled:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def current_span():
+    """当前上下文里最内层的 span（没有则返回空操作对象），用于给外层 span 补属性。"""
+    return (_current.get() or _NOOP) if enabled else _NOOP
+
+
+def _finish(sp, duration):
+    with _lock:
+        durations.setdefault(sp.name, []).append(duration)
+        h = histograms.get(sp.name)
+        if h is None:
+            h = histograms[sp.name] = [0] * (len(BUCKETS) + 2)
+        for k, le in enumerate(BUCKETS):
+            if duration <= le:
+                h[k] += 1
+        h[-2] += duration
+        h[-1] += 1
+        if _exporter is not None:
+            record = {"trace": trace_id, "span": sp.id, "parent": sp.parent, "name": sp.name,
+                      "start": sp.start, "duration": duration, "thread": threading.current_thread().name}
+            record.update(sp.attrs)
+            _exporter.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+def record(stage, seconds):
+    """直接记一个耗时（已经测好的值，比如 wait_for_settle 返回的等待时间）。"""
+    if not enabled:
+        return
+    with _lock:
+        durations.setdefault(stage, []).append(seconds)
+
+
+def record_bytes(stage, n):
+    if not enabled:
+        return
+    with _lock:
+        sizes.setdefault(stage, []).append(n)
+
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def configure(trace_path=None, prometheus_port=None):
+    """
+    启用采集。trace_path 给定时每个结束的 span 写一行 JSON；
+    prometheus_port 给定时在该端口的 /metrics 提供 Prometheus 文本格式。两者都不给时只在内存里汇总。
+    """
+    global enabled, trace_id, _exporter
+    enabled = True
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    if trace_path and _exporter is None:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+        _exporter = open(trace_path, "a", encoding="utf-8", buffering=1)
+        atexit.register(_exporter.close)
+    if prometheus_port:
+        serve_prometheus(prometheus_port)
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+
+def prometheus_text():
+    lines = ["# TYPE gui_agent_span_seconds histogram"]
+    with _lock:
+        for name, h in sorted(histograms.items()):
+            for k, le in enumerate(BUCKETS):
+                lines.append(f'gui_agent_span_seconds_bucket{{span="{name}",le="{le}"}} {h[k]}')
+            lines.append(f'gui_agent_span_seconds_bucket{{span="{name}",le="+Inf"}} {h[-1]}')
+            lines.append(f'gui_agent_span_seconds_sum{{span="{name}"}} {h[-2]}')
+            lines.append(f'gui_agent_span_seconds_count{{span="{name}"}} {h[-1]}')
+        seen = set()
+        for (name, pairs), value in sorted(counters.items()):
+            if name not in seen:
+                lines.append(f"# TYPE gui_agent_{name} counter")
+                seen.add(name)
+            lines.append(f"gui_agent_{name}{_labels(pairs)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(port, host="0.0.0.0"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def percentile(values, q):
+    """线性插值的百分位数，q 取 0-100。"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def describe(values):
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def summary():
+    with _lock:
+        return {
+            "durations": {stage: describe(v) for stage, v in durations.items()},
+            "bytes": {stage: describe(v) for stage, v in sizes.items()},
+            "counters": {name + _labels(pairs): v for (name, pairs), v in counters.items()},
+        }
+
+
+def reset():
+    with _lock:
+        durations.clear()
+        sizes.clear()
+        counters.clear()
+        histograms.clear()
@@ -1,7 +1,121 @@
 # 规划/进度更新 planning
+import os
+import re
 import json
 
 
+# 提示词长度控制：最近 HISTORY_WINDOW 步原样保留，更早的压成一行摘要；
+# important content 去重后只保留最近的 IMPORTANT_CONTENT_MAX_CHARS 个字符；
+# 每个阶段的提示词不超过 TOKEN_BUDGET（超出时逐步缩小历史窗口和 important content，后者不低于 IMPORTANT_CONTENT_MIN_CHARS；
+# 反思不缩 important content，改为先截短 add_info、再截短操作描述和动作，后两者不低于 REFLECT_MIN_OPERATION_CHARS）
+HISTORY_WINDOW = 8
+HISTORY_SUMMARY_MAX_CHARS = 400
+IMPORTANT_CONTENT_MAX_CHARS = 1500
+IMPORTANT_CONTENT_MIN_CHARS = 400
+REFLECT_MIN_OPERATION_CHARS = 200
+TOKEN_BUDGET = {"planning": 3000, "decision": 3500, "reflect": 2500}
+
+
+# 提示词布局："legacy" 为原来的顺序；"cache" 把固定不变的部分（角色、规则、动作空间、输出格式）放在最前，
+# 每步变化的内容放在后面，便于服务端/本地推理服务做 prompt prefix cache
+PROMPT_LAYOUT = "legacy"
+
+
+class PrefixMeter:
+    """统计同一阶段相邻两次提示词的公共前缀占比，衡量 prefix cache 能复用多少。"""
+
+    def __init__(self):
+        self._last = {}
+        self.stats = {}  # stage -> [calls, shared_chars, total_chars]
+
+    def observe(self, stage, prompt):
+        """记录一次提示词，返回与上一次同阶段提示词的公共前缀占比（第一次为 0）。"""
+        last = self._last.get(stage, "")
+        shared = len(os.path.commonprefix([last, prompt]))
+        self._last[stage] = prompt
+        st = self.stats.setdefault(stage, [0, 0, 0])
+        st[0] += 1
+        st[1] += shared
+        st[2] += len(prompt)
+        return shared / max(1, len(prompt))
+
+    def summary(self):
+        return {stage: shared / max(1, total) for stage, (calls, shared, total) in self.stats.items()}
+
+
+def estimate_tokens(text):
+    """粗略估计 token 数：中日韩字符按 1 个，其余按 4 个字符 1 个。"""
+    cjk = len(re.findall(r"[\u3000-\u9fff\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def compact_history(operation_history, action_history, window=HISTORY_WINDOW):
+    """
+    返回 (summary, recent)：recent 是最近 window 步的 [(step, operation, action)]，
+    更早的步骤合并成一行摘要（只保留操作描述的主干，连续重复的合并）。
+    """
+    n = len(action_history)
+    start = max(0, n - window)
+    recent = [(i + 1, operation_history[i] if i < len(operation_history) else "", action_history[i])
+              for i in range(start, n)]
+    if start == 0:
+        return "", recent
+    ops = []
+    for op in operation_history[:start]:
+        op = op.split(" to ")[0].replace("\n", " ").strip()[:60]
+        if not ops or ops[-1] != op:
+            ops.append(op)
+    summary = "; ".join(ops)
+    if len(summary) > HISTORY_SUMMARY_MAX_CHARS:
+        summary = "... " + summary[-HISTORY_SUMMARY_MAX_CHARS:].split("; ", 1)[-1]
+    return f"Step-1 to Step-{start} (summarized): " + summary, recent
+
+
+def compact_important_content(text, max_chars=IMPORTANT_CONTENT_MAX_CHARS):
+    """
+    important content 按句去重（保留最后一次出现的位置），超长时只保留最近的部分。
+    中文句末标点后不需要空格也断句；放不下的那一句截掉开头，只留能放下的结尾。
+    """
+    parts = [p.strip() for p in re.split(r"(?<=[。；！？])|(?<=[;.!?])\s+|\n+", text or "") if p.strip()]
+    seen, kept, used = set(), [], 0
+    for part in reversed(parts):
+        key = part.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        room = max_chars - used
+        if len(part) > room:
+            if room > 1 and (not kept or room >= 40):
+                kept.append("…" + part[len(part) - room + 1:])
+            break
+        kept.append(part)
+        used += len(part) + 1
+    return " ".join(reversed(kept))
+
+
+def _reflect_reason(label, reason):
+    """
+    上一步反思理由：只有 B/C 时写进提示词。
+    A 的理由对下一步没有信息量，去掉后投机执行（反思结束前假设为 A）构造的提示词才能和真实的一致。
+    """
+    return "" if label == "A" else f" Reason={reason}"
+
+
+def _fit_budget(build, stage, history_window, token_budget, min_ic_chars=IMPORTANT_CONTENT_MIN_CHARS):
+    """按预算构造提示词：超出时先缩小历史窗口，再缩短 important content（不低于 min_ic_chars）。"""
+    window = HISTORY_WINDOW if history_window is None else history_window
+    budget = TOKEN_BUDGET.get(stage) if token_budget is None else token_budget
+    ic_chars = IMPORTANT_CONTENT_MAX_CHARS
+    prompt = build(window, ic_chars)
+    while budget and estimate_tokens(prompt) > budget and (window > 0 or ic_chars > min_ic_chars):
+        if window > 0:
+            window //= 2
+        else:
+            ic_chars = max(min_ic_chars, ic_chars // 2)
+        prompt = build(window, ic_chars)
+    return prompt
+
+
 def get_planning_prompt(
     instruction: str,
     planning_json: dict | None,
@@ -10,23 +124,37 @@ def get_planning_prompt(
     completed_summary: str,
     last_reflect_label: str,
     last_reflect_reason: str,
+    history_window: int | None = None,
+    token_budget: int | None = None,
+    layout: str | None = None,
+):
+    return _fit_budget(
+        lambda window, ic_chars: _planning_prompt(
+            instruction, planning_json, operation_history, action_history,
+            completed_summary, last_reflect_label, last_reflect_reason, window, layout or PROMPT_LAYOUT),
+        "planning", history_window, token_budget)
+
+
+def _planning_prompt(
+    instruction, planning_json, operation_history, action_history,
+    completed_summary, last_reflect_label, last_reflect_reason, window, layout,
 ):
     prompt = "You are a mobile GUI agent PLANNER. Your job is NOT to decide coordinates.\n"
 
     if not planning_json:
         prompt += "Your job is to: build a subtask plan.\n\n"
 
-        prompt += "### USER INSTRUCTION ###\n"
-        prompt += instruction.strip() + "\n\n"
+        context = "### USER INSTRUCTION ###\n"
+        context += instruction.strip() + "\n\n"
 
-        prompt += "### PLANNING RULES ###\n"
-        prompt += "1) Create a plan by decomposing the instruction into ordered subtasks and initialize progress.\n"
-        prompt += "2) Each subtask MUST have a stable app_name used for memory category, e.g., 'Setting', 'QQ', 'Maps', 'Chrome'.\n"
-        prompt += "3) Each subtask must be atomic, verifiable, and can be done by one action.\n"
-        prompt += "4) Always output STRICT JSON only. No extra text.\n\n"
+        rules = "### PLANNING RULES ###\n"
+        rules += "1) Create a plan by decomposing the instruction into ordered subtasks and initialize progress.\n"
+        rules += "2) Each subtask MUST have a stable app_name used for memory category, e.g., 'Setting', 'QQ', 'Maps', 'Chrome'.\n"
+        rules += "3) Each subtask must be atomic, verifiable, and can be done by one action.\n"
+        rules += "4) Always output STRICT JSON only. No extra text.\n\n"
 
-        prompt += "### OUTPUT JSON SCHEMA (STRICT) ###\n"
-        prompt += """{
+        rules += "### OUTPUT JSON SCHEMA (STRICT) ###\n"
+        rules += """{
               "subtasks": [
                 {
                   "id": <int>,
@@ -45,41 +173,44 @@ def get_planning_prompt(
                 "replan_reason": "<string>"
               }
             }"""
-        return prompt
+        return _assemble(prompt, rules, context, layout)
 
     prompt += "Your job is to: (1) update subtask plan if needed, (2) track progress, (3) select the current subtask for this iteration.\n\n"
 
-    prompt += "### USER INSTRUCTION ###\n"
-    prompt += instruction.strip() + "\n\n"
+    context = "### USER INSTRUCTION ###\n"
+    context += instruction.strip() + "\n\n"
 
-    prompt += "### CURRENT PLAN JSON ###\n"
-    prompt += (json.dumps(planning_json, ensure_ascii=False) if planning_json else "null") + "\n\n"
+    context += "### CURRENT PLAN JSON ###\n"
+    context += (json.dumps(planning_json, ensure_ascii=False, separators=(",", ":")) if planning_json else "null") + "\n\n"
 
-    prompt += "### EXECUTION HISTORY (most recent last) ###\n"
+    context += "### EXECUTION HISTORY (most recent last) ###\n"
     if operation_history:
-        for i in range(len(operation_history)):
-            op = operation_history[i].replace("\n", " ").strip()
-            act = action_history[i].replace("\n", " ").strip() if i < len(action_history) else ""
-            prompt += f"- Step-{i+1}: operation='{op}' ; action='{act}'\n"
+        summary, recent = compact_history(operation_history, action_history, window)
+        if summary:
+            context += f"- {summary}\n"
+        for step, op, act in recent:
+            op = op.replace("\n", " ").strip()
+            act = act.replace("\n", " ").strip()
+            context += f"- Step-{step}: operation='{op}' ; action='{act}'\n"
     else:
-        prompt += "- (none)\n"
-    prompt += "\n"
+        context += "- (none)\n"
+    context += "\n"
 
-    prompt += "### COMPLETED SUMMARY (may be empty) ###\n"
-    prompt += (completed_summary.strip() if completed_summary else "") + "\n\n"
+    context += "### COMPLETED SUMMARY (may be empty) ###\n"
+    context += (completed_summary.strip() if completed_summary else "") + "\n\n"
 
-    prompt += "### LAST REFLECTION RESULT ###\n"
-    prompt += f"label={last_reflect_label}(A means The result of Operation meets the expectation; B means the Operation results in a wrong page; C means The Operation produces no changes). Reason={last_reflect_reason}\n\n"
+    context += "### LAST REFLECTION RESULT ###\n"
+    context += f"label={last_reflect_label}(A means The result of Operation meets the expectation; B means the Operation results in a wrong page; C means The Operation produces no changes).{_reflect_reason(last_reflect_label, last_reflect_reason)}\n\n"
 
-    prompt += "### PLANNING RULES ###\n"
-    prompt += "1) Update each subtask.done and progress based on the EXECUTION HISTORY and COMPLETED SUMMARY.\n"
-    prompt += "2) Select current task as the first subtask with done=false.\n"
-    prompt += "3) If error=True: consider whether remaining subtasks require revision.\n"
-    prompt += "4) Only revise FUTURE tasks when clearly necessary; keep already-done tasks stable.\n"
-    prompt += "5) Always output STRICT JSON only. No extra text.\n\n"
+    rules = "### PLANNING RULES ###\n"
+    rules += "1) Update each subtask.done and progress based on the EXECUTION HISTORY and COMPLETED SUMMARY.\n"
+    rules += "2) Select current task as the first subtask with done=false.\n"
+    rules += "3) If error=True: consider whether remaining subtasks require revision.\n"
+    rules += "4) Only revise FUTURE tasks when clearly necessary; keep already-done tasks stable.\n"
+    rules += "5) Always output STRICT JSON only. No extra text.\n\n"
 
-    prompt += "### OUTPUT JSON SCHEMA (STRICT) ###\n"
-    prompt += """{
+    rules += "### OUTPUT JSON SCHEMA (STRICT) ###\n"
+    rules += """{
       "subtasks": [
         {
           "id": <int>,
@@ -99,7 +230,14 @@ def get_planning_prompt(
       }
     }"""
 
-    return prompt
+    return _assemble(prompt, rules, context, layout)
+
+
+def _assemble(head, rules, context, layout):
+    """legacy：head + 上下文 + 规则；cache：head + 规则（固定前缀）+ 上下文。"""
+    if layout == "cache":
+        return head + rules + "\n\n" + context + "### OUTPUT ###\nOutput STRICT JSON following the schema above.\n"
+    return head + context + rules
 
 
 # decision
@@ -113,9 +251,42 @@ def get_decision_prompt(
     current_subtask,
     important_content,
     retrieved_memory,
+    ui_elements=None,
+    text_only=False,
+    history_window=None,
+    token_budget=None,
+    layout=None,
+    ):
+    """
+    ui_elements 为当前界面元素列表（每行 "[ID] 类型 "标签" at (x, y)"），给出时可以用 Tap element (ID)；
+    text_only=True 时不附截图，界面只由元素列表描述。
+    """
+    args = dict(locals())
+    del args["history_window"], args["token_budget"]
+    args["layout"] = layout or PROMPT_LAYOUT
+    return _fit_budget(
+        lambda window, ic_chars: _decision_prompt(**args, window=window, ic_chars=ic_chars),
+        "decision", history_window, token_budget)
+
+
+def _decision_prompt(
+    instruction, width, height, keyboard,
+    operation_history, action_history,
+    last_operation, last_action,
+    add_info,
+    last_reflect_label, last_reflect_reason, error, completed,
+    current_app_name,
+    current_subtask,
+    important_content,
+    retrieved_memory,
+    ui_elements, text_only,
+    layout, window, ic_chars,
     ):
     prompt = "### Background ###\n"
-    prompt += f"The image is a phone screenshot. Its width is {width} pixels and its height is {height} pixels. The user\'s instruction is: {instruction}.\n\n"
+    if text_only:
+        prompt += f"No screenshot is attached this time: the current phone screen is described by the UI element list below. The screen width is {width} pixels and its height is {height} pixels. The user\'s instruction is: {instruction}.\n\n"
+    else:
+        prompt += f"The image is a phone screenshot. Its width is {width} pixels and its height is {height} pixels. The user\'s instruction is: {instruction}.\n\n"
     prompt += "The format of the coordinates is [x, y], x is the pixel from left to right and y is the pixel from top to bottom. "
 
     if current_subtask or current_app_name:
@@ -132,6 +303,11 @@ def get_decision_prompt(
     else:
         prompt += "The keyboard has not been activated and you can\'t type."
     prompt += "\n\n"
+
+    if ui_elements:
+        prompt += "### UI elements ###\n"
+        prompt += "The interactive elements and texts on the current screen, from top to bottom. Each line is [ID] type \"label\" at (x, y), where (x, y) is the center of the element:\n"
+        prompt += ui_elements + "\n\n"
     
     if add_info != "":
         prompt += "### Hint ###\n"
@@ -142,8 +318,11 @@ def get_decision_prompt(
     if len(action_history) > 0:
         prompt += "### History operations ###\n"
         prompt += "Before reaching this page, some operations have been completed. You need to refer to the completed operations to decide the next operation. These operations are as follow:\n"
-        for i in range(len(action_history)):
-            prompt += f"Step-{i+1}: [Operation: " + operation_history[i].split(" to ")[0].strip() + "; Action: " + action_history[i] + "]\n"
+        summary, recent = compact_history(operation_history, action_history, window)
+        if summary:
+            prompt += summary + "\n"
+        for step, op, act in recent:
+            prompt += f"Step-{step}: [Operation: " + op.split(" to ")[0].strip() + "; Action: " + act + "]\n"
         prompt += "\n"
     
     if completed != "":
@@ -165,33 +344,56 @@ def get_decision_prompt(
     if important_content != "":
         prompt += "### Important Contents ###\n"
         prompt += "During the operations, you record the following contents on the screenshot for use in subsequent operations:\n"
-        prompt += "Important Contents:\n" + important_content + "\n"
+        prompt += "Important Contents:\n" + compact_important_content(important_content, ic_chars) + "\n"
 
     prompt += "### Last Reflection Result ###\n"
-    prompt += f"label={last_reflect_label}(A means The result of Operation meets the expectation; B means the Operation results in a wrong page; C means The Operation produces no changes). Reason={last_reflect_reason}\n\n"
+    prompt += f"label={last_reflect_label}(A means The result of Operation meets the expectation; B means the Operation results in a wrong page; C means The Operation produces no changes).{_reflect_reason(last_reflect_label, last_reflect_reason)}\n\n"
     if error:
         prompt += "### Last operation ###\n"
         prompt += f"You previously attempted to perform the operation \"{last_operation}\" by executing the Action \"{last_action}\". That action was incorrect, and its effect has already been undone. Now, you should not repeat “{last_action}” or perform a similar back-off action. Instead, re-evaluate the current screen and choose a new action that advances the task toward the goal."
         prompt += "\n\n"
 
-    prompt += "### Response requirements ###\n"
-    prompt += "Now you need to combine all of the above to perform just one action on the current page. You must choose one of the five actions below:\n"
+    if layout == "cache":
+        # 规则和动作空间与键盘状态无关，放在最前面作为固定前缀
+        return (_decision_rules(None, bool(ui_elements)) + "\n\n" + prompt
+                + "### Task ###\nNow you need to combine all of the above to perform just one action on the current page, "
+                "following the response requirements and output format given at the beginning.\n")
+    return prompt + _decision_rules(keyboard, bool(ui_elements))
+
+
+def _decision_rules(keyboard, elements=False):
+    """
+    动作空间 + 输出格式。keyboard 为 None 时给出与键盘状态无关的版本（cache 布局）；
+    elements 为 True 时多一个按元素编号点击的动作。
+    """
+    if keyboard is None:
+        prompt = "### Response requirements ###\n"
+        prompt += "You need to combine the context given below to perform just one action on the current page. You must choose one of the five actions below:\n"
+    else:
+        prompt = "### Response requirements ###\n"
+        prompt += "Now you need to combine all of the above to perform just one action on the current page. You must choose one of the five actions below:\n"
     prompt += "Open app 'app name' (x, y): If the current page is desktop, you can use this action to tap the position (x, y) in current page to open the app named \"app name\" on the desktop.\n"
     prompt += "Tap (x, y): Tap the position (x, y) in current page.\n"
+    if elements:
+        prompt += "Tap element (ID): Tap the center of the element with this ID in the UI element list. Prefer this over Tap (x, y) when the target is in the list.\n"
     prompt += "Swipe (x1, y1), (x2, y2): Swipe from position (x1, y1) to position (x2, y2).\n"
-    if keyboard:
+    if keyboard is None:
+        prompt += "Type (text): Type the \"text\" in the input box. Only available when the Keyboard status says the keyboard has been activated; otherwise, first activate the keyboard by tapping on the input box on the screen.\n"
+    elif keyboard:
         prompt += "Type (text): Type the \"text\" in the input box.\n"
     else:
         prompt += "Unable to Type. You cannot use the action \"Type\" because the keyboard has not been activated. If you want to type, please first activate the keyboard by tapping on the input box on the screen.\n"
     prompt += "Home: Return to home page.\n"
     prompt += "\n\n"
-    
+
     prompt += "### Output format ###\n"
     prompt += "Your output consists of the following three parts:\n"
     prompt += "### Thought ###\nThink about the requirements that have been completed in previous operations and the requirements that need to be completed in the next one operation.\n"
     prompt += "### Action ###\nYou can only choose one from the five actions above. Make sure that the coordinates or text in the \"()\".\n"
     prompt += "### Description ###\nPlease generate a brief natural language description for the operation in Action based on your Thought."
-    
+
+    if elements:
+        prompt = prompt.replace("the five actions", "the actions")
     return prompt
 
 
@@ -201,12 +403,57 @@ def get_reflect_prompt(
     operation, action,
     add_info,
     current_app_name, current_subtask,
-    important_content
+    important_content,
+    token_budget=None,
+    layout=None,
 ):
-    prompt = ""
-    prompt += f"These images are two phone screenshots BEFORE and AFTER one operation. Width={width}px, Height={height}px.\n\n"
+    # 反思的输出会替换掉 important content，截短它就等于把早先记下的内容丢掉，所以超预算时只截 add_info 和操作
+    budget = TOKEN_BUDGET.get("reflect") if token_budget is None else token_budget
+    important_content = compact_important_content(important_content)
+    info_chars = len(add_info or "")
+    op_chars = max(len(operation), len(action))
+
+    def build():
+        return _reflect_prompt(
+            instruction, width, height, keyboard1, keyboard2,
+            _clip(operation, op_chars), _clip(action, op_chars), _clip(add_info, info_chars),
+            current_app_name, current_subtask, important_content, layout or PROMPT_LAYOUT)
+
+    prompt = build()
+    while budget and estimate_tokens(prompt) > budget and (info_chars > 0 or op_chars > REFLECT_MIN_OPERATION_CHARS):
+        if info_chars > 0:
+            info_chars = info_chars // 2 if info_chars > 100 else 0
+        else:
+            op_chars = max(REFLECT_MIN_OPERATION_CHARS, op_chars // 2)
+        prompt = build()
+    return prompt
+
+
+def _clip(text, max_chars):
+    """超过 max_chars 时截掉结尾，用 … 标出。"""
+    if not text or len(text) <= max_chars:
+        return text
+    return text[:max_chars - 1] + "…" if max_chars > 0 else ""
+
+
+def _reflect_prompt(
+    instruction, width, height,
+    keyboard1, keyboard2,
+    operation, action,
+    add_info,
+    current_app_name, current_subtask,
+    important_content, layout="legacy",
+):
+    if layout == "cache":
+        prompt = "These images are two phone screenshots BEFORE and AFTER one operation.\n\n"
+    else:
+        prompt = f"These images are two phone screenshots BEFORE and AFTER one operation. Width={width}px, Height={height}px.\n\n"
     prompt += "Coordinates format is (x, y): x is left-to-right pixels, y is top-to-bottom pixels.\n"
     prompt += "Keyboard status indicates whether the on-screen keyboard is activated.\n\n"
+    if layout == "cache":
+        prompt += _reflect_rules() + "\n\n"
+        prompt += "### Screenshot size ###\n"
+        prompt += f"Width={width}px, Height={height}px.\n\n"
 
     prompt += "### Task context ###\n"
     prompt += f"User instruction: {instruction}\n"
@@ -233,6 +480,14 @@ def get_reflect_prompt(
     prompt += "This is the current stored important content. You must keep it unchanged unless you are sure the operation succeeded (Answer=A) and you extracted NEW useful information.\n"
     prompt += (important_content.strip() if important_content else "(empty)") + "\n\n"
 
+    if layout == "cache":
+        prompt += "Now judge the operation and update the Important content following the response requirements and output format given at the beginning.\n"
+        return prompt
+    return prompt + _reflect_rules()
+
+
+def _reflect_rules():
+    prompt = ""
     prompt += "### Response requirements ###\n"
     prompt += "1) Judge whether the result of the Operation action meets the expectation of Operation thought, by comparing the before/after screenshots.\n"
     prompt += "Choose exactly ONE:\n"
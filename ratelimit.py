@@ -0,0 +1,249 @@
+# 客户端限流：每个模型一对令牌桶（每分钟请求数 RPM、每分钟 token 数 TPM），
+# 预算不够时按优先级排队（decision > reflection > planning > memory），关键路径上的调用先拿到预算。
+# 发送前按请求内容估计 token 数，拿到返回的 usage 后再修正桶里的扣减量
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+import metrics
+
+# 数字越小越先服务；未指定阶段的调用按 planning 处理
+PRIORITY = {"decision": 0, "reflection": 1, "planning": 2, "memory": 3}
+DEFAULT_PRIORITY = "planning"
+
+# 估计 prompt token 用：一张截图大约的 token 数（576x1280 高精度图为 6 块 * 170 + 85）、每条消息的固定开销
+IMAGE_TOKENS = 1105
+MESSAGE_TOKENS = 4
+
+
+def estimate_tokens(data):
+    """发送前粗估一次请求的 prompt token 数：文本按 4 字节 1 个，图片按 IMAGE_TOKENS。"""
+    tokens = 0
+    for message in data["messages"]:
+        tokens += MESSAGE_TOKENS
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content.encode()) // 4
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += len(part.get("text", "").encode()) // 4
+    return tokens
+
+
+class TokenBucket:
+    """容量为每分钟限额、匀速补充的令牌桶。允许被修正成负数（欠账），之后补回来之前不放行。"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount):
+        """还要等多少秒才够 amount；超过容量的请求等桶满即可，否则永远发不出去。"""
+        need = min(amount, self.capacity) - self.level
+        return need / self.rate if need > 0 else 0.0
+
+
+class Ticket:
+    """一次放行的凭据：拿到 usage 后 settle() 把预扣的 token 修正为实际用量。"""
+    __slots__ = ("limiter", "estimate", "reserved", "waited")
+
+    def __init__(self, limiter, estimate, reserved, waited):
+        self.limiter = limiter
+        self.estimate = estimate  # 未校准的 prompt 估计值
+        self.reserved = reserved  # 实际从 TPM 桶里扣掉的量
+        self.waited = waited
+
+    def settle(self, usage):
+        if usage and self.limiter is not None:
+            self.limiter.settle(self, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0)
+        self.limiter = None
+
+    def cancel(self):
+        """请求没成功（要重试或放弃）：预扣的 token 全部还回 TPM 桶，不参与估计值校准。"""
+        if self.limiter is not None:
+            self.limiter.settle(self, 0, 0)
+        self.limiter = None
+
+
+class ModelLimiter:
+    """
+    单个模型的 RPM/TPM 限流。等待者放进按 (优先级, 到达顺序) 排的堆里，
+    只有堆顶能扣预算，低优先级的调用不会在预算紧张时抢在 decision 前面。
+    """
+
+    def __init__(self, model, rpm=None, tpm=None, completion_reserve=512):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.completion_reserve = completion_reserve  # 输出 token 也计入 TPM，先按这个数预扣
+        self.ratio = 1.0  # 实际 prompt token / 估计值 的滑动平均，用来校准后续估计
+        self.paused_until = 0.0  # 收到 429 后到这个时刻之前都不放行
+        self._cond = threading.Condition()
+        self._waiters = []  # 堆：(priority, seq)
+        self._seq = itertools.count()
+        self.stats = {"requests": 0, "throttled": 0, "waited": 0.0, "estimated": 0, "actual": 0, "rate_limited": 0}
+        self.stages = {}  # 阶段 -> {"requests", "waited"}，看优先级是否起作用
+
+    def _try_take(self, key, amount):
+        """调用方持有锁。轮到 key 且预算足够时扣掉并返回 0，否则返回建议等待的秒数（None 表示没轮到）。"""
+        if self._waiters[0] != key:
+            return None
+        now = time.monotonic()
+        wait = self.paused_until - now
+        for bucket, n in ((self.requests, 1), (self.tokens, amount)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(n))
+        if wait > 0:
+            return wait
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= amount
+        heapq.heappop(self._waiters)
+        self._cond.notify_all()
+        return 0.0
+
+    def _discard(self, key):
+        with self._cond:
+            if key in self._waiters:
+                self._waiters.remove(key)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def _enqueue(self, priority, estimate):
+        amount = int(estimate * self.ratio) + self.completion_reserve
+        with self._cond:
+            key = (PRIORITY.get(priority, PRIORITY[DEFAULT_PRIORITY]), next(self._seq))
+            heapq.heappush(self._waiters, key)
+        return key, amount
+
+    def _granted(self, priority, estimate, amount, waited):
+        stage = priority or DEFAULT_PRIORITY
+        with self._cond:
+            st = self.stages.setdefault(stage, {"requests": 0, "waited": 0.0})
+            st["requests"] += 1
+            st["waited"] += waited
+            self.stats["requests"] += 1
+            self.stats["estimated"] += amount
+            if waited > 0.001:
+                self.stats["throttled"] += 1
+                self.stats["waited"] += waited
+        if waited > 0.001:
+            metrics.inc("llm_throttled_total", model=self.model, stage=stage)
+            metrics.inc("llm_throttle_seconds_total", waited, model=self.model)
+        return Ticket(self, estimate, amount, waited)
+
+    def acquire(self, estimate, priority=None):
+        """阻塞直到放行，返回 Ticket。"""
+        key, amount = self._enqueue(priority, estimate)
+        start = time.monotonic()
+        try:
+            with self._cond:
+                while True:
+                    wait = self._try_take(key, amount)
+                    if wait == 0:
+                        break
+                    # 没轮到时等前面的人放行后 notify；轮到了但预算不够时睡到预计补足的时刻
+                    self._cond.wait(timeout=wait if wait is not None else 1.0)
+        except BaseException:
+            self._discard(key)
+            raise
+        return self._granted(priority, estimate, amount, time.monotonic() - start)
+
+    async def acquire_async(self, estimate, priority=None):
+        """acquire 的协程版本，不阻塞事件循环；和同步调用方排在同一个队列里。"""
+        key, amount = self._enqueue(priority, estimate)
+        start = time.monotonic()
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(key, amount)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait, 0.05) if wait is not None else 0.05)
+        except BaseException:
+            self._discard(key)
+            raise
+        return self._granted(priority, estimate, amount, time.monotonic() - start)
+
+    def settle(self, ticket, prompt_tokens, completion_tokens):
+        actual = prompt_tokens + completion_tokens
+        with self._cond:
+            if self.tokens is not None:
+                # 多扣的还回去，少扣的补扣（可以扣成负数）
+                self.tokens.level = min(self.tokens.capacity, self.tokens.level + ticket.reserved - actual)
+            if ticket.estimate and prompt_tokens:
+                self.ratio = 0.8 * self.ratio + 0.2 * (prompt_tokens / ticket.estimate)
+            self.stats["actual"] += actual
+            self._cond.notify_all()
+
+    def penalize(self, seconds):
+        """收到 429：这段时间内谁都不放行，避免所有调用方同时重试把情况弄得更糟。"""
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+        metrics.inc("llm_rate_limited_total", model=self.model)
+
+
+class RateLimiter:
+    """
+    按模型分别限流。limits 为 {model: {"rpm": ..., "tpm": ...}}，没列出的模型用 default（None 表示不限）。
+    同步和异步客户端应共用同一个 RateLimiter，它们消耗的是同一份服务端配额。
+    """
+
+    def __init__(self, limits, default=None, completion_reserve=512):
+        self.limits = dict(limits)
+        self.default = default
+        self.completion_reserve = completion_reserve
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        with self._lock:
+            limiter = self._models.get(model)
+            if limiter is None:
+                cfg = self.limits.get(model, self.default)
+                if cfg is None:
+                    return None
+                limiter = self._models[model] = ModelLimiter(model, cfg.get("rpm"), cfg.get("tpm"),
+                                                             self.completion_reserve)
+            return limiter
+
+    def acquire(self, data, priority=None):
+        limiter = self.get(data["model"])
+        if limiter is None:
+            return Ticket(None, 0, 0, 0.0)
+        return limiter.acquire(estimate_tokens(data), priority)
+
+    async def acquire_async(self, data, priority=None):
+        limiter = self.get(data["model"])
+        if limiter is None:
+            return Ticket(None, 0, 0, 0.0)
+        return await limiter.acquire_async(estimate_tokens(data), priority)
+
+    def penalize(self, model, seconds):
+        limiter = self.get(model)
+        if limiter is not None:
+            limiter.penalize(seconds)
+
+    def summary(self):
+        with self._lock:
+            models = list(self._models.items())
+        out = {}
+        for model, limiter in models:
+            with limiter._cond:
+                out[model] = dict(limiter.stats, ratio=round(limiter.ratio, 3),
+                                  stages={k: dict(v) for k, v in limiter.stages.items()})
+        return out
@@ -0,0 +1,451 @@
+# 离线录制/回放：python replay.py {record,run,serve} <trace_dir> [options]
+#   record  用真机 + 真实 API 跑一遍 main.py，把截图、adb 命令、LLM 请求/回答写进 trace 目录
+#   run     用假设备 + 本地 stub LLM 服务把 trace 重放一遍，不需要模拟器和 API key
+#   serve   只启动 stub LLM 服务（按请求指纹应答），给其他客户端用
+import os
+import sys
+import json
+import gzip
+import time
+import runpy
+import shutil
+import sqlite3
+import argparse
+import threading
+import subprocess as sp
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import api
+import controller
+
+MAIN_PATH = str(Path(__file__).with_name("main.py"))
+# main.py 在工作目录下读写的记忆文件，录制前快照到 trace/initial/，回放前拷回去
+MEMORY_FILES = ("memory_db.sqlite", "memory_db.json")
+
+
+class ReplayError(Exception):
+    """trace 用完了，或者回放时找不到对应的记录。"""
+
+
+class Trace:
+    """
+    trace 目录：
+      meta.json      instruction 和录制时的设置
+      events.jsonl   设备事件（frame / screenshot / settle / shell / run），按发生顺序；
+                     query 为后台线程里的只读查询（键盘状态、界面树），和其他事件的先后不固定，回放时单独按参数对应
+      llm.jsonl      LLM 调用：指纹、模型、耗时、回答，以及去掉图片字节的请求
+      frames/        截图（原始帧为 gzip 压缩的像素，PNG 模式为原文件）
+      initial/       录制开始时的记忆库快照
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.frames = self.path / "frames"
+
+    def read_jsonl(self, name):
+        p = self.path / name
+        if not p.exists():
+            return []
+        with open(p, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    @property
+    def meta(self):
+        return json.loads((self.path / "meta.json").read_text(encoding="utf-8"))
+
+    def load_frame(self, event):
+        with gzip.open(self.path / event["file"], "rb") as f:
+            pixels = f.read()
+        return controller.Frame(event["width"], event["height"], pixels, event["format"])
+
+
+class Recorder:
+    """包住 controller 和 api 的默认客户端，把真实设备和 LLM 的交互写进 trace。"""
+
+    def __init__(self, trace_dir):
+        self.trace = Trace(trace_dir)
+        self.trace.frames.mkdir(parents=True, exist_ok=True)
+        self._events = open(self.trace.path / "events.jsonl", "w", encoding="utf-8")
+        self._llm = open(self.trace.path / "llm.jsonl", "w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._local = threading.local()  # 按线程计数：wait_for_settle / _query 内部的命令不单独记录
+
+    @property
+    def _inner(self):
+        return getattr(self._local, "inner", 0)
+
+    @_inner.setter
+    def _inner(self, value):
+        self._local.inner = value
+
+    def _write(self, f, record):
+        with self._lock:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+    def _next_file(self, suffix):
+        with self._lock:
+            self._seq += 1
+            return f"frames/{self._seq:06d}{suffix}"
+
+    def _save_frame(self, frame):
+        name = self._next_file(".raw.gz")
+        with gzip.open(self.trace.path / name, "wb", compresslevel=1) as f:
+            f.write(frame.pixels)
+        return {"file": name, "width": frame.width, "height": frame.height, "format": frame.pixel_format}
+
+    def install(self):
+        real = {name: getattr(controller, name) for name in ("_run", "_shell", "_query", "get_frame", "get_screenshot", "wait_for_settle")}
+
+        def _run(adb_path, *args, check=False):
+            res = real["_run"](adb_path, *args, check=check)
+            self._write(self._events, {"op": "run", "args": list(map(str, args)), "code": res.returncode, "stdout": res.stdout})
+            return res
+
+        def _shell(adb_path, *args, check=False):
+            res = real["_shell"](adb_path, *args, check=check)
+            if not self._inner:
+                self._write(self._events, {"op": "shell", "args": list(map(str, args)), "code": res.returncode, "stdout": res.stdout})
+            return res
+
+        def _query(adb_path, *args):
+            self._inner += 1
+            try:
+                res = real["_query"](adb_path, *args)
+            finally:
+                self._inner -= 1
+            self._write(self._events, {"op": "query", "args": list(map(str, args)), "code": res.returncode, "stdout": res.stdout})
+            return res
+
+        def get_frame(adb_path):
+            frame = real["get_frame"](adb_path)
+            if not self._inner:
+                self._write(self._events, {"op": "frame", **self._save_frame(frame)})
+            return frame
+
+        def get_screenshot(adb_path, save_path):
+            out = real["get_screenshot"](adb_path, save_path)
+            name = self._next_file(".png")
+            shutil.copyfile(out, self.trace.path / name)
+            self._write(self._events, {"op": "screenshot", "file": name})
+            return out
+
+        def wait_for_settle(adb_path, **kwargs):
+            self._inner += 1
+            try:
+                waited, frame = real["wait_for_settle"](adb_path, **kwargs)
+            finally:
+                self._inner -= 1
+            self._write(self._events, {"op": "settle", "waited": waited, **self._save_frame(frame)})
+            return waited, frame
+
+        for name, fn in (("_run", _run), ("_shell", _shell), ("_query", _query), ("get_frame", get_frame),
+                         ("get_screenshot", get_screenshot), ("wait_for_settle", wait_for_settle)):
+            setattr(controller, name, fn)
+
+        sync_call, async_call = api.default_client.call, api.default_async_client.call
+
+        def call(chat, model, api_url, token, max_tokens=2048, priority=None):
+            start = time.time()
+            out = sync_call(chat, model, api_url, token, max_tokens, priority)
+            self.log_llm(api.build_request(chat, model, max_tokens), out, time.time() - start)
+            return out
+
+        async def acall(chat, model, api_url, token, max_tokens=2048, priority=None):
+            start = time.time()
+            out = await async_call(chat, model, api_url, token, max_tokens, priority)
+            self.log_llm(api.build_request(chat, model, max_tokens), out, time.time() - start)
+            return out
+
+        api.default_client.call = call
+        api.default_async_client.call = acall
+
+    def log_llm(self, data, response, elapsed):
+        self._write(self._llm, {
+            "fingerprint": api.request_fingerprint(data),
+            "model": data["model"],
+            "elapsed": elapsed,
+            "response": response,
+            "request": api.canonical_request(data),
+        })
+
+    def snapshot_memory(self, workdir="."):
+        """把当前的记忆库拷进 trace/initial/，回放时从同样的记忆开始。"""
+        initial = self.trace.path / "initial"
+        initial.mkdir(exist_ok=True)
+        for name in MEMORY_FILES:
+            src = Path(workdir) / name
+            if not src.exists():
+                continue
+            if name.endswith(".sqlite"):
+                # WAL 模式下直接拷文件可能丢最近的写入，走 backup API
+                with sqlite3.connect(src) as a, sqlite3.connect(initial / name) as b:
+                    a.backup(b)
+            else:
+                shutil.copyfile(src, initial / name)
+
+    def close(self):
+        self._events.close()
+        self._llm.close()
+
+
+class FakeDevice:
+    """
+    假的 controller 后端：按 trace 的顺序返回录制的截图，adb 命令只记日志、不执行。
+    命令和录制的不一致时记一条 divergence，并在后面找同类事件重新对齐。
+    只读查询（query）和截屏并行、先后不固定，不参与排序：按参数取最早一条没用过的，不移动主游标。
+    latency 为回放录制时 UI 等待时间的倍数（0 表示不等待）。
+    """
+
+    def __init__(self, trace, latency=0.0):
+        self.trace = trace
+        events = trace.read_jsonl("events.jsonl")
+        self.events = [ev for ev in events if ev["op"] != "query"]
+        self.queries = [ev for ev in events if ev["op"] == "query"]
+        self.queries_used = [False] * len(self.queries)
+        self.latency = latency
+        self.pos = 0
+        self.commands = []
+        self.divergences = []
+        self._lock = threading.Lock()
+
+    def _take(self, op, args=None):
+        with self._lock:
+            for j in range(self.pos, len(self.events)):
+                ev = self.events[j]
+                if ev["op"] == op and (args is None or ev["args"] == args):
+                    if j != self.pos:
+                        self.divergences.append({"expected": self.events[self.pos], "got": {"op": op, "args": args}})
+                    self.pos = j + 1
+                    return ev
+            raise ReplayError(f"trace exhausted: no {op} {args or ''} after event {self.pos}")
+
+    def _command(self, op, adb_path, args, check):
+        args = list(map(str, args))
+        self.commands.append({"op": op, "args": args})
+        try:
+            ev = self._take(op, args)
+        except ReplayError:
+            # 录制里没有这条命令：agent 走了不同的分支，照常返回成功，后面的截图仍按顺序给
+            self.divergences.append({"expected": self.events[self.pos] if self.pos < len(self.events) else {}, "got": {"op": op, "args": args}})
+            ev = {}
+        res = sp.CompletedProcess([adb_path, *args], ev.get("code", 0), ev.get("stdout", ""), "")
+        if check:
+            res.check_returncode()
+        return res
+
+    def _run(self, adb_path, *args, check=False):
+        return self._command("run", adb_path, args, check)
+
+    def _shell(self, adb_path, *args, check=False):
+        return self._command("shell", adb_path, args, check)
+
+    def _query(self, adb_path, *args):
+        args = list(map(str, args))
+        self.commands.append({"op": "query", "args": args})
+        with self._lock:
+            for j, ev in enumerate(self.queries):
+                if not self.queries_used[j] and ev["args"] == args:
+                    self.queries_used[j] = True
+                    return sp.CompletedProcess([adb_path, *args], ev["code"], ev["stdout"], "")
+            self.divergences.append({"expected": {}, "got": {"op": "query", "args": args}})
+        # 录制里没有这次查询：当作查询失败，调用方会走各自的兜底
+        return sp.CompletedProcess([adb_path, *args], 1, "", "")
+
+    def get_frame(self, adb_path):
+        return self.trace.load_frame(self._take("frame"))
+
+    def get_screenshot(self, adb_path, save_path):
+        ev = self._take("screenshot")
+        Path(save_path).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self.trace.path / ev["file"], save_path)
+        return str(save_path)
+
+    def wait_for_settle(self, adb_path, **kwargs):
+        ev = self._take("settle")
+        if self.latency:
+            time.sleep(ev["waited"] * self.latency)
+        return ev["waited"], self.trace.load_frame(ev)
+
+    def install(self):
+        for name in ("_run", "_shell", "_query", "get_frame", "get_screenshot", "wait_for_settle"):
+            setattr(controller, name, getattr(self, name))
+
+
+class StubLLMServer:
+    """
+    按请求指纹应答的 OpenAI 兼容服务。指纹相同的请求按录制顺序依次返回；
+    指纹对不上（比如记忆里的 updated_at 变了）时，退回到同一模型下一个没用过的回答，记为 fallback。
+    latency 为回放录制时模型耗时的倍数（0 表示立即返回）。
+    """
+
+    def __init__(self, trace, port=0, latency=0.0):
+        self.records = trace.read_jsonl("llm.jsonl")
+        self.latency = latency
+        self.used = [False] * len(self.records)
+        self.stats = {"exact": 0, "fallback": 0, "miss": 0}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/chat/completions"
+        self._thread = None
+
+    def lookup(self, data):
+        fp = api.request_fingerprint(data)
+        with self._lock:
+            for kind, match in (("exact", lambda r: r["fingerprint"] == fp),
+                                ("fallback", lambda r: r["model"] == data.get("model"))):
+                for j, rec in enumerate(self.records):
+                    if not self.used[j] and match(rec):
+                        self.used[j] = True
+                        self.stats[kind] += 1
+                        return rec
+            self.stats["miss"] += 1
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                rec = server.lookup(data)
+                if rec is None:
+                    status, body = 404, {"error": {"message": "no recorded response for this request"}}
+                else:
+                    if server.latency:
+                        time.sleep(rec["elapsed"] * server.latency)
+                    status, body = 200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": rec["response"]}}]}
+                payload = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main_settings():
+    """执行 main.py 的顶层（不进入 agent 循环），取出当前设置。"""
+    g = runpy.run_path(MAIN_PATH, run_name="main_settings")
+    keys = ("instruction", "add_info", "raw_screencap", "settle_adaptive", "image_max_side", "image_format",
+            "image_quality", "speculative", "speculative_decision", "memory_backend", "memory_retrieval", "prompt_layout")
+    return {k: g.get(k) for k in keys}
+
+
+def run_main():
+    """以 __main__ 身份执行 main.py，跑到规划器判定完成为止。"""
+    runpy.run_path(MAIN_PATH, run_name="__main__")
+
+
+def cmd_record(args):
+    trace = Trace(args.trace)
+    trace.path.mkdir(parents=True, exist_ok=True)
+    meta = main_settings()
+    meta["recorded_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    (trace.path / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    recorder = Recorder(trace.path)
+    recorder.snapshot_memory()
+    recorder.install()
+    try:
+        run_main()
+    finally:
+        recorder.close()
+    print(f"[Record] trace written to {trace.path}")
+
+
+def cmd_run(args):
+    trace = Trace(Path(args.trace).resolve())
+    meta = trace.meta
+    workdir = Path(args.workdir or trace.path / f"replay_{time.strftime('%Y%m%d_%H%M%S')}").resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    for name in MEMORY_FILES:
+        src = trace.path / "initial" / name
+        if src.exists():
+            shutil.copyfile(src, workdir / name)
+
+    server = StubLLMServer(trace, latency=args.latency).start()
+    device = FakeDevice(trace, latency=args.latency)
+    device.install()
+    os.environ["GUI_AGENT_API_URL"] = server.url
+    os.environ["GUI_AGENT_API_KEY"] = "replay"
+    os.environ["GUI_AGENT_INSTRUCTION"] = meta["instruction"]
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    start = time.time()
+    status = "completed"
+    try:
+        run_main()
+    except ReplayError as e:
+        status = str(e)
+    finally:
+        os.chdir(cwd)
+        server.stop()
+    elapsed = time.time() - start
+
+    with open(workdir / "commands.jsonl", "w", encoding="utf-8") as f:
+        for c in device.commands:
+            f.write(json.dumps(c, ensure_ascii=False) + "\n")
+    print("\n" + "=" * 50 + " Replay " + "=" * 52)
+    print(f"Status: {status}")
+    print(f"Wall time: {elapsed:.1f} s, workdir {workdir}")
+    print(f"Device events used: {device.pos}/{len(device.events)}, queries {sum(device.queries_used)}/{len(device.queries)}, "
+          f"commands {len(device.commands)}, divergences {len(device.divergences)}")
+    print(f"LLM responses: {server.stats['exact']} exact, {server.stats['fallback']} fallback, {server.stats['miss']} miss "
+          f"({len(server.records)} recorded)")
+    for d in device.divergences[:5]:
+        print(f"  divergence: expected {d['expected'].get('op')} {d['expected'].get('args', '')}, got {d['got']['op']} {d['got']['args'] or ''}")
+    return 0 if status == "completed" and not device.divergences and not server.stats["miss"] else 1
+
+
+def cmd_serve(args):
+    server = StubLLMServer(Trace(args.trace), port=args.port, latency=args.latency)
+    print(f"[Stub LLM] serving {len(server.records)} responses at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"[Stub LLM] {server.stats}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GUI Agent offline record/replay")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("record", help="run main.py against the real device and API, recording a trace")
+    p.add_argument("trace")
+    p.set_defaults(func=cmd_record)
+
+    p = sub.add_parser("run", help="replay a trace with the fake device and the stub LLM server")
+    p.add_argument("trace")
+    p.add_argument("--workdir", help="回放的工作目录（记忆库、截图写在这里），默认 trace/replay_<时间>")
+    p.add_argument("--latency", type=float, default=0.0, help="按录制耗时的倍数模拟模型和 UI 等待，0 为不等待")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("serve", help="serve recorded LLM responses over HTTP")
+    p.add_argument("trace")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--latency", type=float, default=0.0)
+    p.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# 多设备并行执行任务队列：python runner.py --tasks tasks.txt [--devices SERIAL ...] [options]
+# 每台设备一个（或 --per-device 个）worker 线程，各自跑 main.Agent；
+# 所有 worker 共用一个有上限的 LLM 连接池、技能记忆和后台事件循环
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+from collections import OrderedDict, deque
+
+import api
+import controller
+
+
+class Task:
+    def __init__(self, instruction, group="default", device=None):
+        self.instruction = instruction
+        self.group = group  # 公平调度的单位（比如提交任务的用户）
+        self.device = device  # 指定只在这台设备上跑，None 为任意设备
+
+
+class TaskQueue:
+    """
+    公平调度的任务队列：同一 group 内先进先出，group 之间轮转出队，
+    一个 group 提交的大批任务不会让其他 group 一直等。指定了 device 的任务只给那台设备的 worker。
+    """
+
+    def __init__(self):
+        self._groups = OrderedDict()  # group -> deque[Task]，顺序即轮转顺序
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, task):
+        with self._cond:
+            self._groups.setdefault(task.group, deque()).append(task)
+            self._cond.notify_all()
+
+    def close(self):
+        """不再有新任务；队列取空后 get() 返回 None。"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _pop(self, serial):
+        for group, tasks in self._groups.items():
+            for k, task in enumerate(tasks):
+                if task.device is None or task.device == serial:
+                    del tasks[k]
+                    # 取过的 group 挪到队尾，下次先轮到别的 group
+                    self._groups.move_to_end(group)
+                    if not tasks:
+                        del self._groups[group]
+                    return task
+        return None
+
+    def get(self, serial):
+        with self._cond:
+            while True:
+                task = self._pop(serial)
+                if task is not None or self._closed:
+                    return task
+                self._cond.wait()
+
+
+def load_tasks(path):
+    """每行一个任务：纯文本为 instruction；以 { 开头时按 JSON 读 instruction / group / device。"""
+    tasks = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                obj = json.loads(line)
+                tasks.append(Task(obj["instruction"], obj.get("group", "default"), obj.get("device")))
+            else:
+                tasks.append(Task(line))
+    return tasks
+
+
+def share_llm_pool(pool_size):
+    """所有 worker 共用的 LLM 客户端：连接数到 pool_size 后新的请求排队等待。限流器和应答缓存沿用原来的。"""
+    old, old_async = api.default_client, api.default_async_client
+    api.default_client = api.LLMClient(pool_size=pool_size, pool_block=True, limiter=old.limiter, cache=old.cache)
+    api.default_async_client = api.AsyncLLMClient(pool_size=pool_size, limiter=old.limiter, cache=old.cache)
+    # 被替换的客户端不会再用到，关掉它们的连接池
+    old.session.close()
+    old_async.close_threadsafe()
+
+
+def run_tasks(tasks, serials, adb_path, per_device=1, max_steps=None, quiet=False, device_options=None):
+    """
+    在 serials 这些设备上并行执行 tasks，返回每个任务的结果（按完成顺序）。
+    per_device 为每台设备同时跑的任务数（同一屏幕上一般只能跑一个）。
+    device_options 为 {serial: Agent 的关键字参数}（比如 no_change 阈值），按设备分别设置。
+    """
+    import main
+
+    if main.skill_index is None:
+        main.open_memory()
+    results = []
+    lock = threading.Lock()
+    queue = TaskQueue()
+    for task in tasks:
+        if task.device is not None and task.device not in serials:
+            # 指定的设备不在线：没有 worker 会取这个任务，直接记为失败，不让它从结果里消失
+            results.append({"instruction": task.instruction, "device": task.device, "group": task.group,
+                            "completed": False, "steps": 0, "time": 0.0, "error": "device not available"})
+        else:
+            queue.put(task)
+    queue.close()
+
+    def worker(serial, slot):
+        while True:
+            task = queue.get(serial)
+            if task is None:
+                return
+            name = serial if per_device == 1 else f"{serial}#{slot}"
+            agent = main.Agent(task.instruction, controller.device(adb_path, serial), name=name,
+                               screenshot_dir=f"./screenshot/{serial}/{slot}", **(device_options or {}).get(serial, {}))
+            start = time.time()
+            try:
+                result = agent.run(max_steps=max_steps)
+            except Exception as e:
+                if not quiet:
+                    traceback.print_exc()
+                result = {"instruction": task.instruction, "device": name, "completed": False,
+                          "steps": agent.steps, "time": time.time() - start, "error": f"{type(e).__name__}: {e}"}
+            result["group"] = task.group
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, args=(serial, slot), name=f"agent-{serial}-{slot}", daemon=True)
+               for serial in serials for slot in range(per_device)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if main.memory_retrieval == "vector":
+        main.skill_index.flush()
+    return results
+
+
+def no_change_options(values, serials):
+    """--no-change-ratio 的取值 -> {serial: {"no_change": {...}}}；不带 SERIAL= 的对所有设备生效，按出现顺序覆盖。"""
+    options = {}
+    for value in values or ():
+        serial, _, ratio = value.rpartition("=")
+        ratio = float(ratio)
+        for s in ([serial] if serial else serials):
+            options.setdefault(s, {}).setdefault("no_change", {}).update(enabled=ratio > 0, ratio=ratio)
+    return options
+
+
+def report(results, wall):
+    done = sum(r["completed"] for r in results)
+    steps = sum(r["steps"] for r in results)
+    print("\n" + "=" * 50 + " Runner " + "=" * 52)
+    for r in results:
+        status = "done" if r["completed"] else r.get("error", "stopped")
+        print(f"[{r['device']}] {r['steps']:3d} steps {r['time']:7.1f} s  {status}  {r['instruction']}")
+    print(f"{done}/{len(results)} tasks completed, {steps} steps in {wall:.1f} s "
+          f"({len(results) / wall * 3600:.0f} tasks/h, {steps / wall * 60:.1f} steps/min)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a queue of GUI agent tasks across several devices")
+    parser.add_argument("--tasks", required=True, help="任务文件：每行一个 instruction，或 JSON {instruction, group, device}")
+    parser.add_argument("--adb", help="adb 路径，默认用 main.py 里的 adb_path")
+    parser.add_argument("--devices", nargs="*", help="设备序列号，默认为 adb devices 里所有在线设备")
+    parser.add_argument("--per-device", type=int, default=1, help="每台设备同时跑的任务数")
+    parser.add_argument("--llm-pool", type=int, default=8, help="共用的 LLM 连接数上限")
+    parser.add_argument("--max-steps", type=int, help="单个任务的步数上限")
+    parser.add_argument("--no-change-ratio", action="append", metavar="[SERIAL=]RATIO",
+                        help="本地判定画面无变化的像素占比阈值，可按设备给出（SERIAL=RATIO），0 为关闭本地判定")
+    parser.add_argument("--json", help="把结果写成 JSON")
+    args = parser.parse_args(argv)
+
+    import main as agent_main
+    adb_path = args.adb or agent_main.adb_path
+    serials = args.devices or controller.list_devices(adb_path)
+    if not serials:
+        print("No device connected.")
+        return 1
+    share_llm_pool(args.llm_pool)
+    tasks = load_tasks(args.tasks)
+    print(f"{len(tasks)} tasks on {len(serials)} devices: {', '.join(serials)}")
+    start = time.time()
+    results = run_tasks(tasks, serials, adb_path, args.per_device, args.max_steps,
+                        device_options=no_change_options(args.no_change_ratio, serials))
+    wall = time.time() - start
+    report(results, wall)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"wall": wall, "devices": serials, "results": results}, f, ensure_ascii=False, indent=2)
+    return 0 if all(r["completed"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# LLMClient.call 的重试策略与失败时退还限流预扣：对着本地 http.server 桩服务跑，python -m pytest（或 python -m unittest）运行
+import json
+import time
+import threading
+import unittest
+import email.utils
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import api
+import ratelimit
+
+OK = (200, {}, {"choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}}]})
+
+
+class StubServer:
+    """按顺序返回预设的 (状态码, 响应头, 返回体)，用完后一直返回最后一个；记录收到的请求数。"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, headers, body = server.responses[min(server.requests, len(server.responses) - 1)]
+                server.requests += 1
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LLMClientRetryTest(unittest.TestCase):
+
+    def call(self, responses, max_attempts=3, limiter=None):
+        """返回 (结果或异常, 请求数, 每次重试前等待的秒数)。"""
+        server = StubServer(responses)
+        self.addCleanup(server.close)
+        client = api.LLMClient(max_attempts=max_attempts, backoff_base=0.01, backoff_max=30.0, limiter=limiter)
+        self.addCleanup(client.session.close)
+        with mock.patch.object(api.time, "sleep") as sleep, mock.patch("builtins.print"):
+            try:
+                out = client.call([("user", [{"type": "text", "text": "hi"}])], "gpt-4o", server.url, "key")
+            except api.LLMError as e:
+                out = e
+        return out, server.requests, [c.args[0] for c in sleep.call_args_list]
+
+    def test_success(self):
+        out, requests, delays = self.call([OK])
+        self.assertEqual((out, requests, delays), ("ok", 1, []))
+
+    def test_429_retry_after_seconds(self):
+        out, requests, delays = self.call([(429, {"Retry-After": "7"}, {"error": {}}), OK])
+        self.assertEqual((out, requests), ("ok", 2))
+        self.assertEqual(delays, [7.0])
+
+    def test_429_retry_after_http_date(self):
+        when = email.utils.formatdate(time.time() + 6, usegmt=True)
+        out, requests, delays = self.call([(429, {"Retry-After": when}, {"error": {}}), OK])
+        self.assertEqual((out, requests), ("ok", 2))
+        self.assertEqual(len(delays), 1)
+        self.assertTrue(4.0 < delays[0] <= 6.0, delays)
+
+    def test_5xx_retried_until_max_attempts(self):
+        out, requests, delays = self.call([(503, {}, {"error": {}})], max_attempts=3)
+        self.assertIsInstance(out, api.LLMError)
+        self.assertNotIsInstance(out, api.RetryableError)
+        self.assertEqual(out.status, 503)
+        self.assertEqual((requests, len(delays)), (3, 2))
+
+    def test_401_not_retried(self):
+        out, requests, delays = self.call([(401, {}, {"error": {"message": "bad key"}}), OK])
+        self.assertIsInstance(out, api.LLMError)
+        self.assertEqual(out.status, 401)
+        self.assertEqual((requests, delays), (1, []))
+
+    def test_200_without_choices_retried(self):
+        out, requests, delays = self.call([(200, {}, {"error": "upstream"}), OK])
+        self.assertEqual((out, requests, len(delays)), ("ok", 2, 1))
+
+    def test_failed_attempts_refund_reserved_tokens(self):
+        # TPM 6000：失败的尝试如果不退还，桶里会少掉一整份预扣（估计值 + 512）
+        limiter = ratelimit.RateLimiter({"gpt-4o": {"tpm": 6000}})
+        ok = (200, {}, dict(OK[2], usage={"prompt_tokens": 10, "completion_tokens": 5}))
+        out, requests, _ = self.call([(503, {}, {"error": {}}), (429, {}, {"error": {}}), ok], limiter=limiter)
+        self.assertEqual((out, requests), ("ok", 3))
+        bucket = limiter.get("gpt-4o").tokens
+        bucket.refill(time.monotonic())
+        self.assertGreaterEqual(bucket.level, bucket.capacity - 15 - 1)
+
+    def test_non_retryable_error_refunds_reserved_tokens(self):
+        limiter = ratelimit.RateLimiter({"gpt-4o": {"tpm": 6000}})
+        out, _, _ = self.call([(401, {}, {"error": {}})], limiter=limiter)
+        self.assertIsInstance(out, api.LLMError)
+        bucket = limiter.get("gpt-4o").tokens
+        self.assertEqual(bucket.level, bucket.capacity)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+# controller 的单元测试：type 的命令序列（录制命令的假 adb 代替真机）、常驻 shell 断开时不重发、uiautomator dump 的元素坐标；python -m pytest（或 python -m unittest）运行
+import sys
+import shlex
+import tempfile
+import unittest
+import subprocess as sp
+
+import controller
+
+
+class FakeAdb:
+    """替换 controller._shell / _run，只记录发出的命令。"""
+
+    def __init__(self):
+        self.shell = []
+        self.run = []
+
+    def _shell(self, adb_path, *args, check=False):
+        self.shell.append(tuple(map(str, args)))
+        return sp.CompletedProcess(list(args), 0, "", "")
+
+    def _run(self, adb_path, *args, check=False):
+        self.run.append(tuple(map(str, args)))
+        return sp.CompletedProcess(list(args), 0, "", "")
+
+
+class TypeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adb = FakeAdb()
+        self._saved = controller._shell, controller._run, controller.PERSISTENT_SHELL
+        controller._shell = self.adb._shell
+
+    def tearDown(self):
+        controller._shell, controller._run, controller.PERSISTENT_SHELL = self._saved
+
+    def typed(self, text):
+        controller.type("adb", text)
+        return self.adb.shell
+
+    def test_ascii_spaces(self):
+        self.assertEqual(self.typed("hello world 42"), [("input", "text", "hello%sworld%s42")])
+
+    def test_cjk_and_ascii_runs(self):
+        self.assertEqual(self.typed("打开 Settings，然后 search dark mode"), [
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "打开 "),
+            ("input", "text", "Settings"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "，然后 "),
+            ("input", "text", "search%sdark%smode"),
+        ])
+
+    def test_space_between_cjk_stays_in_one_broadcast(self):
+        self.assertEqual(self.typed("中 文"), [("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "中 文")])
+
+    def test_literal_percent_s(self):
+        # input text 会把 %s 当空格，字面的 % 走广播
+        self.assertEqual(self.typed("100%s off"), [
+            ("input", "text", "100"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "%"),
+            ("input", "text", "s%soff"),
+        ])
+
+    def test_shell_metacharacters(self):
+        self.assertEqual(self.typed("a&b|c$HOME`x`\"q\" it's (ok);"), [
+            ("input", "text", "a"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "&"),
+            ("input", "text", "b"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "|"),
+            ("input", "text", "c"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "$"),
+            ("input", "text", "HOME"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "`"),
+            ("input", "text", "x"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "`\""),
+            ("input", "text", "q"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "\" "),
+            ("input", "text", "it's%s(ok);"),
+        ])
+
+    def test_newlines_send_enter(self):
+        self.assertEqual(self.typed("第一行\\nline two"), [
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "第一行"),
+            ("input", "keyevent", "66"),
+            ("input", "text", "line%stwo"),
+        ])
+
+    def test_underscore_sends_enter(self):
+        self.assertEqual(self.typed("dark_mode"), [
+            ("input", "text", "dark"),
+            ("input", "keyevent", "66"),
+            ("input", "text", "mode"),
+        ])
+
+    def test_degree_sign_uses_input_text(self):
+        self.assertEqual(self.typed("25°C"), [("input", "text", "25°C")])
+
+    def test_one_shot_adb_quotes_each_argument(self):
+        # 不走常驻会话时参数由设备端 sh 重新拆分，转义后必须还原成同样的参数
+        controller._shell = self._saved[0]
+        controller._run = self.adb._run
+        controller.PERSISTENT_SHELL = False
+        controller.type("adb", "it's $HOME; 你好 (x)")
+        self.assertEqual([tuple(shlex.split(" ".join(args[1:]))) for args in self.adb.run], [
+            ("input", "text", "it's%s"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "$"),
+            ("input", "text", "HOME;%s"),
+            ("am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", "你好 "),
+            ("input", "text", "(x)"),
+        ])
+        self.assertTrue(all(args[0] == "shell" for args in self.adb.run))
+
+
+# 假的 "adb shell"：记下收到的第一条命令后直接退出，相当于命令已经生效、会话在回结果前断开
+DROPPING_SHELL = """
+import sys
+with open(sys.argv[1], "a") as f:
+    f.write(sys.stdin.readline())
+"""
+
+
+class AdbShellTest(unittest.TestCase):
+
+    def test_no_resend_after_command_was_written(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = f"{tmp}/commands.txt"
+            # _argv 之后会拼上 "shell"，作为脚本的第二个参数被忽略
+            shell = controller.AdbShell((sys.executable, "-c", DROPPING_SHELL, log), timeout=10)
+            with self.assertRaises(ConnectionError):
+                shell.run("input", "tap", 100, 200)
+            # 会话已丢弃，下一条命令重新连接
+            with self.assertRaises(ConnectionError):
+                shell.run("input", "tap", 300, 400)
+            with open(log) as f:
+                self.assertEqual([line.split(" 2>&1")[0] for line in f], ["input tap 100 200", "input tap 300 400"])
+            shell.close()
+
+
+# 1080x2400 设备上 Settings > Display 的 uiautomator dump（节选）
+UI_DUMP = """<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation="0">\
+<node index="0" text="" resource-id="" class="android.widget.FrameLayout" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[0,0][1080,2400]">\
+<node index="0" text="" resource-id="" class="android.widget.ImageButton" package="com.android.settings" content-desc="Navigate up" checkable="false" checked="false" clickable="true" enabled="true" focusable="true" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[0,80][126,206]" />\
+<node index="1" text="Display" resource-id="com.android.settings:id/title" class="android.widget.TextView" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[150,100][600,190]" />\
+<node index="2" text="" resource-id="com.android.settings:id/recycler_view" class="androidx.recyclerview.widget.RecyclerView" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="false" enabled="true" focusable="true" focused="false" scrollable="true" long-clickable="false" password="false" selected="false" bounds="[0,300][1080,2300]">\
+<node index="0" text="" resource-id="" class="android.widget.LinearLayout" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="true" enabled="true" focusable="true" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[0,300][1080,500]">\
+<node index="0" text="Dark theme" resource-id="android:id/title" class="android.widget.TextView" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[60,330][700,400]" />\
+<node index="1" text="" resource-id="android:id/switch_widget" class="android.widget.Switch" package="com.android.settings" content-desc="" checkable="true" checked="false" clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[900,340][1020,460]" />\
+</node>\
+<node index="1" text="Brightness level" resource-id="android:id/title" class="android.widget.TextView" package="com.android.settings" content-desc="" checkable="false" checked="false" clickable="true" enabled="true" focusable="true" focused="false" scrollable="false" long-clickable="false" password="false" selected="false" bounds="[60,2150][1020,2290]" />\
+</node></node></hierarchy>"""
+
+
+class UIDumpTest(unittest.TestCase):
+
+    def test_describe_uses_image_coordinates(self):
+        # 1080x2400 按长边 1280 缩放后发给模型：截图是 576x1280
+        scale = 1280 / 2400
+        elements = controller.parse_ui_dump(UI_DUMP)
+        self.assertTrue(elements)
+        for e in elements:
+            x, y = map(int, e.describe(scale).rsplit(" at (", 1)[1].rstrip(")").split(", "))
+            self.assertTrue(0 <= x <= 576 and 0 <= y <= 1280, e.describe(scale))
+            # 模型照抄这个坐标时，main.to_device 换算回设备像素应当落在控件中心
+            cx, cy = e.center
+            self.assertLessEqual(abs(round(x / scale) - cx), 2)
+            self.assertLessEqual(abs(round(y / scale) - cy), 2)
+
+    def test_describe_known_elements(self):
+        scale = 1280 / 2400
+        lines = [e.describe(scale) for e in controller.parse_ui_dump(UI_DUMP)]
+        self.assertTrue(any('"Navigate up"' in line and line.endswith("at (34, 76)") for line in lines), lines)
+        self.assertTrue(any('"Brightness level"' in line and line.endswith("at (288, 1184)") for line in lines), lines)
+
+
+if __name__ == "__main__":
+    unittest.main()